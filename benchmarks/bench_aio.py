@@ -0,0 +1,169 @@
+"""
+Compares the Twisted and asyncio clients against the same fake server.
+
+Starts :class:`txssmi.server.SSMIServerFactory` on 127.0.0.1 in its own
+process, then runs :class:`txssmi.protocol.SSMIProtocol` on the Twisted
+reactor and :class:`txssmi.aio.SSMIAsyncProtocol` on an asyncio event
+loop against it, each in a fresh process. Both log in and send the same
+messages, in bulk through ``send_messages`` waiting for every DR, or one
+at a time through ``send_binary_message`` waiting for the SEQs. Reports
+messages per second and SEQ latency percentiles for each.
+
+    python benchmarks/bench_aio.py [messages] [bulk|binary]
+"""
+import asyncio
+import subprocess
+import sys
+import time
+
+from txssmi.metrics import Histogram
+
+MESSAGE_COMMANDS = ('SEND_SMS', 'SEND_BINARY_SMS')
+
+
+def report(name, count, elapsed, histogram):
+    print('%-8s %8.0f msgs/sec  SEQ p50 %.1fms p99 %.1fms' % (
+        name, count / elapsed,
+        histogram.percentile(50) * 1000,
+        histogram.percentile(99) * 1000))
+
+
+def serve():
+    from twisted.internet import endpoints, reactor
+    from txssmi.server import SSMIServerFactory
+
+    def listening(port):
+        print(port.getHost().port)
+        sys.stdout.flush()
+
+    factory = SSMIServerFactory('username', 'password')
+    endpoints.TCP4ServerEndpoint(
+        reactor, 0, interface='127.0.0.1').listen(factory).addCallback(
+            listening)
+    reactor.run()
+
+
+def run_twisted(port, count, mode):
+    from twisted.internet import defer, endpoints, task
+    from txssmi.protocol import SSMIProtocol
+
+    class BenchProtocol(SSMIProtocol):
+
+        def __init__(self):
+            SSMIProtocol.__init__(self)
+            self.sent_at = {}
+            self.seq_latency = Histogram()
+            self.drs = 0
+            self.done = defer.Deferred()
+
+        def write_commands(self, commands):
+            now = time.time()
+            for command in commands:
+                if command.command_name in MESSAGE_COMMANDS:
+                    self.sent_at[command.msisdn] = now
+            return SSMIProtocol.write_commands(self, commands)
+
+        def handle_SEQ(self, seq):
+            self.seq_latency.observe(time.time() - self.sent_at[seq.msisdn])
+            return SSMIProtocol.handle_SEQ(self, seq)
+
+        def handle_DR(self, dr):
+            self.drs += 1
+            if self.drs == count:
+                self.done.callback(None)
+
+    @defer.inlineCallbacks
+    def main(reactor):
+        protocol = BenchProtocol()
+        yield endpoints.connectProtocol(
+            endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1', port),
+            protocol)
+        yield protocol.authenticate('username', 'password')
+        msisdns = ['27%09d' % (i,) for i in range(count)]
+        start = time.time()
+        if mode == 'bulk':
+            protocol.send_messages(
+                (msisdn, 'hello, world') for msisdn in msisdns)
+            yield protocol.done
+        else:
+            yield defer.gatherResults([
+                protocol.send_binary_message(msisdn, '68656c6c6f')
+                for msisdn in msisdns])
+        report('twisted', count, time.time() - start, protocol.seq_latency)
+        protocol.transport.loseConnection()
+
+    task.react(main)
+
+
+def run_asyncio(port, count, mode):
+    from txssmi.aio import SSMIAsyncProtocol
+
+    class BenchProtocol(SSMIAsyncProtocol):
+
+        def __init__(self, loop):
+            SSMIAsyncProtocol.__init__(self, loop)
+            self.sent_at = {}
+            self.seq_latency = Histogram()
+            self.drs = 0
+            self.done = loop.create_future()
+
+        def write_command(self, command, wait_for_seq=False):
+            if command.command_name in MESSAGE_COMMANDS:
+                self.sent_at[command.msisdn] = time.time()
+            return SSMIAsyncProtocol.write_command(
+                self, command, wait_for_seq)
+
+        def handle_SEQ(self, seq):
+            self.seq_latency.observe(time.time() - self.sent_at[seq.msisdn])
+            return SSMIAsyncProtocol.handle_SEQ(self, seq)
+
+        def handle_DR(self, dr):
+            self.drs += 1
+            if self.drs == count:
+                self.done.set_result(None)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_connection(
+            lambda: BenchProtocol(loop), '127.0.0.1', port)
+        await protocol.authenticate('username', 'password')
+        msisdns = ['27%09d' % (i,) for i in range(count)]
+        start = time.time()
+        if mode == 'bulk':
+            await protocol.send_messages(
+                (msisdn, 'hello, world') for msisdn in msisdns)
+            await protocol.done
+        else:
+            await asyncio.gather(*[
+                protocol.send_binary_message(msisdn, '68656c6c6f')
+                for msisdn in msisdns])
+        report('asyncio', count, time.time() - start, protocol.seq_latency)
+        protocol.transport.close()
+
+    asyncio.run(main())
+
+
+def main(count=10000, mode='bulk'):
+    server = subprocess.Popen(
+        [sys.executable, __file__, 'serve'],
+        stdout=subprocess.PIPE)
+    try:
+        port = server.stdout.readline().strip().decode('ascii')
+        print('messages: %s (%s)' % (count, mode))
+        for client in ('twisted', 'asyncio'):
+            subprocess.check_call(
+                [sys.executable, __file__, client, port, str(count), mode])
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve()
+    elif sys.argv[1:2] == ['twisted']:
+        run_twisted(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
+    elif sys.argv[1:2] == ['asyncio']:
+        run_asyncio(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
+    else:
+        main(*sys.argv[1:])
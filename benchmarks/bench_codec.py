@@ -0,0 +1,101 @@
+"""
+Micro-benchmark for moving SSMI commands between text and the wire.
+
+Inbound, compares decoding every line as its own bytes object against
+decoding each received chunk once, straight from a ``memoryview``, and
+splitting the text. Outbound, compares encoding and writing every command
+on its own against joining a batch and encoding it once.
+
+    python benchmarks/bench_codec.py [number of lines]
+"""
+import sys
+import time
+
+from twisted.protocols.basic import LineReceiver
+from twisted.internet.testing import StringTransport
+
+from txssmi.builder import SSMIResponse, encode
+from txssmi.constants import SSMI_ENCODING
+from txssmi.protocol import SSMIProtocol
+from txssmi.commands import MoMessage, DrMessage, Seq, Ack, SendSMS
+
+CHUNK_SIZE = 65536
+
+
+def sample_chunks(count):
+    templates = [
+        MoMessage(msisdn='27000000000', sequence='1',
+                  message=u'hello, w\xf6rld').to_bytes(),
+        DrMessage(msisdn='27000000000', sequence='1', ret_code='0').to_bytes(),
+        Seq(msisdn='27000000000', sequence='1').to_bytes(),
+        Ack(ack_type='1').to_bytes(),
+    ]
+    data = b''.join(templates[i % len(templates)] + b'\r'
+                    for i in range(count))
+    return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+class LineParser(LineReceiver):
+    """
+    The previous inbound path, ``LineReceiver`` handing over every line as
+    its own bytes object to be decoded and parsed.
+    """
+    delimiter = b'\r'
+    MAX_LENGTH = CHUNK_SIZE
+
+    def lineReceived(self, line):
+        SSMIResponse.parse(line.decode(SSMI_ENCODING))
+
+
+class ChunkParser(SSMIProtocol):
+    """
+    The current inbound path, decoding each chunk once.
+    """
+
+    def lineReceived(self, line):
+        SSMIResponse.parse(line)
+
+
+def receive(protocol_class, chunks):
+    protocol = protocol_class()
+    protocol.makeConnection(StringTransport())
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+
+
+def per_command(commands, transport):
+    for command in commands:
+        transport.writeSequence([encode(str(command)), b'\r'])
+
+
+def per_batch(commands, transport, batch_size=100):
+    for i in range(0, len(commands), batch_size):
+        batch = commands[i:i + batch_size]
+        transport.write(encode('\r'.join(map(str, batch)) + '\r'))
+
+
+def measure(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main(count=200000):
+    chunks = sample_chunks(count)
+    before = count / measure(receive, LineParser, chunks)
+    after = count / measure(receive, ChunkParser, chunks)
+    print('lines: %d' % (count,))
+    print('decode per line:  %.0f lines/sec' % (before,))
+    print('decode per chunk: %.0f lines/sec (%.1fx)' % (after, after / before))
+
+    commands = [SendSMS(msisdn='27000000000', message='hello %d' % (i,),
+                        validity='0') for i in range(count)]
+    before = count / measure(per_command, commands, StringTransport())
+    after = count / measure(per_batch, commands, StringTransport())
+    print('encode per command: %.0f commands/sec' % (before,))
+    print('encode per batch:   %.0f commands/sec (%.1fx)' % (
+        after, after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+"""
+Replays MO lines through ``SSMIProtocol.lineReceived`` to compare the cost
+of inbound logging.
+
+``before`` formats every MO with ``%r`` and logs it, as the handlers used
+to. ``after`` uses the default ``CommandLogger``, which drops the DEBUG
+level per-command messages before formatting anything, and ``sampled``
+logs 1% of them. A discarding log observer is attached throughout.
+
+    python benchmarks/bench_logging.py [number of lines]
+"""
+import sys
+import time
+
+from twisted.python import log
+
+from txssmi.commands import MoMessage
+from txssmi.logger import CommandLogger, DEBUG
+from txssmi.protocol import SSMIProtocol
+
+
+class LegacyProtocol(SSMIProtocol):
+
+    def handle_MO(self, mo):
+        log.msg('Received MO: %r' % (mo,))
+
+
+def measure(protocol, lines):
+    start = time.time()
+    for line in lines:
+        protocol.lineReceived(line)
+    return len(lines) / (time.time() - start)
+
+
+def main(count=100000):
+    lines = [str(MoMessage(msisdn='27000000000', sequence=str(i),
+                           message='hello, world')) for i in range(count)]
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+
+    before = measure(LegacyProtocol(), lines)
+    after = measure(SSMIProtocol(), lines)
+    sampled = SSMIProtocol()
+    sampled.logger = CommandLogger(level=DEBUG, sample_rate=0.01)
+    sampled = measure(sampled, lines)
+
+    print('lines: %d' % (count,))
+    print('before:  %.0f lines/sec' % (before,))
+    print('after:   %.0f lines/sec (%.1fx)' % (after, after / before))
+    print('sampled: %.0f lines/sec (%.1fx)' % (sampled, sampled / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,114 @@
+"""
+Load test over a loopback TCP connection.
+
+Starts :class:`txssmi.server.SSMIServerFactory` on 127.0.0.1, connects an
+:class:`txssmi.protocol.SSMIProtocol` to it, logs in and sends messages
+either in bulk through ``send_messages`` or one at a time through
+``send_binary_message``. Reports messages per second, the cost of
+serialising and parsing commands and SEQ and DR latency percentiles.
+
+    python benchmarks/bench_loopback.py [messages] [bulk|binary]
+"""
+import sys
+import time
+
+from twisted.internet import defer, endpoints, task
+
+from txssmi.builder import SSMIResponse
+from txssmi.commands import SendSMS, Seq
+from txssmi.metrics import Histogram
+from txssmi.protocol import SSMIProtocol
+from txssmi.server import SSMIServerFactory
+
+
+class LatencyProtocol(SSMIProtocol):
+
+    def __init__(self, expected):
+        SSMIProtocol.__init__(self)
+        self.expected = expected
+        self.sent_at = {}
+        self.seq_latency = Histogram()
+        self.dr_latency = Histogram()
+        self.drs = 0
+        self.done = defer.Deferred()
+
+    def write_commands(self, commands):
+        now = time.time()
+        for command in commands:
+            if command.command_name in self.sequenced_commands:
+                self.sent_at[command.msisdn] = now
+        return SSMIProtocol.write_commands(self, commands)
+
+    def handle_SEQ(self, seq):
+        self.seq_latency.observe(time.time() - self.sent_at[seq.msisdn])
+        return SSMIProtocol.handle_SEQ(self, seq)
+
+    def handle_DR(self, dr):
+        self.dr_latency.observe(time.time() - self.sent_at[dr.msisdn])
+        self.drs += 1
+        if self.drs == self.expected:
+            self.done.callback(None)
+
+
+def codec_cost(count=10000):
+    command = SendSMS(msisdn='27000000000', message='hello, world',
+                      validity='0')
+    start = time.time()
+    for _ in range(count):
+        str(command)
+    serialise = (time.time() - start) / count
+
+    line = str(Seq(msisdn='27000000000', sequence='1'))
+    start = time.time()
+    for _ in range(count):
+        SSMIResponse.parse(line)
+    parse = (time.time() - start) / count
+    return serialise, parse
+
+
+def report(name, histogram):
+    print('%s latency: p50 %.1fms p95 %.1fms p99 %.1fms' % (
+        name,
+        histogram.percentile(50) * 1000,
+        histogram.percentile(95) * 1000,
+        histogram.percentile(99) * 1000))
+
+
+@defer.inlineCallbacks
+def main(reactor, count=10000, mode='bulk'):
+    count = int(count)
+    msisdns = ['27%09d' % (i,) for i in range(count)]
+    factory = SSMIServerFactory('username', 'password')
+    port = yield endpoints.TCP4ServerEndpoint(
+        reactor, 0, interface='127.0.0.1').listen(factory)
+    protocol = LatencyProtocol(count)
+    yield endpoints.connectProtocol(
+        endpoints.TCP4ClientEndpoint(
+            reactor, '127.0.0.1', port.getHost().port),
+        protocol)
+    yield protocol.authenticate('username', 'password')
+
+    start = time.time()
+    if mode == 'bulk':
+        protocol.send_messages(
+            (msisdn, 'hello, world') for msisdn in msisdns)
+    else:
+        for msisdn in msisdns:
+            protocol.send_binary_message(msisdn, '68656c6c6f')
+    yield protocol.done
+    elapsed = time.time() - start
+
+    serialise, parse = codec_cost()
+    print('messages: %d (%s)' % (count, mode))
+    print('throughput: %.0f msgs/sec' % (count / elapsed,))
+    print('serialise: %.1fus/command parse: %.1fus/line' % (
+        serialise * 1e6, parse * 1e6))
+    report('SEQ', protocol.seq_latency)
+    report('DR', protocol.dr_latency)
+
+    protocol.transport.loseConnection()
+    yield port.stopListening()
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark for parsing inbound SSMI lines.
+
+Compares the previous parse path, which created a fresh command class and
+validated every field for each line, against ``SSMIResponse.parse`` which
+uses the registered class table and skips validation for parsed input.
+
+    python benchmarks/bench_parse.py [number of lines]
+"""
+import sys
+import time
+
+from txssmi.builder import SSMIResponse
+from txssmi.commands import MoMessage, DrMessage, Seq, Ack
+
+
+def sample_lines(count):
+    templates = [
+        str(MoMessage(msisdn='27000000000', sequence='1',
+                      message='hello, world')),
+        str(DrMessage(msisdn='27000000000', sequence='1', ret_code='0')),
+        str(Seq(msisdn='27000000000', sequence='1')),
+        str(Ack(ack_type='1')),
+    ]
+    return [templates[i % len(templates)] for i in range(count)]
+
+
+def legacy_parse(command_string):
+    _, _, command_string = command_string.partition(',')
+    command_id, _, command_values = command_string.partition(',')
+    command_name = SSMIResponse.command_name_map[command_id]
+    command_fields = SSMIResponse.command_field_map[command_name]
+    command_values = command_values.split(',', len(command_fields) - 1)
+    values = dict(zip(command_fields, command_values))
+    return SSMIResponse.create(command_name)(**values)
+
+
+def measure(parse, lines):
+    start = time.time()
+    for line in lines:
+        parse(line)
+    return len(lines) / (time.time() - start)
+
+
+def main(count=100000):
+    lines = sample_lines(count)
+    before = measure(legacy_parse, lines)
+    after = measure(SSMIResponse.parse, lines)
+    print('lines: %d' % (count,))
+    print('before: %.0f lines/sec' % (before,))
+    print('after:  %.0f lines/sec (%.1fx)' % (after, after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -14,6 +14,7 @@ setup(
     ],
     package_data={},
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=[
         'Twisted',
     ],
@@ -23,6 +24,8 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: POSIX',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: System :: Networking',
         'Framework :: Twisted',
@@ -0,0 +1,487 @@
+# -*- test-case-name: txssmi.tests.test_aio -*-
+"""
+An asyncio implementation of the SSMI client protocol.
+
+Shares the command classes, codec and tables with
+:class:`txssmi.protocol.SSMIProtocol` but does not import Twisted, so it
+runs directly on an asyncio event loop::
+
+    protocol = await connect('ssmi.example.com', 2222, 'user', 'pass')
+    await protocol.send_message('27000000000', 'hello')
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from itertools import count
+
+from txssmi.builder import (
+    SSMIResponse, SSMIException, SSMICommandException, CommandNacked,
+    encode, decode)
+from txssmi.commands import (
+    Login, SendSMS, LinkCheck, SendBinarySMS, ClientLogout, SendUSSDMessage,
+    SendWAPPushMessage, SendMMSMessage, IMSILookup, SendExtendedUSSDMessage)
+from txssmi.constants import (
+    RESPONSE_IDS, ACK_LOGIN_OK, ACK_LINK_CHECK_RESPONSE, CODING_7BIT,
+    PROTOCOL_STANDARD, PROTOCOL_ENHANCED, USSD_NEW, USSD_RESPONSE, USSD_END,
+    SSMI_ENCODING)
+from txssmi.segment import Segmenter
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyStore(object):
+    """
+    Matches replies to the futures waiting for them by key, in FIFO
+    order per key. Replies nobody is waiting for are dropped.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}
+
+    def __contains__(self, key):
+        return key in self.waiters
+
+    def wait(self, key):
+        future = self.loop.create_future()
+        self.waiters.setdefault(key, deque()).append(future)
+        future.add_done_callback(lambda f: self.discard(key, f))
+        return future
+
+    def discard(self, key, future):
+        queue = self.waiters.get(key)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiters[key]
+
+    def put(self, key, value):
+        queue = self.waiters.get(key)
+        while queue:
+            future = queue.popleft()
+            if not future.done():
+                future.set_result(value)
+                break
+        if queue is not None and not queue:
+            self.waiters.pop(key, None)
+
+    def fail_all(self, exception):
+        waiters, self.waiters = self.waiters, {}
+        for queue in waiters.values():
+            for future in queue:
+                if not future.done():
+                    future.set_exception(exception)
+
+
+class SeqTracker(object):
+    """
+    Matches SEQs and NACKs to the sequenced commands written, in the
+    order they were written, like :class:`txssmi.correlation.SeqTracker`.
+    A SEQ answers the oldest unanswered command to its msisdn and a NACK
+    the oldest unanswered command of all. Answers to commands nobody
+    waits for, or whose waiter gave up, are dropped. At most ``max_size``
+    written commands are kept, the oldest are dropped first.
+    """
+
+    def __init__(self, loop, max_size=10000):
+        self.loop = loop
+        self.max_size = max_size
+        self.written_order = OrderedDict()
+        self.by_msisdn = {}
+        self.keys = count()
+
+    def __len__(self):
+        return len(self.written_order)
+
+    def written(self, msisdn, wait=False):
+        """
+        Note that a command to ``msisdn`` was written. Returns a future
+        for its SEQ if ``wait`` is set.
+        """
+        future = self.loop.create_future() if wait else None
+        key = next(self.keys)
+        self.written_order[key] = (msisdn, future)
+        self.by_msisdn.setdefault(msisdn, deque()).append(key)
+        while len(self.written_order) > self.max_size:
+            self.answer(next(iter(self.written_order)), exception=(
+                SSMIException('Evicted SEQ waiter, too many pending '
+                              'replies.')))
+        return future
+
+    def answer(self, key, result=None, exception=None):
+        msisdn, future = self.written_order.pop(key)
+        # Always the oldest command written to its msisdn.
+        queue = self.by_msisdn[msisdn]
+        queue.popleft()
+        if not queue:
+            del self.by_msisdn[msisdn]
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def seq_received(self, seq):
+        queue = self.by_msisdn.get(seq.msisdn)
+        if queue:
+            self.answer(queue[0], result=seq)
+
+    def nack_received(self, nack):
+        """
+        Returns False if no command is waiting for an answer.
+        """
+        if not self.written_order:
+            return False
+        self.answer(next(iter(self.written_order)),
+                    exception=CommandNacked(nack))
+        return True
+
+    def fail_all(self, exception):
+        entries = list(self.written_order.values())
+        self.written_order.clear()
+        self.by_msisdn.clear()
+        for _, future in entries:
+            if future is not None and not future.done():
+                future.set_exception(exception)
+
+
+class SSMIAsyncProtocol(asyncio.Protocol):
+    """
+    SSMI client for asyncio. The ``send_*`` coroutines return once the
+    command has been handed to the transport, except for those that wait
+    for the server's reply as their Twisted counterparts do.
+
+    Commands written in the same pass of the event loop are encoded and
+    written together. While the transport's buffer is full the
+    coroutines wait for it to drain.
+    """
+
+    delimiter = b'\r'
+    encoding = SSMI_ENCODING
+    MAX_LENGTH = 16384
+    # Seconds to wait for SEQ, ACK and IMSI lookup replies.
+    reply_timeout = 60
+    max_pending_replies = 10000
+    sequenced_commands = frozenset(['SEND_SMS', 'SEND_BINARY_SMS'])
+    segmenter = Segmenter()
+    concatenated_protocol_id = PROTOCOL_ENHANCED
+
+    def __init__(self, loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.transport = None
+        self.authenticated = False
+        self.buffer = b''
+        self.outbound = []
+        self.flush_handle = None
+        self.paused = False
+        self.resume_waiters = []
+        self.events = asyncio.Queue()
+        self.sequence_replies = SeqTracker(
+            self.loop, self.max_pending_replies)
+        self.imsi_lookup_replies = ReplyStore(self.loop)
+        self.next_imsi_sequence = 1
+        self.link_check_handle = None
+        self.connected = self.loop.create_future()
+        self.disconnected = self.loop.create_future()
+        self.handlers = dict(
+            (command_name, getattr(self, 'handle_%s' % (command_name,)))
+            for command_name in SSMIResponse.command_name_map.values())
+        self.consumers = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected.set_result(None)
+
+    def connection_lost(self, exc):
+        self.stop_link_check()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        exception = exc or ConnectionError('Connection lost.')
+        self.sequence_replies.fail_all(exception)
+        self.imsi_lookup_replies.fail_all(exception)
+        self.resume_writing()
+        if not self.disconnected.done():
+            self.disconnected.set_result(exc)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        waiters, self.resume_waiters = self.resume_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def drain(self):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError('Not connected.')
+        if self.paused:
+            future = self.loop.create_future()
+            self.resume_waiters.append(future)
+            await future
+
+    def data_received(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        end = data.rfind(self.delimiter)
+        if end < 0:
+            self.buffer = data
+        else:
+            self.buffer = data[end + len(self.delimiter):]
+            text = decode(memoryview(data)[:end], self.encoding)
+            for line in text.split(decode(self.delimiter, self.encoding)):
+                if line:
+                    self.dispatch(SSMIResponse.parse(line))
+        if len(self.buffer) > self.MAX_LENGTH:
+            self.buffer = b''
+            self.transport.close()
+
+    def dispatch(self, command):
+        command_name = command.command_name
+        try:
+            self.handlers[command_name](command)
+        except Exception:
+            logger.exception('Error handling %s.', command_name)
+        for consumer in self.consumers.get(command_name, ()):
+            try:
+                consumer(command)
+            except Exception:
+                logger.exception(
+                    'Error in %s consumer %r.', command_name, consumer)
+
+    def register_handler(self, command_name, handler):
+        """
+        Call ``handler`` with every ``command_name`` command received,
+        after the protocol's own ``handle_*`` method.
+        """
+        if command_name not in self.handlers:
+            raise SSMICommandException(
+                'Unknown command name: %s' % (command_name,))
+        self.consumers.setdefault(command_name, []).append(handler)
+        return handler
+
+    def unregister_handler(self, command_name, handler):
+        consumers = self.consumers.get(command_name, [])
+        if handler in consumers:
+            consumers.remove(handler)
+
+    def write_command(self, command, wait_for_seq=False):
+        """
+        Queue ``command`` to be written with the others sent in this pass
+        of the event loop. Returns a future for its SEQ if
+        ``wait_for_seq`` is set.
+        """
+        self.outbound.append(str(command))
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_soon(self.flush)
+        if command.command_name in self.sequenced_commands:
+            return self.sequence_replies.written(
+                command.msisdn, wait_for_seq)
+
+    def flush(self):
+        self.flush_handle = None
+        lines, self.outbound = self.outbound, []
+        if not lines or self.transport is None:
+            return
+        lines.append('')
+        delimiter = decode(self.delimiter, self.encoding)
+        self.transport.write(
+            encode(delimiter.join(lines), self.encoding, 'replace'))
+
+    async def send_command(self, command):
+        await self.drain()
+        self.write_command(command)
+        return command
+
+    async def send_commands(self, commands):
+        sent = []
+        for command in commands:
+            if self.paused:
+                await self.drain()
+            self.write_command(command)
+            sent.append(command)
+        return sent
+
+    async def send_sequenced(self, command):
+        """
+        Send ``command`` and return its SEQ.
+        """
+        await self.drain()
+        reply = self.write_command(command, wait_for_seq=True)
+        return await asyncio.wait_for(reply, self.reply_timeout)
+
+    async def login(self, username, password):
+        return await self.send_command(
+            Login(username=username, password=password))
+
+    async def logout(self):
+        return await self.send_command(ClientLogout())
+
+    async def authenticate(self, username, password):
+        await self.login(username, password)
+        cmd = await asyncio.wait_for(self.events.get(), self.reply_timeout)
+        self.authenticated = (cmd.command_id == RESPONSE_IDS['ACK'] and
+                              cmd.ack_type == ACK_LOGIN_OK)
+        return cmd
+
+    async def send_link_request(self):
+        if self.authenticated:
+            return await self.send_command(LinkCheck())
+
+    def start_link_check(self, interval):
+        """
+        Send a link check every ``interval`` seconds while logged in.
+        """
+        def check():
+            self.link_check_handle = self.loop.call_later(interval, check)
+            if self.authenticated:
+                self.write_command(LinkCheck())
+
+        self.stop_link_check()
+        self.link_check_handle = self.loop.call_later(interval, check)
+
+    def stop_link_check(self):
+        if self.link_check_handle is not None:
+            self.link_check_handle.cancel()
+            self.link_check_handle = None
+
+    async def send_message(self, msisdn, message, validity='0'):
+        return await self.send_command(
+            SendSMS(msisdn=msisdn, message=message, validity=validity))
+
+    async def send_messages(self, messages, validity='0'):
+        """
+        Send an SMS for each ``(msisdn, message)`` pair in ``messages``.
+        Returns the commands sent.
+        """
+        return await self.send_commands(
+            SendSMS(msisdn=msisdn, message=message, validity=validity)
+            for msisdn, message in messages)
+
+    async def send_binary_message(self, msisdn, hex_message, validity='0',
+                                  protocol_id=PROTOCOL_STANDARD,
+                                  coding=CODING_7BIT):
+        return await self.send_sequenced(
+            SendBinarySMS(msisdn=msisdn, hex_msg=hex_message,
+                          validity=validity, pid=protocol_id, coding=coding))
+
+    async def send_long_message(self, msisdn, message, validity='0'):
+        """
+        Send ``message`` as concatenated binary SMS, see
+        :meth:`txssmi.protocol.SSMIProtocol.send_long_message`. Returns
+        the SEQ for every part.
+        """
+        coding, hex_parts = self.segmenter.hex_parts(message)
+        protocol_id = (PROTOCOL_STANDARD if len(hex_parts) == 1
+                       else self.concatenated_protocol_id)
+        return list(await asyncio.gather(*[
+            self.send_binary_message(msisdn, hex_msg, validity=validity,
+                                     protocol_id=protocol_id, coding=coding)
+            for hex_msg in hex_parts]))
+
+    async def send_ussd_message(self, msisdn, message, session_type):
+        return await self.send_command(
+            SendUSSDMessage(msisdn=msisdn, message=message, type=session_type))
+
+    async def send_extended_ussd_message(self, msisdn, message, session_type,
+                                         genfields):
+        if session_type not in [USSD_NEW, USSD_RESPONSE, USSD_END]:
+            raise SSMICommandException(
+                'Invalid session_type: %s' % (session_type,))
+        return await self.send_command(
+            SendExtendedUSSDMessage(msisdn=msisdn, message=message,
+                                    type=session_type,
+                                    genfields=':'.join(genfields)))
+
+    async def send_wap_push_message(self, msisdn, subject, url):
+        return await self.send_command(
+            SendWAPPushMessage(msisdn=msisdn, subject=subject, url=url))
+
+    async def send_mms_message(self, msisdn, subject, name, content):
+        return await self.send_command(
+            SendMMSMessage(msisdn=msisdn, subject=subject, name=name,
+                           content=content))
+
+    def allocate_imsi_sequence(self):
+        for _ in range(99999):
+            sequence = str(self.next_imsi_sequence)
+            self.next_imsi_sequence = self.next_imsi_sequence % 99999 + 1
+            if sequence not in self.imsi_lookup_replies:
+                return sequence
+        raise SSMIException('No free sequence numbers.')
+
+    async def imsi_lookup(self, msisdn, sequence=None, imsi=None,
+                          timeout=None):
+        if sequence is None:
+            sequence = self.allocate_imsi_sequence()
+        await self.send_command(
+            IMSILookup(sequence=sequence, msisdn=msisdn,
+                       imsi='' if imsi is None else imsi))
+        # The reply cannot arrive before the command is flushed.
+        return await asyncio.wait_for(
+            self.imsi_lookup_replies.wait(sequence),
+            self.reply_timeout if timeout is None else timeout)
+
+    def handle_ACK(self, ack):
+        if ack.ack_type != ACK_LINK_CHECK_RESPONSE:
+            self.events.put_nowait(ack)
+
+    def handle_NACK(self, nack):
+        # A NACK answers the oldest message still waiting for its SEQ, if
+        # there is one.
+        if not self.sequence_replies.nack_received(nack):
+            self.events.put_nowait(nack)
+
+    def handle_IMSI_LOOKUP_REPLY(self, resp):
+        self.imsi_lookup_replies.put(resp.sequence, resp)
+
+    def handle_SEQ(self, seq):
+        self.sequence_replies.seq_received(seq)
+
+    def handle_MO(self, mo):
+        pass
+
+    def handle_DR(self, dr):
+        pass
+
+    def handle_FREE_FORM(self, ff):
+        pass
+
+    def handle_BINARY_MO(self, bmo):
+        pass
+
+    def handle_PREMIUM_MO(self, pmo):
+        pass
+
+    def handle_PREMIUM_BINARY_MO(self, bmo):
+        pass
+
+    def handle_USSD_MESSAGE(self, um):
+        pass
+
+    def handle_EXTENDED_USSD_MESSAGE(self, um):
+        pass
+
+    def handle_LOGOUT(self, msg):
+        self.authenticated = False
+
+
+async def connect(host, port, username=None, password=None,
+                  protocol_class=SSMIAsyncProtocol):
+    """
+    Connect to the SSMI server at ``host`` and ``port`` and log in if
+    given a ``username``. Returns the protocol.
+    """
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_connection(
+        lambda: protocol_class(loop), host, port)
+    if username is not None:
+        cmd = await protocol.authenticate(username, password)
+        if not protocol.authenticated:
+            protocol.transport.close()
+            raise SSMIException('Authentication failed: %r' % (cmd,))
+    return protocol
@@ -1,5 +1,5 @@
 from txssmi.constants import (
-    SSMI_HEADER,
+    SSMI_HEADER, SSMI_ENCODING,
     REQUEST_IDS, REQUEST_NAMES, REQUEST_FIELDS,
     RESPONSE_IDS, RESPONSE_NAMES, RESPONSE_FIELDS)
 
@@ -8,51 +8,107 @@ class SSMIException(Exception):
     pass
 
 
+def encode(text, encoding=SSMI_ENCODING, errors='strict'):
+    """
+    Encode command text for the wire. Bytes are passed through as they
+    are.
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode(encoding, errors)
+
+
+def decode(data, encoding=SSMI_ENCODING):
+    """
+    Decode ``data`` from the wire, bytes or a ``memoryview`` over them,
+    to ``str``. Undecodable bytes are replaced.
+    """
+    if isinstance(data, str):
+        return data
+    return str(data, encoding, 'replace')
+
+
 class SSMICommandException(SSMIException):
     pass
 
 
+class CommandNacked(SSMIException):
+    """
+    The server answered a command with ``nack`` instead of a SEQ.
+    """
+
+    def __init__(self, nack):
+        SSMIException.__init__(self, 'NACK %s' % (nack.nack_type,))
+        self.nack = nack
+
+
 class SSMICommand(object):
 
+    __slots__ = ()
+
     command_name = None
     command_id = None
-    fields = []
+    fields = ()
+    field_set = frozenset()
     defaults = {}
     command_name_map = {}
     command_id_map = {}
     command_field_map = {}
+    command_class_map = {}
 
     def __init__(self, **kwargs):
-        self.values = self.defaults.copy()
-        self.values.update(kwargs)
+        values = self.defaults.copy()
+        values.update(kwargs)
 
-        fields = set(self.values.keys())
-        known_fields = set(self.fields)
+        fields = set(values.keys())
 
-        unsupported_fields = fields - known_fields
+        unsupported_fields = fields - self.field_set
         if unsupported_fields:
             raise SSMICommandException(
                 'Unsupported fields: %s' % (', '.join(unsupported_fields),))
 
-        missing_fields = known_fields - fields
+        missing_fields = self.field_set - fields
         if missing_fields:
             raise SSMICommandException(
                 'Missing fields: %s' % (', '.join(missing_fields),))
 
+        for field in self.fields:
+            setattr(self, field, values[field])
+
+    @property
+    def values(self):
+        return dict(zip(self.fields, self.field_values()))
+
+    def field_values(self):
+        return tuple(getattr(self, field) for field in self.fields)
+
     def __iter__(self):
         parts = [SSMI_HEADER, self.command_id]
-        parts.extend([self.values.get(fn) for fn in self.fields])
+        parts.extend(self.field_values())
         return iter(parts)
 
     def __str__(self):
         return ','.join(self)
 
-    def __eq__(self, other):
-        return str(other) == str(self)
+    def to_bytes(self, encoding=SSMI_ENCODING):
+        return encode(str(self), encoding)
 
-    def __getattr__(self, attr):
-        if attr in self.fields:
-            return self.values[attr]
+    def __eq__(self, other):
+        if not isinstance(other, SSMICommand):
+            return NotImplemented
+        return (self.command_name == other.command_name and
+                self.command_id == other.command_id and
+                self.field_values() == other.field_values())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash((self.command_name, self.command_id,
+                     self.field_values()))
 
     def __repr__(self):
         return '<%s command_id=%s values=%r>' % (
@@ -61,41 +117,84 @@ class SSMICommand(object):
 
     @classmethod
     def create(cls, command_name, defaults={}):
+        fields = tuple(cls.command_field_map[command_name])
         return type('%s%s' % (command_name.title(), cls.__name__), (cls,), {
+            '__slots__': fields,
             'command_name': command_name,
             'command_id': cls.command_id_map[command_name],
-            'fields': cls.command_field_map[command_name],
+            'fields': fields,
+            'field_set': frozenset(fields),
             'defaults': defaults,
         })
 
+    @classmethod
+    def from_values(cls, values):
+        """
+        Build a command from ``values`` given in ``fields`` order without
+        running the field validation done in ``__init__``. Only use this
+        for trusted input, like the output of :meth:`parse`.
+        """
+        command = cls.__new__(cls)
+        for field, value in zip(cls.fields, values):
+            setattr(command, field, value)
+        return command
+
+    @classmethod
+    def register(cls, command_cls):
+        """
+        Register ``command_cls`` as the class :meth:`parse` instantiates
+        for its ``command_id``.
+        """
+        cls.command_class_map[command_cls.command_id] = command_cls
+        return command_cls
+
+    @classmethod
+    def lookup(cls, command_id):
+        command_cls = cls.command_class_map.get(command_id)
+        if command_cls is None:
+            command_name = cls.command_name_map.get(command_id)
+            if command_name is None:
+                raise SSMICommandException(
+                    'Unknown command id: %s.' % (command_id,))
+            command_cls = cls.register(cls.create(command_name))
+        return command_cls
+
     @classmethod
     def parse(cls, command_string):
         header, _, command_string = command_string.partition(',')
         if header != SSMI_HEADER:
             raise SSMICommandException('Unknown header: %s.' % (SSMI_HEADER,))
         command_id, _, command_values = command_string.partition(',')
-        command_name = cls.command_name_map.get(command_id)
-        if command_name is None:
-            raise SSMICommandException(
-                'Unknown command id: %s.' % (command_id,))
-        command_fields = cls.command_field_map[command_name]
+        command_cls = cls.lookup(command_id)
+        command_fields = command_cls.fields
         command_values = command_values.split(',', len(command_fields) - 1)
         if len(command_values) < len(command_fields):
             raise SSMICommandException(
                 'Too few parameters for command: %s (expected %s got %s)' % (
-                    command_name, len(command_fields), len(command_values)))
-        values = dict(zip(command_fields, command_values))
-        command_cls = cls.create(command_name)
-        return command_cls(**values)
+                    command_cls.command_name, len(command_fields),
+                    len(command_values)))
+        return command_cls.from_values(command_values)
+
+    @classmethod
+    def from_bytes(cls, data, encoding=SSMI_ENCODING):
+        """
+        Parse a command from ``data``, bytes or a ``memoryview`` over
+        them, decoding it once for the whole line.
+        """
+        return cls.parse(decode(data, encoding))
 
 
 class SSMIRequest(SSMICommand):
+    __slots__ = ()
     command_id_map = REQUEST_IDS
     command_name_map = REQUEST_NAMES
     command_field_map = REQUEST_FIELDS
+    command_class_map = {}
 
 
 class SSMIResponse(SSMICommand):
+    __slots__ = ()
     command_id_map = RESPONSE_IDS
     command_name_map = RESPONSE_NAMES
     command_field_map = RESPONSE_FIELDS
+    command_class_map = {}
@@ -0,0 +1,148 @@
+# -*- test-case-name: txssmi.tests.test_client -*-
+
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.error import ConnectionClosed
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.python import log
+
+from txssmi.builder import SSMIException
+from txssmi.protocol import SSMIProtocol
+
+
+class SSMIClientMixin(object):
+    """
+    The :class:`txssmi.protocol.SSMIProtocol` send methods for objects that
+    delegate them to a protocol through ``call(method, *args, **kwargs)``.
+    """
+
+    def call(self, method, *args, **kwargs):
+        raise NotImplementedError('Subclasses should implement this.')
+
+    def send_message(self, msisdn, message, validity='0'):
+        return self.call('send_message', msisdn, message, validity=validity)
+
+    def send_messages(self, messages, validity='0'):
+        return self.call('send_messages', messages, validity=validity)
+
+    def send_long_message(self, msisdn, message, validity='0'):
+        return self.call('send_long_message', msisdn, message,
+                         validity=validity)
+
+    def send_binary_message(self, msisdn, hex_message, **kwargs):
+        return self.call('send_binary_message', msisdn, hex_message,
+                         **kwargs)
+
+    def send_ussd_message(self, msisdn, message, session_type):
+        return self.call('send_ussd_message', msisdn, message, session_type)
+
+    def send_extended_ussd_message(self, msisdn, message, session_type,
+                                   genfields):
+        return self.call('send_extended_ussd_message', msisdn, message,
+                         session_type, genfields)
+
+    def send_wap_push_message(self, msisdn, subject, url):
+        return self.call('send_wap_push_message', msisdn, subject, url)
+
+    def send_mms_message(self, msisdn, subject, name, content):
+        return self.call('send_mms_message', msisdn, subject, name, content)
+
+    def imsi_lookup(self, msisdn, sequence=None, imsi=None, timeout=None):
+        return self.call('imsi_lookup', msisdn, sequence=sequence, imsi=imsi,
+                         timeout=timeout)
+
+
+class SSMIClientFactory(SSMIClientMixin, ReconnectingClientFactory):
+    """
+    Reconnecting factory that logs in on every new connection and restarts
+    its link check.
+
+    Reconnects back off exponentially (see
+    :class:`twisted.internet.protocol.ReconnectingClientFactory`). Replies
+    still outstanding when a connection is lost fail with the connection's
+    failure. Calls made through the factory's send methods are made again
+    on the next connection if that happens, up to ``max_replays`` times,
+    unless ``replay`` is False. Replayed messages may be delivered twice if
+    the server had accepted them before the connection dropped.
+    """
+
+    protocol = SSMIProtocol
+    link_check_interval = 60
+    replay = True
+    max_replays = 3
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.client = None
+        self.client_waiters = []
+        self.deliveries = None
+
+    def buildProtocol(self, addr):
+        protocol = ReconnectingClientFactory.buildProtocol(self, addr)
+        # DRs may arrive on a later connection than the message was sent
+        # on, so every connection shares the first one's index.
+        if self.deliveries is None:
+            self.deliveries = protocol.deliveries
+        protocol.deliveries = self.deliveries
+        protocol.wait_for_connect().addCallback(
+            lambda _: self.authenticate(protocol))
+        return protocol
+
+    def authenticate(self, protocol):
+        d = protocol.authenticate(self.username, self.password)
+        d.addCallback(lambda cmd: self.client_authenticated(protocol, cmd))
+        d.addErrback(log.err, 'Unable to authenticate.')
+        return d
+
+    def client_authenticated(self, protocol, cmd):
+        if not protocol.authenticated:
+            log.msg('Authentication failed: %r' % (cmd,))
+            protocol.transport.loseConnection()
+            return
+        self.resetDelay()
+        self.client = protocol
+        protocol.link_check.start(self.link_check_interval, now=False)
+        protocol.wait_for_disconnect().addCallback(
+            lambda _: self.client_lost(protocol))
+        waiters, self.client_waiters = self.client_waiters, []
+        for d in waiters:
+            d.callback(protocol)
+
+    def client_lost(self, protocol):
+        if self.client is protocol:
+            self.client = None
+
+    def stopTrying(self):
+        ReconnectingClientFactory.stopTrying(self)
+        waiters, self.client_waiters = self.client_waiters, []
+        for d in waiters:
+            d.errback(SSMIException('Stopped connecting.'))
+
+    def wait_for_client(self):
+        """
+        Returns a Deferred that fires with the authenticated protocol, as
+        soon as there is one.
+        """
+        if self.client is not None and self.client.connected:
+            return succeed(self.client)
+        if not self.continueTrying:
+            return fail(SSMIException('Stopped connecting.'))
+        d = Deferred()
+        self.client_waiters.append(d)
+        return d
+
+    def call(self, method, *args, **kwargs):
+        replays = self.max_replays if self.replay else 0
+        return self.call_with_replays(replays, method, args, kwargs)
+
+    def call_with_replays(self, replays, method, args, kwargs):
+        d = self.wait_for_client()
+        d.addCallback(lambda client: getattr(client, method)(*args, **kwargs))
+        if replays > 0:
+            def replay(failure):
+                failure.trap(ConnectionClosed)
+                log.msg('Connection lost during %s, replaying.' % (method,))
+                return self.call_with_replays(
+                    replays - 1, method, args, kwargs)
+            d.addErrback(replay)
+        return d
@@ -34,3 +34,15 @@ IMSILookupReply = SSMIResponse.create('IMSI_LOOKUP_REPLY')
 USSDMessage = SSMIResponse.create('USSD_MESSAGE')
 ExtendedUSSDMessage = SSMIResponse.create('EXTENDED_USSD_MESSAGE')
 ServerLogout = SSMIResponse.create('LOGOUT')
+
+for command_cls in [Login, SendSMS, SendBinarySMS, SendUSSDMessage,
+                    SendWAPPushMessage, SendMMSMessage,
+                    SendExtendedUSSDMessage, IMSILookup, LinkCheck,
+                    ClientLogout]:
+    SSMIRequest.register(command_cls)
+
+for command_cls in [Ack, Nack, Seq, MoMessage, DrMessage, FFMessage,
+                    BMoMessage, PremiumMoMessage, PremiumBMoMessage,
+                    IMSILookupReply, USSDMessage, ExtendedUSSDMessage,
+                    ServerLogout]:
+    SSMIResponse.register(command_cls)
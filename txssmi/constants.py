@@ -1,5 +1,9 @@
 SSMI_HEADER = 'SSMI'
 
+# Every byte maps to exactly one character and back, so text round trips
+# to the wire unchanged whatever the message bodies contain.
+SSMI_ENCODING = 'iso-8859-1'
+
 SSMI_REQUESTS = {
     '1': ('LOGIN', ['username', 'password']),
     '2': ('SEND_SMS', ['validity', 'msisdn', 'message']),
@@ -48,6 +52,7 @@ RESPONSE_FIELDS = dict(value for key, value in SSMI_RESPONSES.items())
 
 CODING_7BIT = '0'
 CODING_8BIT = '246'
+CODING_UCS2 = '8'
 
 PROTOCOL_STANDARD = '0'
 PROTOCOL_ENHANCED = '15'
@@ -0,0 +1,537 @@
+# -*- test-case-name: txssmi.tests.test_correlation -*-
+
+from collections import OrderedDict, deque
+from itertools import count
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed, TimeoutError
+from twisted.python import log
+
+from txssmi.builder import SSMIException, CommandNacked
+
+
+class CorrelationEvicted(SSMIException):
+    pass
+
+
+class CorrelationStore(object):
+    """
+    Matches replies to the Deferreds waiting for them by key.
+
+    Waiters are served in FIFO order per key. Replies that arrive before
+    anyone waits for them are kept for ``ttl`` seconds, waiters time out
+    with a ``TimeoutError`` after ``ttl`` seconds unless given their own
+    timeout. At most ``max_size`` waiters and replies are kept, the least
+    recently used replies are dropped first and then the least recently
+    used waiters, which fail with :class:`CorrelationEvicted`.
+
+    ``hits``, ``expiries`` and ``evictions`` count matched replies, timed
+    out waiters or replies and entries dropped to stay within
+    ``max_size``.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, clock=reactor):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.waiters = OrderedDict()
+        self.replies = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.expiries = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return self.size
+
+    def touch(self, entries, key):
+        queue = entries.pop(key)
+        entries[key] = queue
+        return queue
+
+    def wait(self, key, timeout=None):
+        """
+        Returns a Deferred that fires with the next reply for ``key``.
+        """
+        self.expire_replies()
+        if key in self.replies:
+            queue = self.replies[key]
+            value, _ = queue.popleft()
+            if not queue:
+                del self.replies[key]
+            self.size -= 1
+            self.hits += 1
+            return succeed(value)
+
+        d = Deferred(lambda d: self.remove_waiter(key, d))
+        delayed_call = self.clock.callLater(
+            self.ttl if timeout is None else timeout,
+            self.expire_waiter, key, d)
+        if key in self.waiters:
+            queue = self.touch(self.waiters, key)
+        else:
+            queue = self.waiters[key] = deque()
+        queue.append((d, delayed_call))
+        self.size += 1
+        self.enforce_max_size()
+        return d
+
+    def put(self, key, value):
+        """
+        Fire the oldest waiter for ``key`` with ``value``, or keep
+        ``value`` for the next waiter if nobody is waiting.
+        """
+        if key in self.waiters:
+            queue = self.waiters[key]
+            d, delayed_call = queue.popleft()
+            if not queue:
+                del self.waiters[key]
+            self.size -= 1
+            self.hits += 1
+            delayed_call.cancel()
+            d.callback(value)
+            return
+
+        self.expire_replies()
+        if key in self.replies:
+            queue = self.touch(self.replies, key)
+        else:
+            queue = self.replies[key] = deque()
+        queue.append((value, self.clock.seconds() + self.ttl))
+        self.size += 1
+        self.enforce_max_size()
+
+    def remove_waiter(self, key, d):
+        queue = self.waiters.get(key, ())
+        for entry in queue:
+            if entry[0] is d:
+                queue.remove(entry)
+                if entry[1].active():
+                    entry[1].cancel()
+                self.size -= 1
+                break
+        if key in self.waiters and not queue:
+            del self.waiters[key]
+
+    def expire_waiter(self, key, d):
+        self.remove_waiter(key, d)
+        self.expiries += 1
+        d.errback(TimeoutError('No reply for %r within the timeout.' % (
+            key,)))
+
+    def expire_replies(self):
+        """
+        Drop expired replies from the least recently used end.
+        """
+        now = self.clock.seconds()
+        while self.replies:
+            key, queue = next(iter(self.replies.items()))
+            while queue and queue[0][1] <= now:
+                queue.popleft()
+                self.size -= 1
+                self.expiries += 1
+            if queue:
+                break
+            del self.replies[key]
+
+    def enforce_max_size(self):
+        while self.size > self.max_size and self.replies:
+            key, queue = next(iter(self.replies.items()))
+            queue.popleft()
+            if not queue:
+                del self.replies[key]
+            self.size -= 1
+            self.evictions += 1
+        while self.size > self.max_size and self.waiters:
+            key, queue = next(iter(self.waiters.items()))
+            d, delayed_call = queue.popleft()
+            if not queue:
+                del self.waiters[key]
+            self.size -= 1
+            self.evictions += 1
+            delayed_call.cancel()
+            d.errback(CorrelationEvicted(
+                'Evicted waiter for %r, too many pending replies.' % (key,)))
+
+    def fail_all(self, reason):
+        """
+        Errback every waiter with ``reason`` and drop any kept replies.
+        """
+        waiters, self.waiters = self.waiters, OrderedDict()
+        self.replies.clear()
+        self.size = 0
+        for queue in waiters.values():
+            for d, delayed_call in queue:
+                delayed_call.cancel()
+                d.errback(reason)
+
+
+class PendingSeq(object):
+
+    __slots__ = ('msisdn', 'd', 'delayed_call', 'claim_key', 'key')
+
+    def __init__(self, msisdn, d=None, claim_key=None):
+        self.msisdn = msisdn
+        self.d = d
+        self.delayed_call = None
+        self.claim_key = claim_key
+        self.key = None
+
+
+class SeqTracker(object):
+    """
+    Matches SEQs and NACKs to the sequenced commands written on one
+    connection. A SEQ only names an msisdn and a NACK names nothing, so
+    both go by the order the commands were written in: a SEQ answers the
+    oldest unanswered command to its msisdn, a NACK the oldest unanswered
+    command of all.
+
+    :meth:`claim` a command before it is queued to get a Deferred for its
+    SEQ and report every sequenced command with :meth:`written` as it
+    goes out. Answers to commands nobody claimed are dropped. Claims time
+    out ``timeout`` seconds after their command was written, the command
+    keeps its place in line so its SEQ cannot be taken by the next one.
+    At most ``max_size`` written commands are kept, the oldest are dropped
+    first and their claims fail with :class:`CorrelationEvicted`.
+    """
+
+    def __init__(self, max_size=10000, timeout=60, clock=reactor):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.clock = clock
+        self.claims = {}
+        self.written_order = OrderedDict()
+        self.by_msisdn = {}
+        self.keys = count()
+        self.hits = 0
+        self.nacks = 0
+        self.expiries = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.claims) + len(self.written_order)
+
+    def claim(self, command):
+        """
+        Returns a Deferred that fires with the SEQ for ``command``, which
+        must not have been written yet.
+        """
+        entry = PendingSeq(command.msisdn, claim_key=id(command))
+        entry.d = Deferred(lambda d: self.cancel(entry))
+        self.claims[entry.claim_key] = entry
+        return entry.d
+
+    def cancel(self, entry):
+        if entry.key is None:
+            self.claims.pop(entry.claim_key, None)
+        else:
+            self.stop_waiting(entry)
+
+    def stop_waiting(self, entry):
+        """
+        Drop the claim on ``entry`` but keep its place in line.
+        """
+        d, entry.d = entry.d, None
+        if entry.delayed_call is not None:
+            if entry.delayed_call.active():
+                entry.delayed_call.cancel()
+            entry.delayed_call = None
+        return d
+
+    def written(self, command):
+        """
+        Note that ``command`` was written and a SEQ or NACK will follow,
+        starting the timeout of its claim.
+        """
+        entry = self.claims.pop(id(command), None)
+        if entry is None:
+            entry = PendingSeq(command.msisdn)
+        entry.key = next(self.keys)
+        self.written_order[entry.key] = entry
+        self.by_msisdn.setdefault(entry.msisdn, deque()).append(entry)
+        if entry.d is not None:
+            entry.delayed_call = self.clock.callLater(
+                self.timeout, self.expire, entry)
+        self.enforce_max_size()
+
+    def expire(self, entry):
+        entry.delayed_call = None
+        d = self.stop_waiting(entry)
+        self.expiries += 1
+        d.errback(TimeoutError('No SEQ for %r within the timeout.' % (
+            entry.msisdn,)))
+
+    def remove(self, entry):
+        del self.written_order[entry.key]
+        # Always the oldest command written to its msisdn.
+        queue = self.by_msisdn[entry.msisdn]
+        queue.popleft()
+        if not queue:
+            del self.by_msisdn[entry.msisdn]
+        return self.stop_waiting(entry)
+
+    def seq_received(self, seq):
+        """
+        Fire the claim, if any, of the oldest command written to the
+        msisdn of ``seq``.
+        """
+        queue = self.by_msisdn.get(seq.msisdn)
+        if not queue:
+            # Not for anything written on this connection.
+            return
+        d = self.remove(queue[0])
+        if d is not None:
+            self.hits += 1
+            d.callback(seq)
+
+    def nack_received(self, nack):
+        """
+        Fail the claim, if any, of the oldest command written. Returns
+        False if no command is waiting for an answer.
+        """
+        if not self.written_order:
+            return False
+        d = self.remove(next(iter(self.written_order.values())))
+        self.nacks += 1
+        if d is not None:
+            d.errback(CommandNacked(nack))
+        return True
+
+    def enforce_max_size(self):
+        while len(self.written_order) > self.max_size:
+            entry = next(iter(self.written_order.values()))
+            d = self.remove(entry)
+            self.evictions += 1
+            if d is not None:
+                d.errback(CorrelationEvicted(
+                    'Evicted SEQ waiter for %r, too many pending '
+                    'replies.' % (entry.msisdn,)))
+
+    def fail_all(self, reason):
+        """
+        Errback every claim with ``reason`` and forget every command.
+        """
+        entries = list(self.claims.values())
+        entries.extend(self.written_order.values())
+        self.claims.clear()
+        self.written_order.clear()
+        self.by_msisdn.clear()
+        for entry in entries:
+            d = self.stop_waiting(entry)
+            if d is not None:
+                d.errback(reason)
+
+
+class SequenceAllocator(object):
+    """
+    Hands out sequence numbers between ``first`` and ``last`` from a
+    wrapping counter, skipping numbers that have not been released yet.
+    """
+
+    def __init__(self, first=1, last=99999):
+        self.first = first
+        self.last = last
+        self.next = first
+        self.in_use = set()
+
+    def __len__(self):
+        return len(self.in_use)
+
+    @property
+    def free(self):
+        return self.last - self.first + 1 - len(self.in_use)
+
+    def allocate(self):
+        if not self.free:
+            raise SSMIException('No free sequence numbers.')
+        while True:
+            sequence = str(self.next)
+            self.next = self.first if self.next >= self.last else self.next + 1
+            if sequence not in self.in_use:
+                self.in_use.add(sequence)
+                return sequence
+
+    def release(self, sequence):
+        self.in_use.discard(sequence)
+
+
+class Delivery(object):
+    """
+    The delivery state of one message, identified by the ``msisdn`` and
+    ``sequence`` from its SEQ. Times are clock seconds, None until known.
+    """
+
+    __slots__ = ('msisdn', 'sequence', 'reference', 'created_at', 'sent_at',
+                 'seq_at', 'dr_at', 'ret_code', 'waiters')
+
+    def __init__(self, msisdn, sequence, created_at=None):
+        self.msisdn = msisdn
+        self.sequence = sequence
+        self.created_at = created_at
+        self.reference = None
+        self.sent_at = None
+        self.seq_at = None
+        self.dr_at = None
+        self.ret_code = None
+        self.waiters = None
+
+    def __repr__(self):
+        return '<Delivery msisdn=%s sequence=%s ret_code=%s>' % (
+            self.msisdn, self.sequence, self.ret_code)
+
+    @property
+    def key(self):
+        return (self.msisdn, self.sequence)
+
+    @property
+    def reported(self):
+        """
+        Whether a DR has been received.
+        """
+        return self.ret_code is not None
+
+
+class DeliveryIndex(object):
+    """
+    Indexes messages by ``(msisdn, sequence)`` from their SEQ until their
+    DR, and for ``ttl`` seconds after their SEQ in total.
+
+    At most ``max_size`` messages are kept, the oldest are dropped first.
+    Deferreds waiting for the DR of a message that is dropped or expires
+    fail with :class:`CorrelationEvicted` or ``TimeoutError``. Expiry is
+    done as new messages are added, there are no timers.
+
+    ``subscribe`` registers a callable that is called with every
+    :class:`Delivery` as its DR arrives.
+    """
+
+    def __init__(self, max_size=100000, ttl=86400, clock=reactor):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.subscribers = []
+        self.expiries = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    def get(self, msisdn, sequence):
+        return self.entries.get((msisdn, sequence))
+
+    def add(self, msisdn, sequence):
+        delivery = Delivery(msisdn, sequence, self.clock.seconds())
+        self.entries[delivery.key] = delivery
+        return delivery
+
+    def record_seq(self, msisdn, sequence):
+        """
+        Start tracking the message with ``msisdn`` and ``sequence``.
+        Returns its :class:`Delivery`.
+        """
+        now = self.clock.seconds()
+        delivery = self.entries.get((msisdn, sequence))
+        if delivery is None or delivery.seq_at is not None:
+            # New, or a sequence number the server has wrapped around to.
+            self.discard(delivery, CorrelationEvicted(
+                'Sequence %s for %s reused.' % (sequence, msisdn)))
+            delivery = self.add(msisdn, sequence)
+        delivery.seq_at = now
+        self.expire(now)
+        self.enforce_max_size()
+        return delivery
+
+    def link(self, msisdn, sequence, sent_at=None, reference=None):
+        """
+        Record when the message was sent and the caller's ``reference``
+        for it. Returns its :class:`Delivery`, or None if it is unknown.
+        """
+        delivery = self.entries.get((msisdn, sequence))
+        if delivery is not None:
+            delivery.sent_at = sent_at
+            delivery.reference = reference
+        return delivery
+
+    def record_dr(self, msisdn, sequence, ret_code):
+        """
+        Record the DR for a message, fire anything waiting for it and
+        notify the subscribers. A DR that arrives before its SEQ is kept
+        until the SEQ arrives.
+        """
+        delivery = self.entries.get((msisdn, sequence))
+        if delivery is None:
+            delivery = self.add(msisdn, sequence)
+            self.enforce_max_size()
+        delivery.ret_code = ret_code
+        delivery.dr_at = self.clock.seconds()
+        waiters, delivery.waiters = delivery.waiters, None
+        for d in waiters or ():
+            d.callback(delivery)
+        for subscriber in self.subscribers:
+            try:
+                subscriber(delivery)
+            except Exception:
+                log.err(None, 'Error in delivery subscriber %r.' % (
+                    subscriber,))
+        return delivery
+
+    def wait(self, msisdn, sequence):
+        """
+        Returns a Deferred that fires with the :class:`Delivery` once its
+        DR has been received.
+        """
+        delivery = self.entries.get((msisdn, sequence))
+        if delivery is None:
+            # Waiting ahead of the SEQ, which fills in this placeholder.
+            delivery = self.add(msisdn, sequence)
+            self.expire(self.clock.seconds())
+            self.enforce_max_size()
+        if delivery.reported:
+            return succeed(delivery)
+        d = Deferred(lambda d: delivery.waiters.remove(d))
+        if delivery.waiters is None:
+            delivery.waiters = []
+        delivery.waiters.append(d)
+        return d
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+
+    def discard(self, delivery, reason):
+        if delivery is None:
+            return
+        self.entries.pop(delivery.key, None)
+        waiters, delivery.waiters = delivery.waiters, None
+        for d in waiters or ():
+            d.errback(reason)
+
+    def expire(self, now):
+        """
+        Drop messages whose SEQ is older than ``ttl`` from the oldest end.
+        """
+        while self.entries:
+            delivery = next(iter(self.entries.values()))
+            started = delivery.seq_at
+            if started is None:
+                started = delivery.created_at
+            if started + self.ttl > now:
+                break
+            self.expiries += 1
+            self.discard(delivery, TimeoutError(
+                'No DR for %r within the timeout.' % (delivery.key,)))
+
+    def enforce_max_size(self):
+        while len(self.entries) > self.max_size:
+            delivery = next(iter(self.entries.values()))
+            self.evictions += 1
+            self.discard(delivery, CorrelationEvicted(
+                'Evicted %r, too many tracked deliveries.' % (
+                    delivery.key,)))
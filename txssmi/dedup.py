@@ -0,0 +1,137 @@
+# -*- test-case-name: txssmi.tests.test_dedup -*-
+
+import hashlib
+import math
+import struct
+
+from twisted.internet import reactor
+
+from txssmi.builder import encode
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized to hold ``capacity`` keys with a false positive
+    rate of ``error_rate``. Keys are checked and added by their bit
+    positions, see :meth:`positions`, so they are hashed only once.
+    """
+
+    def __init__(self, capacity, error_rate):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1.')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, key):
+        """
+        Returns the bit positions of ``key``, a bytes string, derived from
+        the first 16 bytes of its SHA-1 hash by double hashing.
+        """
+        h1, h2 = struct.unpack('<QQ', hashlib.sha1(key).digest()[:16])
+        h2 |= 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def contains(self, positions):
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        bits = self.bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+
+def mo_key(command):
+    """
+    Returns the key an MO is recognised by: its msisdn, sequence number
+    and message, encoded as they are on the wire.
+    """
+    return b'\x00'.join(
+        encode(field, errors='replace')
+        for field in (command.msisdn, command.sequence, command.message))
+
+
+class DuplicateFilter(object):
+    """
+    Drops ``MO`` and ``PREMIUM_MO`` commands the gateway delivers more than
+    once, as it does after a reconnect.
+
+    Recent MOs are remembered in two Bloom filters of fixed size. New
+    ones go into the current filter, which replaces the previous one once
+    it is ``window`` seconds old or holds ``capacity`` MOs. An MO is
+    remembered for between one and two windows unless more than
+    ``capacity`` arrive in a window, in which case the window is cut
+    short. Each filter has a false positive rate of ``error_rate`` when
+    full and a new MO is checked against both, so at worst about
+    ``2 * error_rate`` of new MOs are dropped wrongly.
+    """
+
+    command_names = frozenset(['MO', 'PREMIUM_MO'])
+
+    def __init__(self, window=3600, capacity=100000, error_rate=1e-6,
+                 clock=reactor):
+        self.window = window
+        self.clock = clock
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.started_at = clock.seconds()
+        self.checked = 0
+        self.duplicates = 0
+        self.rotations = 0
+
+    def rotate(self, now):
+        self.previous, self.current = self.current, self.previous
+        self.current.clear()
+        if now - self.started_at >= 2 * self.window:
+            # Nothing arrived for a whole window, forget everything.
+            self.previous.clear()
+        self.started_at = now
+        self.rotations += 1
+
+    def is_duplicate(self, command):
+        """
+        Returns True if ``command`` is an MO seen before, otherwise
+        remembers it and returns False.
+        """
+        if command.command_name not in self.command_names:
+            return False
+        now = self.clock.seconds()
+        if (now - self.started_at >= self.window or
+                len(self.current) >= self.current.capacity):
+            self.rotate(now)
+        self.checked += 1
+        positions = self.current.positions(mo_key(command))
+        if (self.current.contains(positions) or
+                self.previous.contains(positions)):
+            self.duplicates += 1
+            return True
+        self.current.add(positions)
+        return False
+
+    def snapshot(self):
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'rotations': self.rotations,
+            'current': len(self.current),
+            'previous': len(self.previous),
+            'bytes': len(self.current.bits) + len(self.previous.bits),
+        }
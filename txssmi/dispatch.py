@@ -0,0 +1,49 @@
+# -*- test-case-name: txssmi.tests.test_dispatch -*-
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.python import log
+
+
+class BatchConsumer(object):
+    """
+    Collects the commands it is called with and hands them to ``handler``
+    as a list, ``interval`` seconds after the first command of a batch
+    arrived or as soon as ``max_size`` commands are waiting.
+    """
+
+    def __init__(self, handler, interval=0.1, max_size=500, clock=reactor):
+        self.handler = handler
+        self.interval = interval
+        self.max_size = max_size
+        self.clock = clock
+        self.batch = []
+        self.delayed_call = None
+
+    def __len__(self):
+        return len(self.batch)
+
+    def __call__(self, command):
+        self.batch.append(command)
+        if self.max_size is not None and len(self.batch) >= self.max_size:
+            self.flush()
+        elif self.delayed_call is None:
+            self.delayed_call = self.clock.callLater(
+                self.interval, self.flush)
+
+    def flush(self):
+        """
+        Hand the waiting commands to the handler now. Returns a Deferred
+        that fires once the handler is done with them.
+        """
+        if self.delayed_call is not None:
+            if self.delayed_call.active():
+                self.delayed_call.cancel()
+            self.delayed_call = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return succeed(None)
+        d = maybeDeferred(self.handler, batch)
+        d.addErrback(log.err, 'Error handling a batch of %s commands.' % (
+            len(batch),))
+        return d
@@ -0,0 +1,158 @@
+# -*- test-case-name: txssmi.tests.test_keepalive -*-
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from txssmi.metrics import Histogram
+
+
+class LinkMonitor(object):
+    """
+    Sends link checks over ``protocol`` and measures how long the server
+    takes to acknowledge them.
+
+    A check is only sent once nothing has been received for ``interval``
+    seconds, traffic from the server already shows the link is up. A
+    check not acknowledged within ``timeout`` seconds, with nothing else
+    received meanwhile, is sent again straight away, after
+    ``max_missed`` of those in a row the link is declared dead and
+    ``protocol.link_dead()`` is called.
+
+    Round trip times are kept as a smoothed average and variation, as
+    TCP does, and in a histogram. Started and stopped like the
+    ``LoopingCall`` it replaces.
+    """
+
+    def __init__(self, protocol, timeout=10, max_missed=3, clock=reactor,
+                 buckets=None):
+        self.protocol = protocol
+        self.timeout = timeout
+        self.max_missed = max_missed
+        self.clock = clock
+        self.interval = None
+        self.running = False
+        self.alive = True
+        self.call = None
+        self.timeout_call = None
+        self.sent_at = None
+        self.last_received = None
+        self.missed = 0
+        self.rtt = Histogram(buckets)
+        self.srtt = None
+        self.rttvar = None
+        self.last_rtt = None
+        self.min_rtt = None
+        self.checks = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.skipped = 0
+
+    def start(self, interval, now=True):
+        self.interval = interval
+        self.running = True
+        self.alive = True
+        self.missed = 0
+        if now:
+            self.check()
+        else:
+            self.schedule(interval)
+
+    def stop(self):
+        self.running = False
+        for name in ('call', 'timeout_call'):
+            delayed_call = getattr(self, name)
+            if delayed_call is not None and delayed_call.active():
+                delayed_call.cancel()
+            setattr(self, name, None)
+        self.sent_at = None
+
+    def schedule(self, delay):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = self.clock.callLater(delay, self.check)
+
+    def data_received(self):
+        self.last_received = self.clock.seconds()
+
+    def check(self):
+        self.call = None
+        if not self.running or self.sent_at is not None:
+            return
+        if self.last_received is not None:
+            idle = self.clock.seconds() - self.last_received
+            if idle < self.interval:
+                self.skipped += 1
+                self.schedule(self.interval - idle)
+                return
+        self.send()
+
+    def send(self):
+        if self.protocol.send_link_request() is None:
+            # Not logged in yet, try again later.
+            self.schedule(self.interval)
+            return
+        self.checks += 1
+        self.sent_at = self.clock.seconds()
+        self.timeout_call = self.clock.callLater(
+            self.timeout, self.response_missed)
+
+    def response_received(self):
+        if self.sent_at is None:
+            return
+        if self.timeout_call is not None and self.timeout_call.active():
+            self.timeout_call.cancel()
+        self.timeout_call = None
+        self.observe(self.clock.seconds() - self.sent_at)
+        self.sent_at = None
+        self.missed = 0
+        self.responses += 1
+        if self.running:
+            self.schedule(self.interval)
+
+    def response_missed(self):
+        self.timeout_call = None
+        sent_at, self.sent_at = self.sent_at, None
+        if not self.running:
+            return
+        if self.last_received is not None and self.last_received >= sent_at:
+            # The link is up, the server is slow to answer link checks.
+            self.schedule(self.interval)
+            return
+        self.timeouts += 1
+        self.missed += 1
+        if self.missed < self.max_missed:
+            self.send()
+            return
+        log.msg('No reply to %s link checks, link is dead.' % (self.missed,))
+        self.alive = False
+        self.stop()
+        self.protocol.link_dead()
+
+    def observe(self, rtt):
+        """
+        Update the round trip time estimates as in RFC 6298.
+        """
+        self.rtt.observe(rtt)
+        self.last_rtt = rtt
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def snapshot(self):
+        return {
+            'alive': self.alive,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'last_rtt': self.last_rtt,
+            'min_rtt': self.min_rtt,
+            'rtt': self.rtt.snapshot(),
+            'checks': self.checks,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'skipped': self.skipped,
+        }
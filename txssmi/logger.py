@@ -0,0 +1,46 @@
+# -*- test-case-name: txssmi.tests.test_logger -*-
+
+import logging
+import random
+
+from twisted.python import log
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+
+
+class CommandLogger(object):
+    """
+    Level filtered and sampled logging through :mod:`twisted.python.log`.
+
+    Messages below ``level`` are dropped before anything is formatted,
+    messages that pass are handed to the log observers with a ``format``
+    and its arguments so they are only turned into text by observers that
+    want text. Of the per-command messages logged through :meth:`command`
+    only a ``sample_rate`` fraction is kept.
+    """
+
+    def __init__(self, level=INFO, sample_rate=1.0, seed=None):
+        self.level = level
+        self.sample_rate = sample_rate
+        self.random = random.Random(seed)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def msg(self, level, format, **kwargs):
+        if level >= self.level:
+            log.msg(format=format, logLevel=level, **kwargs)
+
+    def command(self, level, description, command):
+        """
+        Log ``command`` with ``description``, subject to sampling.
+        """
+        if level < self.level:
+            return
+        if (self.sample_rate < 1.0 and
+                self.random.random() >= self.sample_rate):
+            return
+        log.msg(format='%(description)s: %(command)r',
+                description=description, command=command, logLevel=level)
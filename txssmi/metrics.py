@@ -0,0 +1,215 @@
+# -*- test-case-name: txssmi.tests.test_metrics -*-
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+
+from twisted.internet import reactor
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram. Observations are counted in the first bucket
+    whose upper bound is greater than or equal to the value, values past
+    the last bound go into an overflow bucket.
+    """
+
+    default_buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+        10, 30, 60)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket holding the ``percent`` percentile, or the
+        largest value seen if that falls in the overflow bucket.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': list(zip(self.buckets, self.counts)),
+            'overflow': self.counts[-1],
+        }
+
+
+class NullMetrics(object):
+    """
+    The metrics interface :class:`txssmi.protocol.SSMIProtocol` reports
+    to. Does nothing, the protocol skips its bookkeeping altogether when
+    ``enabled`` is False.
+
+    Timers are keyed by a ``name`` and a ``key``, such as the msisdn a
+    SEQ is expected for. :meth:`stop_timer` returns the time the matching
+    timer was started, or None.
+    """
+
+    enabled = False
+
+    def command_sent(self, command_name):
+        pass
+
+    def command_received(self, command_name):
+        pass
+
+    def bytes_sent(self, count):
+        pass
+
+    def bytes_received(self, count):
+        pass
+
+    def queue_depth(self, lane, depth):
+        pass
+
+    def start_timer(self, name, key, start=None):
+        pass
+
+    def stop_timer(self, name, key):
+        return None
+
+
+class InMemoryMetrics(NullMetrics):
+    """
+    Keeps counters, queue depths and timing histograms in memory, see
+    :meth:`snapshot`. At most ``max_pending`` timers are kept running,
+    the oldest are dropped first.
+    """
+
+    enabled = True
+
+    def __init__(self, clock=reactor, max_pending=10000, buckets=None):
+        self.clock = clock
+        self.max_pending = max_pending
+        self.buckets = buckets
+        self.sent = defaultdict(int)
+        self.received = defaultdict(int)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.queue_depths = {}
+        self.timings = {}
+        self.pending = OrderedDict()
+        self.pending_count = 0
+
+    def command_sent(self, command_name):
+        self.sent[command_name] += 1
+
+    def command_received(self, command_name):
+        self.received[command_name] += 1
+
+    def bytes_sent(self, count):
+        self.bytes_out += count
+
+    def bytes_received(self, count):
+        self.bytes_in += count
+
+    def queue_depth(self, lane, depth):
+        self.queue_depths[lane] = depth
+
+    def start_timer(self, name, key, start=None):
+        timers = self.pending.get((name, key))
+        if timers is None:
+            timers = self.pending[(name, key)] = deque()
+        timers.append(self.clock.seconds() if start is None else start)
+        self.pending_count += 1
+        while self.pending_count > self.max_pending:
+            oldest_key, oldest = next(iter(self.pending.items()))
+            oldest.popleft()
+            if not oldest:
+                del self.pending[oldest_key]
+            self.pending_count -= 1
+
+    def stop_timer(self, name, key):
+        timers = self.pending.get((name, key))
+        if timers is None:
+            return None
+        start = timers.popleft()
+        if not timers:
+            del self.pending[(name, key)]
+        self.pending_count -= 1
+        histogram = self.timings.get(name)
+        if histogram is None:
+            histogram = self.timings[name] = Histogram(self.buckets)
+        histogram.observe(self.clock.seconds() - start)
+        return start
+
+    def snapshot(self):
+        return {
+            'sent': dict(self.sent),
+            'received': dict(self.received),
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'queue_depths': dict(self.queue_depths),
+            'timings': dict((name, histogram.snapshot())
+                            for name, histogram in self.timings.items()),
+        }
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up :meth:`InMemoryMetrics.snapshot` results, such as those of
+    several processes. Queue depths are summed per lane and histograms
+    bucket by bucket.
+    """
+    merged = {
+        'sent': defaultdict(int),
+        'received': defaultdict(int),
+        'bytes_out': 0,
+        'bytes_in': 0,
+        'queue_depths': defaultdict(int),
+        'timings': {},
+    }
+    for snapshot in snapshots:
+        for key in ('sent', 'received', 'queue_depths'):
+            for name, value in snapshot[key].items():
+                merged[key][name] += value
+        merged['bytes_out'] += snapshot['bytes_out']
+        merged['bytes_in'] += snapshot['bytes_in']
+        for name, histogram in snapshot['timings'].items():
+            merged['timings'].setdefault(name, []).append(histogram)
+    for key in ('sent', 'received', 'queue_depths'):
+        merged[key] = dict(merged[key])
+    for name, histograms in merged['timings'].items():
+        counts = OrderedDict()
+        for histogram in histograms:
+            for bound, count in histogram['buckets']:
+                counts[bound] = counts.get(bound, 0) + count
+        maxima = [histogram['max'] for histogram in histograms
+                  if histogram['max'] is not None]
+        merged['timings'][name] = {
+            'count': sum(histogram['count'] for histogram in histograms),
+            'total': sum(histogram['total'] for histogram in histograms),
+            'max': max(maxima) if maxima else None,
+            'buckets': sorted(counts.items()),
+            'overflow': sum(
+                histogram['overflow'] for histogram in histograms),
+        }
+    return merged
@@ -0,0 +1,225 @@
+# -*- test-case-name: txssmi.tests.test_pool -*-
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, gatherResults
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from txssmi.builder import SSMIException
+from txssmi.client import SSMIClientMixin
+from txssmi.constants import USSD_END, USSD_NEW, USSD_TIMEOUT
+from txssmi.correlation import DeliveryIndex
+from txssmi.protocol import SSMIProtocol
+
+USSD_COMMANDS = ('USSD_MESSAGE', 'EXTENDED_USSD_MESSAGE')
+
+
+class SSMIPool(SSMIClientMixin):
+    """
+    Keeps ``size`` authenticated SSMI connections to ``endpoint`` open and
+    spreads outbound messages over them.
+
+    Members are picked round robin, by the shortest outbound queue or by
+    the lowest smoothed link check round trip time, depending on
+    ``strategy``. USSD sessions are pinned to one member per
+    msisdn, the one the network started them on, until the session is
+    ended or times out. Members that disconnect, fail to
+    authenticate or are logged out by the server are dropped and replaced
+    after ``reconnect_delay`` seconds.
+    """
+
+    ROUND_ROBIN = 'round_robin'
+    LEAST_LOADED = 'least_loaded'
+    FASTEST = 'fastest'
+
+    protocol_class = SSMIProtocol
+    clock = reactor
+    reconnect_delay = 5
+    health_check_interval = 30
+    link_check_interval = 60
+
+    def __init__(self, endpoint, username, password, size=2,
+                 strategy=LEAST_LOADED):
+        if strategy not in (self.ROUND_ROBIN, self.LEAST_LOADED,
+                            self.FASTEST):
+            raise SSMIException('Unknown strategy: %s' % (strategy,))
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.size = size
+        self.strategy = strategy
+        self.members = []
+        self.connecting = 0
+        self.replacements = set()
+        self.pins = {}
+        self.next_member = 0
+        self.running = False
+        self.health_check = LoopingCall(self.check_health)
+        self.health_check.clock = self.clock
+        # Shared by every member, a DR may arrive on any of them.
+        self.deliveries = DeliveryIndex(
+            self.protocol_class.max_deliveries,
+            self.protocol_class.delivery_ttl, clock=self.clock)
+
+    def start(self):
+        """
+        Open the initial connections. Returns a Deferred that fires with
+        the pool once every connection has been attempted, failed
+        connections are retried in the background.
+        """
+        self.running = True
+        self.health_check.start(self.health_check_interval, now=False)
+        d = gatherResults([self.add_member() for _ in range(self.size)])
+        d.addCallback(lambda _: self)
+        return d
+
+    def stop(self):
+        self.running = False
+        if self.health_check.running:
+            self.health_check.stop()
+        for delayed_call in list(self.replacements):
+            delayed_call.cancel()
+        self.replacements.clear()
+        for member in list(self.members):
+            self.drop_member(member)
+
+    def add_member(self):
+        self.connecting += 1
+        protocol = self.protocol_class()
+        protocol.deliveries = self.deliveries
+        d = connectProtocol(self.endpoint, protocol)
+        d.addCallback(self.authenticate_member)
+        d.addCallbacks(self.member_ready, self.member_failed)
+        return d
+
+    def authenticate_member(self, protocol):
+        d = protocol.authenticate(self.username, self.password)
+
+        def check(cmd):
+            if not protocol.authenticated:
+                protocol.transport.loseConnection()
+                raise SSMIException('Authentication failed: %r' % (cmd,))
+            return protocol
+
+        return d.addCallback(check)
+
+    def member_ready(self, protocol):
+        self.connecting -= 1
+        if not self.running:
+            protocol.transport.loseConnection()
+            return
+        self.members.append(protocol)
+        protocol.link_check.start(self.link_check_interval, now=False)
+        for command_name in USSD_COMMANDS:
+            protocol.register_handler(
+                command_name,
+                lambda command: self.ussd_received(protocol, command))
+        protocol.wait_for_disconnect().addCallback(
+            lambda _: self.remove_member(protocol))
+        return protocol
+
+    def member_failed(self, failure):
+        self.connecting -= 1
+        log.err(failure, 'Unable to add SSMI connection to pool.')
+        self.schedule_replacement()
+
+    def remove_member(self, protocol):
+        if protocol not in self.members:
+            return
+        self.members.remove(protocol)
+        if protocol.link_check.running:
+            protocol.link_check.stop()
+        for msisdn, member in list(self.pins.items()):
+            if member is protocol:
+                del self.pins[msisdn]
+        self.schedule_replacement()
+
+    def drop_member(self, protocol):
+        self.remove_member(protocol)
+        protocol.transport.loseConnection()
+
+    def schedule_replacement(self):
+        pending = len(self.members) + self.connecting + len(self.replacements)
+        if not self.running or pending >= self.size:
+            return
+
+        def replace():
+            self.replacements.discard(delayed_call)
+            self.add_member()
+
+        delayed_call = self.clock.callLater(self.reconnect_delay, replace)
+        self.replacements.add(delayed_call)
+
+    def is_healthy(self, protocol):
+        return bool(protocol.connected and protocol.authenticated and
+                    protocol.link_check.alive)
+
+    def check_health(self):
+        for member in list(self.members):
+            if not self.is_healthy(member):
+                log.msg('Dropping unhealthy SSMI connection: %r' % (member,))
+                self.drop_member(member)
+
+    def pick(self):
+        healthy = [member for member in self.members
+                   if self.is_healthy(member)]
+        if not healthy:
+            raise SSMIException('No healthy SSMI connections available.')
+        if self.strategy == self.ROUND_ROBIN:
+            member = healthy[self.next_member % len(healthy)]
+            self.next_member += 1
+            return member
+        if self.strategy == self.FASTEST:
+            # Members without a round trip time yet come last.
+            return min(healthy, key=lambda member: (
+                member.link_check.srtt is None, member.link_check.srtt,
+                member.queue_depth))
+        return min(healthy, key=lambda member: member.queue_depth)
+
+    def pin(self, msisdn, protocol):
+        """
+        Route USSD messages for ``msisdn`` over ``protocol``, for sessions
+        started by the network on that connection.
+        """
+        self.pins[msisdn] = protocol
+
+    def unpin(self, msisdn):
+        self.pins.pop(msisdn, None)
+
+    def ussd_received(self, protocol, command):
+        if command.type == USSD_NEW:
+            self.pin(command.msisdn, protocol)
+        elif command.type in (USSD_END, USSD_TIMEOUT):
+            self.unpin(command.msisdn)
+
+    def session_member(self, msisdn):
+        member = self.pins.get(msisdn)
+        if member is None or not self.is_healthy(member):
+            member = self.pick()
+            self.pins[msisdn] = member
+        return member
+
+    def call(self, method, *args, **kwargs):
+        return maybeDeferred(
+            lambda: getattr(self.pick(), method)(*args, **kwargs))
+
+    def send_session_message(self, method, msisdn, message, session_type,
+                             *args):
+        def send():
+            member = self.session_member(msisdn)
+            if session_type == USSD_END:
+                self.unpin(msisdn)
+            return getattr(member, method)(
+                msisdn, message, session_type, *args)
+        return maybeDeferred(send)
+
+    def send_ussd_message(self, msisdn, message, session_type):
+        return self.send_session_message(
+            'send_ussd_message', msisdn, message, session_type)
+
+    def send_extended_ussd_message(self, msisdn, message, session_type,
+                                   genfields):
+        return self.send_session_message(
+            'send_extended_ussd_message', msisdn, message, session_type,
+            genfields)
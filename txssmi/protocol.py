@@ -1,67 +1,489 @@
 # -*- test-case-name: txssmi.tests.test_protocol -*-
 # -*- coding: utf-8 -*-
 
-import random
-from collections import defaultdict
+from itertools import islice
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    maybeDeferred, succeed, DeferredQueue, Deferred)
-from twisted.internet.task import LoopingCall
+    DeferredQueue, Deferred, FirstError, fail, gatherResults)
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import Cooperator
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
+from zope.interface import implementer
 
 from txssmi.commands import (
     Login, SendSMS, LinkCheck, SendBinarySMS, ClientLogout, SendUSSDMessage,
     SendWAPPushMessage, SendMMSMessage, IMSILookup, SendExtendedUSSDMessage)
 from txssmi.constants import (
     RESPONSE_IDS, ACK_LOGIN_OK, CODING_7BIT, PROTOCOL_STANDARD, USSD_NEW,
-    USSD_RESPONSE, USSD_END)
-from txssmi.builder import SSMIResponse, SSMICommandException
-
-
+    USSD_RESPONSE, USSD_END, SSMI_ENCODING, PROTOCOL_ENHANCED,
+    ACK_LINK_CHECK_RESPONSE)
+from txssmi.builder import (
+    SSMIResponse, SSMICommandException, encode, decode)
+from txssmi.correlation import (
+    CorrelationStore, SeqTracker, SequenceAllocator, DeliveryIndex)
+from txssmi.dispatch import BatchConsumer
+from txssmi.keepalive import LinkMonitor
+from txssmi.logger import CommandLogger, DEBUG, INFO
+from txssmi.metrics import NullMetrics
+from txssmi.segment import Segmenter
+from txssmi.scheduler import (
+    LaneScheduler, DEFAULT_LANES, LANE_USSD, LANE_CONTROL, LANE_SMS,
+    LANE_BULK)
+from txssmi.throttle import TokenBucket
+
+
+@implementer(IPushProducer)
 class SSMIProtocol(LineReceiver):
 
     delimiter = b'\r'
+    # Charset of the text on the wire, characters it cannot represent are
+    # sent as '?'.
+    encoding = SSMI_ENCODING
     noisy = False
     clock = reactor
+    batch_size = 500
+    # Bytes the transport may buffer before it pauses us, None leaves the
+    # transport's own default in place.
+    high_water_mark = None
+    # Messages per second allowed for the SSMI account and how many may be
+    # sent back to back, None disables throttling.
+    throttle_rate = None
+    throttle_burst = None
+    lanes = DEFAULT_LANES
+    # Seconds to wait for SEQ and IMSI lookup replies and how many pending
+    # replies to keep track of per connection.
+    reply_timeout = 60
+    max_pending_replies = 10000
+    # Seconds to wait for a link check to be acknowledged and how many may
+    # go unanswered in a row before the connection is dropped.
+    link_check_timeout = 10
+    link_check_max_missed = 3
+    # Seconds and number of messages to keep indexed for their DRs.
+    delivery_ttl = 86400
+    max_deliveries = 100000
+    # Where counters and timings are reported, see txssmi.metrics. Replace
+    # with an InMemoryMetrics to collect them.
+    metrics = NullMetrics()
+    # Inbound commands are logged at DEBUG, so not at all by default. Use
+    # a CommandLogger with a lower level or a sample rate to see them.
+    logger = CommandLogger()
+    # Set to a txssmi.trace.TraceRecorder to record every line sent and
+    # received, by every connection unless set on an instance.
+    trace = None
+    # Commands the server answers with a SEQ and later a DR.
+    sequenced_commands = frozenset(['SEND_SMS', 'SEND_BINARY_SMS'])
+    # Splits long messages into parts. Shared by every connection so the
+    # parts of concurrent messages get different reference numbers.
+    segmenter = Segmenter()
+    # Protocol id sent with parts that start with a concatenation header.
+    concatenated_protocol_id = PROTOCOL_ENHANCED
+    # Set to a txssmi.dedup.DuplicateFilter to drop MOs the gateway sends
+    # again, shared by every connection so copies sent after a reconnect
+    # are dropped too.
+    duplicate_filter = None
 
     def __init__(self):
         self.authenticated = False
+        self.buffer = b''
         self.event_queue = DeferredQueue()
-        self.sequence_reply_map = defaultdict(lambda: DeferredQueue())
-        self.imsi_lookup_reply_map = defaultdict(lambda: DeferredQueue())
-        self.link_check = LoopingCall(self.send_link_request)
-        self.link_check.clock = self.clock
+        self.sequence_replies = SeqTracker(
+            self.max_pending_replies, self.reply_timeout, clock=self.clock)
+        self.imsi_lookup_replies = CorrelationStore(
+            self.max_pending_replies, self.reply_timeout, clock=self.clock)
+        self.imsi_sequences = SequenceAllocator()
+        self.deliveries = DeliveryIndex(
+            self.max_deliveries, self.delivery_ttl, clock=self.clock)
+        self.link_check = LinkMonitor(
+            self, self.link_check_timeout, self.link_check_max_missed,
+            clock=self.clock)
+        self.cooperator = Cooperator(
+            scheduler=lambda x: self.clock.callLater(0, x))
+        self.connect_waiters = []
+        self.disconnect_waiters = []
+        self.writes_paused = False
+        self.disconnected = False
+        self.pumping = False
+        self.pump_call = None
+        self.scheduler = LaneScheduler(self.lanes, clock=self.clock)
+        self.throttle = None
+        if self.throttle_rate is not None:
+            self.throttle = TokenBucket(
+                self.throttle_rate, self.throttle_burst, clock=self.clock)
+        self.handlers = self.build_handlers()
+        self.consumers = {}
+        self.batch_consumers = []
 
     def connectionMade(self):
-        log.msg('Connection made.')
+        self.logger.msg(INFO, 'Connection made.')
+        if self.high_water_mark is not None:
+            self.transport.bufferSize = self.high_water_mark
+        self.transport.registerProducer(self, True)
+        waiters, self.connect_waiters = self.connect_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def wait_for_connect(self):
+        """
+        Returns a Deferred that fires once the connection is made.
+        """
+        d = Deferred()
+        self.connect_waiters.append(d)
+        return d
+
+    @property
+    def queue_depth(self):
+        """
+        The number of commands waiting to be written, across all lanes.
+        """
+        return len(self.scheduler)
+
+    @property
+    def throttle_wait_time(self):
+        """
+        Seconds until the throttle allows every queued message through.
+        """
+        if self.throttle is None:
+            return 0.0
+        return self.throttle.delay(self.scheduler.throttled_depth())
+
+    def lane_latency(self, lane):
+        """
+        Histogram of the seconds commands spent queued on ``lane``.
+        """
+        return self.scheduler.lane_map[lane].latency
+
+    def pauseProducing(self):
+        self.writes_paused = True
+
+    def resumeProducing(self):
+        self.writes_paused = False
+        self.pump()
+
+    def stopProducing(self):
+        self.writes_paused = True
+        if self.pump_call is not None:
+            self.pump_call.cancel()
+            self.pump_call = None
+        for _, d in self.scheduler.clear():
+            if d is not None:
+                d.errback(ConnectionDone())
+
+    def pump(self):
+        """
+        Write queued commands, highest priority lanes first, until the
+        lanes are empty, the transport pauses us or the throttle runs out
+        of tokens. In the last case another pump is scheduled for when the
+        next token is due.
+        """
+        if self.pumping:
+            return
+        self.pumping = True
+        try:
+            while not self.writes_paused:
+                entries = self.scheduler.take(self.batch_size, self.throttle)
+                if not entries:
+                    break
+                self.write_commands([command for command, _ in entries])
+                for command, d in entries:
+                    if d is not None:
+                        d.callback(command)
+        finally:
+            self.pumping = False
+        if self.metrics.enabled:
+            for lane in self.scheduler.lanes:
+                self.metrics.queue_depth(lane.name, len(lane))
+        if (not self.writes_paused and self.throttle is not None and
+                self.pump_call is None and self.scheduler.throttled_depth()):
+            self.pump_call = self.clock.callLater(
+                self.throttle.delay(), self.delayed_pump)
+
+    def delayed_pump(self):
+        self.pump_call = None
+        self.pump()
 
     def connectionLost(self, reason):
-        log.msg('Connection lost: %s' % (reason,))
+        LineReceiver.connectionLost(self, reason)
+        self.disconnected = True
+        self.logger.msg(INFO, 'Connection lost: %(reason)s', reason=reason)
+        if self.link_check.running:
+            self.link_check.stop()
+        waiters, self.disconnect_waiters = self.disconnect_waiters, []
+        for d in waiters:
+            d.callback(None)
+        self.stopProducing()
+        self.fail_pending_replies(reason)
+        for consumer in self.batch_consumers:
+            consumer.flush()
+
+    def fail_pending_replies(self, reason):
+        """
+        Errback every Deferred still waiting for an ACK, SEQ or IMSI lookup
+        reply on this connection with ``reason``.
+        """
+        waiting = self.event_queue.waiting[:]
+        del self.event_queue.waiting[:]
+        for d in waiting:
+            d.errback(reason)
+        self.sequence_replies.fail_all(reason)
+        self.imsi_lookup_replies.fail_all(reason)
+
+    def wait_for_disconnect(self):
+        """
+        Returns a Deferred that fires once the connection is lost.
+        """
+        d = Deferred()
+        self.disconnect_waiters.append(d)
+        return d
 
     def emit(self, prefix, msg):
         if self.noisy:
-            log.msg('%s %r' % (prefix, msg))
+            log.msg(format='%(prefix)s %(command)r', prefix=prefix,
+                    command=msg)
+
+    def dataReceived(self, data):
+        """
+        Decode every complete line in ``data`` in one go, straight from
+        the receive buffer, and hand them to :meth:`lineReceived`.
+
+        This replaces the line splitting in ``LineReceiver``, which also
+        stops delivering lines while the transport has paused our writes.
+        """
+        self.link_check.data_received()
+        if self.metrics.enabled:
+            self.metrics.bytes_received(len(data))
+        if self.buffer:
+            data = self.buffer + data
+        end = data.rfind(self.delimiter)
+        if end < 0:
+            self.buffer = data
+        else:
+            self.buffer = data[end + len(self.delimiter):]
+            lines = memoryview(data)[:end]
+            if self.trace is not None:
+                self.trace.received(lines)
+            text = decode(lines, self.encoding)
+            for line in text.split(decode(self.delimiter, self.encoding)):
+                if self.transport.disconnecting:
+                    return
+                if line:
+                    self.lineReceived(line)
+        if len(self.buffer) > self.MAX_LENGTH:
+            buffer, self.buffer = self.buffer, b''
+            return self.lineLengthExceeded(buffer)
 
     def lineReceived(self, line):
-        command = SSMIResponse.parse(line)
+        command = SSMIResponse.parse(decode(line, self.encoding))
         self.emit('<<', command)
-        handler = getattr(self, 'handle_%s' % (command.command_name,))
-        maybeDeferred(handler, command)
+        if self.metrics.enabled:
+            self.record_received(command)
+        self.dispatch(command)
+
+    def build_handlers(self):
+        """
+        Map the name of every command the server sends to its ``handle_*``
+        method. Built once per protocol, override the ``handle_*`` methods
+        in a subclass to change them.
+        """
+        return dict(
+            (command_name, getattr(self, 'handle_%s' % (command_name,)))
+            for command_name in SSMIResponse.command_name_map.values())
+
+    def dispatch(self, command):
+        command_name = command.command_name
+        if (self.duplicate_filter is not None and
+                self.duplicate_filter.is_duplicate(command)):
+            self.logger.command(DEBUG, 'Dropping duplicate', command)
+            return
+        try:
+            self.handlers[command_name](command)
+        except Exception:
+            log.err(None, 'Error handling %s.' % (command_name,))
+        for consumer in self.consumers.get(command_name, ()):
+            try:
+                consumer(command)
+            except Exception:
+                log.err(None, 'Error in %s consumer %r.' % (
+                    command_name, consumer))
+
+    def register_handler(self, command_name, handler):
+        """
+        Call ``handler`` with every ``command_name`` command received,
+        after the protocol's own ``handle_*`` method.
+        """
+        if command_name not in self.handlers:
+            raise SSMICommandException(
+                'Unknown command name: %s' % (command_name,))
+        self.consumers.setdefault(command_name, []).append(handler)
+        return handler
+
+    def unregister_handler(self, command_name, handler):
+        """
+        Stop calling ``handler`` for ``command_name``. A batch consumer is
+        flushed once it no longer handles any command.
+        """
+        consumers = self.consumers.get(command_name, [])
+        if handler in consumers:
+            consumers.remove(handler)
+        still_registered = any(
+            handler in handlers for handlers in self.consumers.values())
+        if handler in self.batch_consumers and not still_registered:
+            self.batch_consumers.remove(handler)
+            handler.flush()
+
+    def register_batch_handler(self, command_names, handler, interval=0.1,
+                               max_size=500):
+        """
+        Call ``handler`` with lists of the commands received for any of
+        ``command_names``, every ``interval`` seconds or as soon as
+        ``max_size`` are waiting. Returns the
+        :class:`txssmi.dispatch.BatchConsumer`, which is flushed when the
+        connection is lost.
+        """
+        if isinstance(command_names, str):
+            command_names = [command_names]
+        consumer = BatchConsumer(handler, interval, max_size, clock=self.clock)
+        for command_name in command_names:
+            self.register_handler(command_name, consumer)
+        self.batch_consumers.append(consumer)
+        return consumer
+
+    def send_command(self, command, lane=LANE_CONTROL):
+        if self.disconnected:
+            return fail(ConnectionDone())
+        d = Deferred()
+        self.scheduler.put(lane, command, d)
+        self.pump()
+        return d
 
-    def send_command(self, command):
-        self.emit('>>', command)
-        self.sendLine(str(command))
-        return succeed(command)
+    def write_commands(self, commands):
+        """
+        Serialise ``commands`` into a single buffer, encoded in one go,
+        and write it.
+        """
+        lines = []
+        for command in commands:
+            self.emit('>>', command)
+            lines.append(str(command))
+            if command.command_name in self.sequenced_commands:
+                self.sequence_replies.written(command)
+        lines.append('')
+        delimiter = decode(self.delimiter, self.encoding)
+        data = encode(delimiter.join(lines), self.encoding, 'replace')
+        if self.metrics.enabled:
+            self.record_sent(commands, data)
+        if self.trace is not None:
+            self.trace.sent(memoryview(data)[:-len(self.delimiter)])
+        self.transport.write(data)
+
+    def record_sent(self, commands, data):
+        """
+        Count written commands and bytes and start the SEQ and IMSI lookup
+        timers.
+        """
+        metrics = self.metrics
+        metrics.bytes_sent(len(data))
+        for command in commands:
+            command_name = command.command_name
+            metrics.command_sent(command_name)
+            if command_name in self.sequenced_commands:
+                metrics.start_timer('seq', command.msisdn)
+            elif command_name == 'IMSI_LOOKUP':
+                metrics.start_timer('imsi_lookup', command.sequence)
+
+    def record_received(self, command):
+        """
+        Count a received command and stop the timers it answers. A SEQ
+        starts the DR timer from the time the message was sent.
+        """
+        metrics = self.metrics
+        command_name = command.command_name
+        metrics.command_received(command_name)
+        if command_name == 'SEQ':
+            start = metrics.stop_timer('seq', command.msisdn)
+            if start is not None:
+                metrics.start_timer(
+                    'dr', (command.msisdn, command.sequence), start)
+        elif command_name == 'DR':
+            metrics.stop_timer('dr', (command.msisdn, command.sequence))
+        elif command_name == 'IMSI_LOOKUP_REPLY':
+            metrics.stop_timer('imsi_lookup', command.sequence)
+
+    def send_commands(self, commands, lane=LANE_BULK):
+        """
+        Send every command from the ``commands`` iterable on ``lane``,
+        taking ``batch_size`` commands at a time. The next batch is only
+        taken from the iterable once the previous one has been written, so
+        a large (or lazy) iterable does not block the reactor or pile up
+        in memory while the transport is paused or the throttle is
+        holding messages back.
+
+        Returns a Deferred that fires with the list of commands sent.
+        """
+        sent = []
+
+        def enqueue_batches():
+            pending = iter(commands)
+            while True:
+                if self.disconnected:
+                    raise ConnectionDone()
+                batch = list(islice(pending, self.batch_size))
+                if not batch:
+                    return
+                d = Deferred()
+                for command in batch[:-1]:
+                    self.scheduler.put(lane, command)
+                self.scheduler.put(lane, batch[-1], d)
+                sent.extend(batch)
+                self.pump()
+                yield d
+
+        d = self.cooperator.coiterate(enqueue_batches())
+        d.addCallback(lambda _: sent)
+        return d
 
     def send_link_request(self):
         if not self.authenticated:
             return
         return self.send_command(LinkCheck())
 
-    def wait_for_reply(self, msisdn):
-        return self.sequence_reply_map[msisdn].get()
+    def link_dead(self):
+        """
+        Called when link checks go unanswered, drops the connection
+        without waiting for buffered writes that will never go out.
+        """
+        self.logger.msg(INFO, 'Link check failed, dropping connection.')
+        abort = getattr(self.transport, 'abortConnection', None)
+        if abort is None:
+            abort = self.transport.loseConnection
+        abort()
+
+    def claim_seq(self, command):
+        """
+        Returns a Deferred for the SEQ for ``command``, which must not have
+        been queued yet. See :class:`txssmi.correlation.SeqTracker`.
+        """
+        return self.sequence_replies.claim(command)
+
+    def unclaim_seq(self, failure, command, reply):
+        """
+        Give up on the SEQ for ``command`` after it failed to be written.
+        """
+        reply.addErrback(lambda _: None)
+        reply.cancel()
+        return failure
+
+    def send_sequenced(self, command, lane=LANE_SMS):
+        """
+        Send ``command`` and return a Deferred that fires with its SEQ.
+        """
+        reply = self.claim_seq(command)
+        d = self.send_command(command, lane=lane)
+        d.addCallbacks(lambda _: reply, self.unclaim_seq,
+                       errbackArgs=(command, reply))
+        return d
 
     def login(self, username, password):
         return self.send_command(Login(username=username, password=password))
@@ -84,20 +506,88 @@ class SSMIProtocol(LineReceiver):
 
     def send_message(self, msisdn, message, validity='0'):
         return self.send_command(
-            SendSMS(msisdn=msisdn, message=message, validity=validity))
+            SendSMS(msisdn=msisdn, message=message, validity=validity),
+            lane=LANE_SMS)
+
+    def send_tracked_message(self, msisdn, message, validity='0',
+                             reference=None):
+        """
+        Send an SMS and return a Deferred that fires with its
+        :class:`txssmi.correlation.Delivery` once the SEQ arrives. Use
+        :meth:`wait_for_delivery` with it to wait for the DR.
+        """
+        command = SendSMS(msisdn=msisdn, message=message, validity=validity)
+        reply = self.claim_seq(command)
+        d = self.send_command(command, lane=LANE_SMS)
+        d.addCallbacks(self.track_delivery, self.unclaim_seq,
+                       callbackArgs=(reply, reference),
+                       errbackArgs=(command, reply))
+        return d
+
+    def track_delivery(self, command, reply, reference=None):
+        """
+        Link ``reply``, the claimed SEQ for ``command``, which has just
+        been written, to its entry in ``deliveries``.
+        """
+        sent_at = self.clock.seconds()
+        reply.addCallback(lambda seq: self.deliveries.link(
+            seq.msisdn, seq.sequence, sent_at, reference))
+        return reply
+
+    def wait_for_delivery(self, delivery):
+        """
+        Returns a Deferred that fires with ``delivery`` once its DR has
+        been received.
+        """
+        return self.deliveries.wait(delivery.msisdn, delivery.sequence)
+
+    def send_messages(self, messages, validity='0'):
+        """
+        Send an SMS for each ``(msisdn, message)`` pair in ``messages`` on
+        the bulk lane. See :meth:`send_commands`.
+        """
+        return self.send_commands(
+            SendSMS(msisdn=msisdn, message=message, validity=validity)
+            for msisdn, message in messages)
 
     def send_binary_message(self, msisdn, hex_message, validity='0',
                             protocol_id=PROTOCOL_STANDARD,
                             coding=CODING_7BIT):
-        d = self.send_command(
+        return self.send_sequenced(
             SendBinarySMS(msisdn=msisdn, hex_msg=hex_message,
                           validity=validity, pid=protocol_id, coding=coding))
-        d.addCallback(lambda cmd: self.wait_for_reply(cmd.msisdn))
+
+    def send_long_message(self, msisdn, message, validity='0'):
+        """
+        Send ``message`` as binary SMS, split into as many concatenated
+        parts as it needs, in GSM 7-bit if it can be and UCS-2 otherwise.
+        All parts are written together and their SEQs waited for at the
+        same time.
+
+        Returns a Deferred that fires with the SEQ for every part, or
+        with the first failure.
+        """
+        coding, hex_parts = self.segmenter.hex_parts(message)
+        protocol_id = (PROTOCOL_STANDARD if len(hex_parts) == 1
+                       else self.concatenated_protocol_id)
+        deferreds = []
+        for hex_msg in hex_parts:
+            deferreds.append(self.send_sequenced(
+                SendBinarySMS(msisdn=msisdn, hex_msg=hex_msg,
+                              validity=validity, pid=protocol_id,
+                              coding=coding)))
+        d = gatherResults(deferreds, consumeErrors=True)
+        d.addErrback(self.first_failure)
         return d
 
+    def first_failure(self, failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
     def send_ussd_message(self, msisdn, message, session_type):
         return self.send_command(
-            SendUSSDMessage(msisdn=msisdn, message=message, type=session_type))
+            SendUSSDMessage(msisdn=msisdn, message=message, type=session_type),
+            lane=LANE_USSD)
 
     def send_extended_ussd_message(self, msisdn, message, session_type,
                                    genfields):
@@ -107,62 +597,137 @@ class SSMIProtocol(LineReceiver):
         return self.send_command(
             SendExtendedUSSDMessage(msisdn=msisdn, message=message,
                                     type=session_type,
-                                    genfields=':'.join(genfields)))
+                                    genfields=':'.join(genfields)),
+            lane=LANE_USSD)
 
     def send_wap_push_message(self, msisdn, subject, url):
         return self.send_command(
-            SendWAPPushMessage(msisdn=msisdn, subject=subject, url=url))
+            SendWAPPushMessage(msisdn=msisdn, subject=subject, url=url),
+            lane=LANE_SMS)
 
     def send_mms_message(self, msisdn, subject, name, content):
         return self.send_command(
             SendMMSMessage(msisdn=msisdn, subject=subject, name=name,
-                           content=content))
-
-    def imsi_lookup(self, msisdn, sequence=None, imsi=None):
-        if sequence is None:
-            sequence = str(random.randint(0, 1000))
-        d = self.send_command(IMSILookup(sequence=sequence, msisdn=msisdn,
-                                         imsi=imsi))
-        deferred = Deferred()
-        self.imsi_lookup_reply_map[sequence] = deferred
+                           content=content),
+            lane=LANE_SMS)
+
+    def imsi_lookup(self, msisdn, sequence=None, imsi=None, timeout=None):
+        [(command, deferred, allocated)] = self.imsi_lookup_commands(
+            [(msisdn, sequence, imsi)], timeout)
+        d = self.send_command(command)
+        if allocated is not None:
+            self.release_imsi_sequence(allocated, d, deferred)
         d.addCallback(lambda _: deferred)
         return d
 
+    @property
+    def imsi_lookups_free(self):
+        """
+        How many more IMSI lookups can be waited for at the same time.
+        """
+        return min(self.imsi_sequences.free,
+                   self.imsi_lookup_replies.max_size -
+                   len(self.imsi_lookup_replies))
+
+    def imsi_lookup_many(self, msisdns, timeout=None):
+        """
+        Look up the IMSI for every msisdn in ``msisdns``, writing the
+        requests in batches. Returns a list of Deferreds, in the same
+        order as ``msisdns``, that each fire as their reply arrives.
+        """
+        msisdns = list(msisdns)
+        free = self.imsi_lookups_free
+        if len(msisdns) > free:
+            raise SSMICommandException(
+                'Too many concurrent IMSI lookups: %s requested, %s free.' % (
+                    len(msisdns), free))
+        lookups = self.imsi_lookup_commands(
+            [(msisdn, None, None) for msisdn in msisdns], timeout)
+        d = self.send_commands(
+            [command for command, _, _ in lookups], lane=LANE_CONTROL)
+        for _, deferred, allocated in lookups:
+            self.release_imsi_sequence(allocated, d, deferred)
+        # Failures are delivered through the individual lookups.
+        d.addErrback(lambda _: None)
+        return [deferred for _, deferred, _ in lookups]
+
+    def imsi_lookup_commands(self, lookups, timeout):
+        """
+        Build an IMSI lookup command and the Deferred for its reply for
+        every ``(msisdn, sequence, imsi)`` in ``lookups``, along with the
+        sequence number allocated for it when none is given.
+        """
+        commands = []
+        for msisdn, sequence, imsi in lookups:
+            allocated = None
+            if sequence is None:
+                sequence = allocated = self.imsi_sequences.allocate()
+            deferred = self.imsi_lookup_replies.wait(sequence, timeout)
+            command = IMSILookup(sequence=sequence, msisdn=msisdn,
+                                 imsi='' if imsi is None else imsi)
+            commands.append((command, deferred, allocated))
+        return commands
+
+    def release_imsi_sequence(self, sequence, sent, reply):
+        """
+        Release ``sequence`` once the lookup is over and its command is no
+        longer queued, so it is not reused while the command may still be
+        written.
+        """
+        outstanding = [sent, reply]
+
+        def done(result, d):
+            outstanding.remove(d)
+            if not outstanding:
+                self.imsi_sequences.release(sequence)
+            return result
+
+        sent.addBoth(done, sent)
+        reply.addBoth(done, reply)
+
     def handle_ACK(self, ack):
+        if ack.ack_type == ACK_LINK_CHECK_RESPONSE:
+            return self.link_check.response_received()
         return self.event_queue.put(ack)
 
     def handle_NACK(self, nack):
-        return self.event_queue.put(nack)
+        # A NACK answers the oldest message still waiting for its SEQ, if
+        # there is one.
+        if not self.sequence_replies.nack_received(nack):
+            return self.event_queue.put(nack)
 
     def handle_IMSI_LOOKUP_REPLY(self, resp):
-        return self.imsi_lookup_reply_map[resp.sequence].callback(resp)
+        return self.imsi_lookup_replies.put(resp.sequence, resp)
 
     def handle_SEQ(self, seq):
-        return self.sequence_reply_map[seq.msisdn].put(seq)
+        self.deliveries.record_seq(seq.msisdn, seq.sequence)
+        self.sequence_replies.seq_received(seq)
 
     def handle_MO(self, mo):
-        log.msg('Received MO: %r' % (mo,))
+        self.logger.command(DEBUG, 'Received MO', mo)
 
-    def handle_DR(self, mo):
-        log.msg('Received DR: %r' % (mo,))
+    def handle_DR(self, dr):
+        self.logger.command(DEBUG, 'Received DR', dr)
+        self.deliveries.record_dr(dr.msisdn, dr.sequence, dr.ret_code)
 
     def handle_FREE_FORM(self, ff):
-        log.msg('Received FREE_FORM: %r' % (ff,))
+        self.logger.command(DEBUG, 'Received FREE_FORM', ff)
 
     def handle_BINARY_MO(self, bmo):
-        log.msg('Received BINARY_MO: %r' % (bmo,))
+        self.logger.command(DEBUG, 'Received BINARY_MO', bmo)
 
     def handle_PREMIUM_MO(self, pmo):
-        log.msg('Received PREMIUM_MO: %r' % (pmo,))
+        self.logger.command(DEBUG, 'Received PREMIUM_MO', pmo)
 
     def handle_PREMIUM_BINARY_MO(self, bmo):
-        log.msg('Received PREMIUM_BINARY_MO: %r' % (bmo,))
+        self.logger.command(DEBUG, 'Received PREMIUM_BINARY_MO', bmo)
 
     def handle_USSD_MESSAGE(self, um):
-        log.msg('Received USSD_MESSAGE: %r' % (um,))
+        self.logger.command(DEBUG, 'Received USSD_MESSAGE', um)
 
     def handle_EXTENDED_USSD_MESSAGE(self, um):
-        log.msg('Received EXTENDED_USSD_MESSAGE: %r' % (um,))
+        self.logger.command(DEBUG, 'Received EXTENDED_USSD_MESSAGE', um)
 
     def handle_LOGOUT(self, msg):
-        log.msg('Received LOGOUT: %r' % (msg,))
+        self.logger.command(INFO, 'Received LOGOUT', msg)
+        self.authenticated = False
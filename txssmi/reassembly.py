@@ -0,0 +1,186 @@
+# -*- test-case-name: txssmi.tests.test_reassembly -*-
+
+import binascii
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from txssmi.segment import (
+    ALPHABET_GSM7, ALPHABET_UCS2, coding_alphabet, parse_concat_header,
+    unpack_septets, gsm7_decode)
+
+
+class InboundMessage(object):
+    """
+    A binary message received whole or put back together from its parts.
+    ``content`` is text for GSM 7-bit and UCS-2 messages and bytes for
+    8-bit ones, ``parts`` holds the ``BINARY_MO`` or ``PREMIUM_BINARY_MO``
+    commands it arrived in, in order.
+    """
+
+    __slots__ = ('msisdn', 'coding', 'content', 'parts')
+
+    def __init__(self, msisdn, coding, content, parts):
+        self.msisdn = msisdn
+        self.coding = coding
+        self.content = content
+        self.parts = parts
+
+    def __repr__(self):
+        return '<InboundMessage msisdn=%s parts=%s>' % (
+            self.msisdn, len(self.parts))
+
+    @property
+    def command(self):
+        return self.parts[0]
+
+
+class PartialMessage(object):
+
+    __slots__ = ('total', 'started_at', 'parts')
+
+    def __init__(self, total, started_at):
+        self.total = total
+        self.started_at = started_at
+        self.parts = {}
+
+
+def decode_content(alphabet, user_data):
+    """
+    Decode and join the ``(header_length, payload)`` pairs in
+    ``user_data``, skipping the headers.
+    """
+    if alphabet == ALPHABET_GSM7:
+        septets = []
+        for header_length, payload in user_data:
+            # Septets after a header start on the next septet boundary.
+            septets.extend(unpack_septets(
+                payload[header_length:], -header_length * 8 % 7))
+        return gsm7_decode(septets)
+    data = b''.join(
+        payload[header_length:] for header_length, payload in user_data)
+    if alphabet == ALPHABET_UCS2:
+        return data.decode('utf-16-be', 'replace')
+    return data
+
+
+class Reassembler(object):
+    """
+    Puts concatenated binary messages back together and hands complete
+    messages to ``handler`` as :class:`InboundMessage`.
+
+    Parts are buffered by msisdn and concatenation reference, so parts
+    that arrive over different connections are joined too. At most
+    ``max_pending`` messages are waiting for parts, the oldest are
+    dropped beyond that, and messages still missing parts
+    ``timeout`` seconds after their first part arrived are dropped by a
+    single timer. Messages without a concatenation header are handed on
+    straight away.
+    """
+
+    def __init__(self, handler, max_pending=10000, timeout=300,
+                 clock=reactor):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.clock = clock
+        self.pending = OrderedDict()
+        self.expire_call = None
+        self.delivered = 0
+        self.duplicates = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def attach(self, protocol):
+        """
+        Reassemble the binary messages received on ``protocol``.
+        """
+        protocol.register_handler('BINARY_MO', self.handle_part)
+        protocol.register_handler('PREMIUM_BINARY_MO', self.handle_part)
+        return protocol
+
+    def handle_part(self, command):
+        try:
+            payload = binascii.unhexlify(command.hex_msg)
+        except (TypeError, ValueError):
+            log.msg('Dropping %s with invalid hex_msg from %s.' % (
+                command.command_name, command.msisdn))
+            return
+        concat = parse_concat_header(payload)
+        if concat is None:
+            return self.deliver([command], [(0, payload)])
+
+        reference, total, number, header_length = concat
+        key = (command.msisdn, reference, total)
+        message = self.pending.get(key)
+        if message is None:
+            message = self.pending[key] = PartialMessage(
+                total, self.clock.seconds())
+            self.enforce_max_pending()
+            self.schedule_expiry()
+        if number in message.parts:
+            self.duplicates += 1
+            return
+        message.parts[number] = (command, (header_length, payload))
+        if len(message.parts) == total:
+            del self.pending[key]
+            parts = [message.parts[n] for n in range(1, total + 1)]
+            self.deliver([command for command, _ in parts],
+                         [user_data for _, user_data in parts])
+
+    def deliver(self, commands, user_data):
+        command = commands[0]
+        content = decode_content(coding_alphabet(command.coding), user_data)
+        self.delivered += 1
+        try:
+            self.handler(InboundMessage(
+                command.msisdn, command.coding, content, commands))
+        except Exception:
+            log.err(None, 'Error handling message from %s.' % (
+                command.msisdn,))
+
+    def enforce_max_pending(self):
+        while len(self.pending) > self.max_pending:
+            key, _ = self.pending.popitem(last=False)
+            self.evicted += 1
+            log.msg('Dropping incomplete message %r, too many pending.' % (
+                key,))
+
+    def schedule_expiry(self):
+        if self.expire_call is not None or not self.pending:
+            return
+        oldest = next(iter(self.pending.values()))
+        delay = max(0, oldest.started_at + self.timeout -
+                    self.clock.seconds())
+        self.expire_call = self.clock.callLater(delay, self.expire)
+
+    def expire(self):
+        self.expire_call = None
+        deadline = self.clock.seconds() - self.timeout
+        while self.pending:
+            key, message = next(iter(self.pending.items()))
+            if message.started_at > deadline:
+                break
+            del self.pending[key]
+            self.expired += 1
+            log.msg('Dropping incomplete message %r, %s of %s parts.' % (
+                key, len(message.parts), message.total))
+        self.schedule_expiry()
+
+    def snapshot(self):
+        return {
+            'pending': len(self.pending),
+            'delivered': self.delivered,
+            'duplicates': self.duplicates,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+    def stop(self):
+        if self.expire_call is not None:
+            self.expire_call.cancel()
+            self.expire_call = None
@@ -0,0 +1,121 @@
+# -*- test-case-name: txssmi.tests.test_scheduler -*-
+
+from collections import deque
+
+from twisted.internet import reactor
+
+from txssmi.metrics import Histogram
+
+
+LANE_USSD = 'ussd'
+LANE_CONTROL = 'control'
+LANE_SMS = 'sms'
+LANE_BULK = 'bulk'
+
+# (name, weight, throttled) in priority order. Control traffic (login,
+# logout, link checks and IMSI lookups) does not count towards the
+# account's message throughput.
+DEFAULT_LANES = [
+    (LANE_USSD, 8, True),
+    (LANE_CONTROL, 4, False),
+    (LANE_SMS, 2, True),
+    (LANE_BULK, 1, True),
+]
+
+
+class Lane(object):
+
+    def __init__(self, name, weight, throttled):
+        self.name = name
+        self.weight = weight
+        self.throttled = throttled
+        self.queue = deque()
+        self.latency = Histogram()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __repr__(self):
+        return '<Lane %s weight=%s throttled=%s depth=%s>' % (
+            self.name, self.weight, self.throttled, len(self))
+
+
+class LaneScheduler(object):
+    """
+    Weighted round robin over a fixed set of outbound lanes.
+
+    Each lane gets up to ``weight`` commands per turn, lanes take turns in
+    the order given. The time every command spends queued is recorded in
+    its lane's ``latency`` histogram.
+    """
+
+    def __init__(self, lanes=DEFAULT_LANES, clock=reactor):
+        self.lanes = [Lane(*lane) for lane in lanes]
+        self.lane_map = dict((lane.name, lane) for lane in self.lanes)
+        self.clock = clock
+        self.position = 0
+        self.credit = self.lanes[0].weight
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def depth(self, name):
+        return len(self.lane_map[name])
+
+    def throttled_depth(self):
+        return sum(len(lane) for lane in self.lanes if lane.throttled)
+
+    def put(self, name, command, d=None):
+        self.lane_map[name].queue.append((command, d, self.clock.seconds()))
+
+    def take(self, count, throttle=None):
+        """
+        Take up to ``count`` ``(command, deferred)`` pairs. If a
+        :class:`txssmi.throttle.TokenBucket` is given, commands from
+        throttled lanes are only taken for tokens it has available and
+        those tokens are consumed.
+        """
+        throttled_limit = None
+        if throttle is not None:
+            throttled_limit = throttle.available()
+        throttled_taken = 0
+        taken = []
+        now = self.clock.seconds()
+        lane_count = len(self.lanes)
+        # Only move the cursor past lanes we have actually taken from, so
+        # a pass that finds nothing eligible doesn't cost a lane its turn.
+        cursor = (self.position, self.credit)
+        idle = 0
+        while len(taken) < count and idle <= lane_count:
+            lane = self.lanes[self.position]
+            if (self.credit > 0 and lane.queue and (
+                    not lane.throttled or throttled_limit is None or
+                    throttled_limit > 0)):
+                command, d, queued_at = lane.queue.popleft()
+                lane.latency.observe(now - queued_at)
+                taken.append((command, d))
+                self.credit -= 1
+                if lane.throttled and throttled_limit is not None:
+                    throttled_limit -= 1
+                    throttled_taken += 1
+                cursor = (self.position, self.credit)
+                idle = 0
+                continue
+            self.position = (self.position + 1) % lane_count
+            self.credit = self.lanes[self.position].weight
+            idle += 1
+        self.position, self.credit = cursor
+        if throttled_taken:
+            throttle.consume(throttled_taken)
+        return taken
+
+    def clear(self):
+        """
+        Remove and return every queued ``(command, deferred)`` pair.
+        """
+        cleared = []
+        for lane in self.lanes:
+            while lane.queue:
+                command, d, _ = lane.queue.popleft()
+                cleared.append((command, d))
+        return cleared
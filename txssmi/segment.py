@@ -0,0 +1,294 @@
+# -*- test-case-name: txssmi.tests.test_segment -*-
+# -*- coding: utf-8 -*-
+
+import binascii
+
+from txssmi.builder import SSMICommandException
+from txssmi.constants import CODING_7BIT, CODING_UCS2
+
+# The GSM 03.38 default alphabet, by septet value. 0x1B is the escape to
+# the extension table and does not stand for a character of its own.
+GSM7_BASIC = (
+    u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+GSM7_EXTENDED = {
+    u'\x0c': 0x0A, u'^': 0x14, u'{': 0x28, u'}': 0x29, u'\\': 0x2F,
+    u'[': 0x3C, u'~': 0x3D, u']': 0x3E, u'|': 0x40, u'€': 0x65,
+}
+GSM7_ESCAPE = 0x1B
+
+GSM7_SEPTETS = dict(
+    (char, (septet,)) for septet, char in enumerate(GSM7_BASIC)
+    if septet != GSM7_ESCAPE)
+GSM7_SEPTETS.update(
+    (char, (GSM7_ESCAPE, septet)) for char, septet in GSM7_EXTENDED.items())
+
+# User data is at most 140 octets: 160 septets or 70 UCS-2 characters.
+# The concatenation header takes 6 of them from every part of a longer
+# message, plus a fill bit to align the septets that follow it. Limits
+# are in septets for GSM 7-bit and octets for UCS-2, for a message sent
+# whole and for each part of a longer one.
+USER_DATA_LENGTH = 140
+CONCAT_HEADER_LENGTH = 6
+LIMITS = {
+    CODING_7BIT: (
+        USER_DATA_LENGTH * 8 // 7,
+        (USER_DATA_LENGTH - CONCAT_HEADER_LENGTH) * 8 // 7),
+    CODING_UCS2: (
+        USER_DATA_LENGTH,
+        USER_DATA_LENGTH - CONCAT_HEADER_LENGTH),
+}
+
+
+def gsm7_septets(text):
+    """
+    Returns the GSM 7-bit septets for ``text``, or None if it has
+    characters outside the default alphabet and its extension table.
+    """
+    septets = GSM7_SEPTETS
+    try:
+        return [septets[char] for char in text]
+    except KeyError:
+        return None
+
+
+def pack_septets(septets, fill_bits=0):
+    """
+    Pack ``septets`` into octets, least significant bit first, after
+    ``fill_bits`` zero bits.
+    """
+    packed = bytearray()
+    value = 0
+    bits = fill_bits
+    for septet in septets:
+        value |= septet << bits
+        bits += 7
+        while bits >= 8:
+            packed.append(value & 0xFF)
+            value >>= 8
+            bits -= 8
+    if bits:
+        packed.append(value & 0xFF)
+    return bytes(packed)
+
+
+def ucs2_units(text):
+    """
+    Returns the UTF-16 encoding of every character of ``text``, two
+    octets or four for characters outside the basic plane.
+    """
+    return [char.encode('utf-16-be') for char in text]
+
+
+def split_units(units, limit):
+    """
+    Split ``units``, the encoding of every character, into parts of at
+    most ``limit`` septets or octets without splitting a character.
+    """
+    parts = []
+    part = []
+    length = 0
+    for unit in units:
+        if length + len(unit) > limit:
+            parts.append(part)
+            part = []
+            length = 0
+        part.append(unit)
+        length += len(unit)
+    parts.append(part)
+    return parts
+
+
+def concat_header(reference, total, number):
+    return bytes(bytearray([5, 0, 3, reference, total, number]))
+
+
+class Segmenter(object):
+    """
+    Splits text into the user data of as many SMS parts as it needs.
+
+    Text that fits the GSM 7-bit alphabet is sent as packed septets,
+    anything else as UCS-2. Longer messages are split into parts that
+    start with a concatenation header, which share a reference number
+    taken from a counter so messages to the same handset do not mix.
+    """
+
+    max_parts = 255
+
+    def __init__(self, reference=0):
+        self.reference = reference
+
+    def next_reference(self):
+        self.reference = (self.reference + 1) % 256
+        return self.reference
+
+    def units(self, text):
+        """
+        Returns the coding for ``text`` and the encoding of every
+        character in it.
+        """
+        septets = gsm7_septets(text)
+        if septets is not None:
+            return CODING_7BIT, septets
+        return CODING_UCS2, ucs2_units(text)
+
+    def count(self, text):
+        """
+        Returns the coding and the number of parts needed for ``text``.
+        """
+        coding, units = self.units(text)
+        single, part = LIMITS[coding]
+        if sum(len(unit) for unit in units) <= single:
+            return coding, 1
+        return coding, len(split_units(units, part))
+
+    def split(self, text):
+        """
+        Returns the coding for ``text`` and the user data, header
+        included, of every part.
+        """
+        coding, units = self.units(text)
+        single, part = LIMITS[coding]
+        if sum(len(unit) for unit in units) <= single:
+            return coding, [self.pack(coding, units)]
+
+        parts = split_units(units, part)
+        if len(parts) > self.max_parts:
+            raise SSMICommandException(
+                'Message too long: %s parts, at most %s.' % (
+                    len(parts), self.max_parts))
+        reference = self.next_reference()
+        return coding, [
+            concat_header(reference, len(parts), number) +
+            self.pack(coding, units, CONCAT_HEADER_LENGTH)
+            for number, units in enumerate(parts, 1)]
+
+    def pack(self, coding, units, header_length=0):
+        if coding == CODING_7BIT:
+            # Septets after a header start on the next septet boundary.
+            fill_bits = -header_length * 8 % 7
+            return pack_septets(
+                [septet for unit in units for septet in unit], fill_bits)
+        return b''.join(units)
+
+    def hex_parts(self, text):
+        """
+        Returns the coding for ``text`` and every part hex encoded, ready
+        for ``SendBinarySMS``. The parts are encoded in one go.
+        """
+        coding, parts = self.split(text)
+        hex_msg = binascii.hexlify(b''.join(parts)).decode('ascii')
+        hex_parts = []
+        offset = 0
+        for part in parts:
+            hex_parts.append(hex_msg[offset:offset + len(part) * 2])
+            offset += len(part) * 2
+        return coding, hex_parts
+
+
+GSM7_CHARS = dict(
+    (septet, char) for septet, char in enumerate(GSM7_BASIC)
+    if septet != GSM7_ESCAPE)
+GSM7_EXTENDED_CHARS = dict(
+    (septet, char) for char, septet in GSM7_EXTENDED.items())
+
+ALPHABET_GSM7 = 'gsm7'
+ALPHABET_8BIT = '8bit'
+ALPHABET_UCS2 = 'ucs2'
+
+# Concatenation information elements, with 8 and 16 bit references.
+IE_CONCAT = 0x00
+IE_CONCAT_16BIT = 0x08
+
+
+def unpack_septets(data, fill_bits=0):
+    """
+    Unpack the septets in ``data`` after ``fill_bits`` padding bits.
+
+    Without the user data length the last septet is ambiguous when the
+    octets hold exactly one more septet than the padding: a zero septet
+    there is taken to be padding.
+    """
+    septets = []
+    value = 0
+    bits = 0
+    padded = (len(data) * 8 - fill_bits) % 7 == 0
+    for octet in bytearray(data):
+        value |= octet << bits
+        bits += 8
+        if fill_bits:
+            value >>= fill_bits
+            bits -= fill_bits
+            fill_bits = 0
+        while bits >= 7:
+            septets.append(value & 0x7F)
+            value >>= 7
+            bits -= 7
+    if padded and septets and septets[-1] == 0:
+        septets.pop()
+    return septets
+
+
+def gsm7_decode(septets):
+    """
+    Decode GSM 7-bit ``septets``, escaped septets missing from the
+    extension table decode as their default alphabet character.
+    """
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            escaped = False
+            chars.append(GSM7_EXTENDED_CHARS.get(
+                septet, GSM7_CHARS.get(septet, u'')))
+        elif septet == GSM7_ESCAPE:
+            escaped = True
+        else:
+            chars.append(GSM7_CHARS[septet])
+    return u''.join(chars)
+
+
+def coding_alphabet(coding):
+    """
+    Returns the alphabet for the data coding scheme ``coding``, a string
+    as it appears in SSMI commands.
+    """
+    dcs = int(coding or 0)
+    if dcs & 0xF0 == 0xF0:
+        return ALPHABET_8BIT if dcs & 0x04 else ALPHABET_GSM7
+    if dcs & 0xC0 in (0x00, 0x40):
+        return (ALPHABET_GSM7, ALPHABET_8BIT, ALPHABET_UCS2,
+                ALPHABET_8BIT)[(dcs >> 2) & 0x03]
+    if dcs & 0xF0 == 0xE0:
+        return ALPHABET_UCS2
+    return ALPHABET_GSM7
+
+
+def parse_concat_header(data):
+    """
+    Returns ``(reference, total, number, header_length)`` if ``data``
+    starts with a user data header holding a concatenation element, or
+    None.
+    """
+    data = bytearray(data)
+    if not data or data[0] + 1 > len(data):
+        return None
+    header_length = data[0] + 1
+    position = 1
+    concat = None
+    while position + 2 <= header_length:
+        element, length = data[position], data[position + 1]
+        value = data[position + 2:position + 2 + length]
+        if position + 2 + length > header_length:
+            return None
+        if element == IE_CONCAT and length == 3:
+            concat = (value[0], value[1], value[2])
+        elif element == IE_CONCAT_16BIT and length == 4:
+            concat = ((value[0] << 8) | value[1], value[2], value[3])
+        position += 2 + length
+    if position != header_length or concat is None:
+        return None
+    reference, total, number = concat
+    if not 1 <= number <= total:
+        return None
+    return reference, total, number, header_length
@@ -0,0 +1,181 @@
+# -*- test-case-name: txssmi.tests.test_server -*-
+
+import random
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from txssmi.builder import SSMIRequest, SSMICommandException
+from txssmi.commands import (
+    Ack, Nack, Seq, DrMessage, MoMessage, IMSILookupReply, ServerLogout)
+from txssmi.constants import (
+    ACK_LOGIN_OK, ACK_LINK_CHECK_RESPONSE, DR_SUCCESS)
+
+
+class SSMIServerProtocol(LineReceiver):
+    """
+    A stand-in for the SSMI gateway, for tests and benchmarks.
+
+    It logs clients in, answers link checks, replies to SMS sends with a
+    SEQ and later a DR, answers IMSI lookups and can push MOs. Its
+    behaviour is configured on :class:`SSMIServerFactory`.
+    """
+
+    delimiter = b'\r'
+    noisy = False
+
+    def __init__(self):
+        self.authenticated = False
+        self.sequence = 0
+        self.messages = 0
+        self.delayed_calls = set()
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.connections:
+            self.factory.connections.remove(self)
+        for delayed_call in self.delayed_calls:
+            delayed_call.cancel()
+        self.delayed_calls.clear()
+
+    def lineReceived(self, line):
+        try:
+            command = SSMIRequest.from_bytes(line)
+        except SSMICommandException:
+            log.err(None, 'Unable to parse %r' % (line,))
+            return self.send_command(Nack(nack_type=self.factory.nack_type))
+        if self.noisy:
+            log.msg('Server << %r' % (command,))
+        self.factory.received[command.command_name] += 1
+        if not (self.authenticated or command.command_name == 'LOGIN'):
+            return self.send_command(Nack(nack_type=self.factory.nack_type))
+        getattr(self, 'handle_%s' % (command.command_name,))(command)
+
+    def send_command(self, command):
+        if self.noisy:
+            log.msg('Server >> %r' % (command,))
+        self.factory.sent[command.command_name] += 1
+        self.sendLine(command.to_bytes())
+
+    def send_later(self, delay, command):
+        if not delay:
+            return self.send_command(command)
+
+        def send():
+            self.delayed_calls.discard(delayed_call)
+            self.send_command(command)
+
+        delayed_call = self.factory.clock.callLater(delay, send)
+        self.delayed_calls.add(delayed_call)
+
+    def next_sequence(self):
+        self.sequence += 1
+        return str(self.sequence)
+
+    def logout(self, ip='127.0.0.1'):
+        self.send_command(ServerLogout(ip=ip))
+        self.authenticated = False
+        self.transport.loseConnection()
+
+    def send_mo(self, msisdn, message):
+        self.send_command(MoMessage(msisdn=msisdn,
+                                    sequence=self.next_sequence(),
+                                    message=message))
+
+    def handle_LOGIN(self, cmd):
+        factory = self.factory
+        if ((factory.username is None or cmd.username == factory.username)
+                and (factory.password is None or
+                     cmd.password == factory.password)):
+            self.authenticated = True
+            self.send_command(Ack(ack_type=ACK_LOGIN_OK))
+        else:
+            self.send_command(Nack(nack_type=factory.nack_type))
+
+    def handle_LOGOUT(self, cmd):
+        self.authenticated = False
+        self.transport.loseConnection()
+
+    def handle_LINK_CHECK(self, cmd):
+        self.send_command(Ack(ack_type=ACK_LINK_CHECK_RESPONSE))
+
+    def handle_message(self, cmd):
+        factory = self.factory
+        self.messages += 1
+        if factory.random.random() < factory.nack_rate:
+            self.send_command(Nack(nack_type=factory.nack_type))
+        else:
+            sequence = self.next_sequence()
+            self.send_later(factory.seq_delay,
+                            Seq(msisdn=cmd.msisdn, sequence=sequence))
+            if factory.dr_delay is not None:
+                self.send_later(factory.dr_delay, DrMessage(
+                    msisdn=cmd.msisdn, sequence=sequence,
+                    ret_code=factory.dr_ret_code))
+        if (factory.logout_after is not None and
+                self.messages >= factory.logout_after):
+            self.logout()
+
+    handle_SEND_SMS = handle_message
+    handle_SEND_BINARY_SMS = handle_message
+
+    def handle_session_message(self, cmd):
+        pass
+
+    handle_SEND_USSD_MESSAGE = handle_session_message
+    handle_SEND_EXTENDED_USSD_MESSAGE = handle_session_message
+    handle_SEND_WAP_PUSH_MESSAGE = handle_session_message
+    handle_SEND_MMS_MESSAGE = handle_session_message
+
+    def handle_IMSI_LOOKUP(self, cmd):
+        self.send_later(self.factory.imsi_delay, IMSILookupReply(
+            sequence=cmd.sequence, msisdn=cmd.msisdn,
+            imsi=self.factory.imsi, spid=self.factory.spid))
+
+
+class SSMIServerFactory(ServerFactory):
+    """
+    Factory for :class:`SSMIServerProtocol`.
+
+    ``username`` and ``password`` are the accepted credentials, None
+    accepts anything. SEQs, DRs and IMSI lookup replies are sent after
+    ``seq_delay``, ``dr_delay`` and ``imsi_delay`` seconds, ``dr_delay``
+    of None sends no DRs. ``nack_rate`` is the fraction of messages
+    answered with a NACK instead of a SEQ and ``logout_after`` logs the
+    client out after that many messages.
+    """
+
+    protocol = SSMIServerProtocol
+    clock = reactor
+    nack_type = '1'
+    dr_ret_code = DR_SUCCESS
+    imsi = '655011234567890'
+    spid = '1'
+
+    def __init__(self, username=None, password=None, seq_delay=0,
+                 dr_delay=0, imsi_delay=0, nack_rate=0.0, logout_after=None,
+                 seed=None):
+        self.username = username
+        self.password = password
+        self.seq_delay = seq_delay
+        self.dr_delay = dr_delay
+        self.imsi_delay = imsi_delay
+        self.nack_rate = nack_rate
+        self.logout_after = logout_after
+        self.random = random.Random(seed)
+        self.connections = []
+        self.received = defaultdict(int)
+        self.sent = defaultdict(int)
+
+    def send_mo(self, msisdn, message):
+        """
+        Send an MO on every connected and logged in client.
+        """
+        for connection in self.connections:
+            if connection.authenticated:
+                connection.send_mo(msisdn, message)
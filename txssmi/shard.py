@@ -0,0 +1,515 @@
+# -*- test-case-name: txssmi.tests.test_shard -*-
+"""
+Spread SSMI traffic over several processes.
+
+:class:`ShardSupervisor` runs in the parent and starts ``workers`` child
+processes, each running a :class:`ShardWorker` with its own
+:class:`txssmi.pool.SSMIPool` of SSMI connections. Outbound calls are
+routed to a worker by a hash of the msisdn, so the SEQ, DR and USSD
+replies for a number are handled by one process. Inbound commands and
+metrics are sent back to the parent.
+
+Parent and workers talk over the workers' stdin and stdout, one JSON
+object per line. Workers log to stderr, which the parent logs.
+
+    python -m txssmi.shard
+"""
+
+import json
+import os
+import sys
+import zlib
+
+from twisted.internet import reactor, stdio, task
+from twisted.internet.defer import (
+    Deferred, maybeDeferred, gatherResults, FirstError)
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import Protocol, ProcessProtocol
+from twisted.python import log
+
+from txssmi.builder import SSMIException, SSMIRequest, SSMIResponse
+from txssmi.client import SSMIClientMixin
+from txssmi.constants import USSD_NEW, USSD_END, USSD_TIMEOUT
+from txssmi.metrics import InMemoryMetrics, merge_snapshots
+from txssmi.pool import SSMIPool
+
+# Inbound commands workers pass on to the parent.
+FORWARDED_COMMANDS = (
+    'MO', 'DR', 'FREE_FORM', 'BINARY_MO', 'PREMIUM_MO', 'PREMIUM_BINARY_MO',
+    'USSD_MESSAGE', 'EXTENDED_USSD_MESSAGE')
+USSD_COMMANDS = ('USSD_MESSAGE', 'EXTENDED_USSD_MESSAGE')
+
+# Pool methods the parent may call on a worker.
+WORKER_METHODS = frozenset([
+    'send_message', 'send_messages', 'send_long_message',
+    'send_binary_message', 'send_ussd_message', 'send_extended_ussd_message',
+    'send_wap_push_message', 'send_mms_message', 'imsi_lookup'])
+
+
+class RemoteError(SSMIException):
+    """
+    A call failed in a worker. ``error_type`` is the name of the
+    exception raised there.
+    """
+
+    def __init__(self, error_type, message):
+        SSMIException.__init__(self, '%s: %s' % (error_type, message))
+        self.error_type = error_type
+
+
+def shard_for(msisdn, count):
+    """
+    The worker, out of ``count``, that handles ``msisdn``. The same in
+    every process and across restarts.
+    """
+    return (zlib.crc32(msisdn.encode('utf-8')) & 0xffffffff) % count
+
+
+def encode_value(value):
+    if isinstance(value, SSMIRequest):
+        return {'request': str(value)}
+    if isinstance(value, SSMIResponse):
+        return {'response': str(value)}
+    if isinstance(value, (list, tuple)):
+        return {'list': [encode_value(item) for item in value]}
+    return {'value': value}
+
+
+def decode_value(encoded):
+    if 'request' in encoded:
+        return SSMIRequest.parse(encoded['request'])
+    if 'response' in encoded:
+        return SSMIResponse.parse(encoded['response'])
+    if 'list' in encoded:
+        return [decode_value(item) for item in encoded['list']]
+    return encoded['value']
+
+
+class Channel(Protocol):
+    """
+    Sends and receives JSON objects, one per line, on behalf of
+    ``receiver``. Works over a process transport as well as stdio.
+    """
+
+    delimiter = b'\n'
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.buffer = b''
+
+    def send(self, message):
+        self.transport.write(json.dumps(message).encode('utf-8') +
+                             self.delimiter)
+
+    def dataReceived(self, data):
+        lines = (self.buffer + data).split(self.delimiter)
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.MAX_LENGTH:
+            log.msg('Dropping message of over %s bytes.' % (
+                len(self.buffer),))
+            self.buffer = b''
+        for line in lines:
+            self.lineReceived(line)
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line.decode('utf-8'))
+        except ValueError:
+            log.err(None, 'Unparseable message: %r' % (line[:100],))
+            return
+        self.receiver.message_received(message)
+
+    def connectionLost(self, reason):
+        self.receiver.channel_lost(reason)
+
+
+class WorkerPool(SSMIPool):
+    """
+    The pool a :class:`ShardWorker` sends through, hands it every
+    member that is ready.
+    """
+
+    def __init__(self, worker, *args, **kwargs):
+        SSMIPool.__init__(self, *args, **kwargs)
+        self.worker = worker
+
+    def member_ready(self, protocol):
+        protocol = SSMIPool.member_ready(self, protocol)
+        if protocol is not None:
+            self.worker.attach(protocol)
+        return protocol
+
+
+class ShardWorker(object):
+    """
+    Runs in a worker process. Connects once the parent sends its
+    configuration, makes the calls the parent asks for and passes
+    inbound commands, in batches of up to ``event_interval`` seconds,
+    and a metrics snapshot every ``metrics_interval`` seconds back to it.
+    """
+
+    pool_class = WorkerPool
+    event_interval = 0.05
+    metrics_interval = 5
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.channel = Channel(self)
+        self.index = None
+        self.pool = None
+        self.metrics = InMemoryMetrics(clock=clock)
+        self.metrics_call = task.LoopingCall(self.report_metrics)
+        self.metrics_call.clock = clock
+        self.done = Deferred()
+
+    def make_endpoint(self, description):
+        return clientFromString(reactor, description)
+
+    def message_received(self, message):
+        if 'request' in message:
+            self.request(message)
+        elif 'config' in message:
+            self.configure(message['config'])
+        elif 'stop' in message:
+            self.stop()
+
+    def channel_lost(self, reason):
+        # The parent has gone away.
+        self.stop()
+
+    def configure(self, config):
+        self.index = config['index']
+        self.pool = self.pool_class(
+            self, self.make_endpoint(config['endpoint']),
+            config['username'], config['password'],
+            size=config['connections'])
+        d = self.pool.start()
+        d.addCallback(lambda _: self.channel.send({'ready': self.index}))
+        d.addErrback(log.err, 'Unable to start worker %s.' % (self.index,))
+        self.metrics_call.start(self.metrics_interval, now=False)
+
+    def request(self, message):
+        request_id, method = message['request'], message['method']
+        if method not in WORKER_METHODS or self.pool is None:
+            self.channel.send({'id': request_id, 'error': [
+                'SSMIException', 'Unable to call %s.' % (method,)]})
+            return
+        d = maybeDeferred(getattr(self.pool, method),
+                          *message['args'], **message['kwargs'])
+        d.addCallbacks(self.reply, self.reply_error,
+                       callbackArgs=(request_id,),
+                       errbackArgs=(request_id,))
+
+    def reply(self, result, request_id):
+        self.channel.send({'id': request_id, 'result': encode_value(result)})
+
+    def reply_error(self, failure, request_id):
+        self.channel.send({'id': request_id, 'error': [
+            failure.type.__name__, failure.getErrorMessage()]})
+
+    def attach(self, protocol):
+        protocol.metrics = self.metrics
+        protocol.register_batch_handler(
+            FORWARDED_COMMANDS, self.forward, interval=self.event_interval)
+
+    def forward(self, commands):
+        self.channel.send({'events': [str(command) for command in commands]})
+
+    def report_metrics(self):
+        self.channel.send({'metrics': self.metrics.snapshot()})
+
+    def stop(self):
+        if self.done.called:
+            return
+        if self.metrics_call.running:
+            self.metrics_call.stop()
+        if self.pool is not None:
+            self.pool.stop()
+        self.done.callback(None)
+
+
+class WorkerProcess(ProcessProtocol):
+    """
+    The parent's end of a worker process.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.channel = Channel(self)
+        self.pending = {}
+        self.next_id = 0
+        self.ready = False
+        self.metrics = None
+        self.ended = Deferred()
+
+    def __repr__(self):
+        return '<WorkerProcess %s>' % (self.index,)
+
+    def connectionMade(self):
+        self.channel.makeConnection(self.transport)
+        self.channel.send({'config': self.supervisor.worker_config(self)})
+
+    def childDataReceived(self, fd, data):
+        if fd == 1:
+            self.channel.dataReceived(data)
+        else:
+            for line in data.decode('utf-8', 'replace').splitlines():
+                log.msg('Worker %s: %s' % (self.index, line))
+
+    def request(self, method, args, kwargs):
+        self.next_id += 1
+        d = self.pending[self.next_id] = Deferred()
+        self.channel.send({'request': self.next_id, 'method': method,
+                           'args': args, 'kwargs': kwargs})
+        return d
+
+    def message_received(self, message):
+        if 'id' in message:
+            d = self.pending.pop(message['id'], None)
+            if d is None:
+                return
+            if 'error' in message:
+                d.errback(RemoteError(*message['error']))
+            else:
+                d.callback(decode_value(message['result']))
+        elif 'events' in message:
+            self.supervisor.events_received(self, message['events'])
+        elif 'metrics' in message:
+            self.metrics = message['metrics']
+        elif 'ready' in message:
+            self.ready = True
+            self.supervisor.worker_ready(self)
+
+    def channel_lost(self, reason):
+        pass
+
+    def stop(self):
+        self.channel.send({'stop': True})
+
+    def processEnded(self, reason):
+        self.ready = False
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(SSMIException('Worker %s exited.' % (self.index,)))
+        self.supervisor.worker_ended(self)
+        self.ended.callback(None)
+
+
+class ShardSupervisor(SSMIClientMixin):
+    """
+    Runs ``workers`` processes that each keep ``connections`` SSMI
+    connections to ``endpoint``, a client endpoint description such as
+    ``'tcp:host=ssmi.example.com:port=2222'``, and sends through them.
+
+    Calls are routed by a hash of their msisdn, USSD sessions the
+    network starts stay with the worker they arrived on until they end.
+    Inbound commands from every worker are dispatched to the handlers
+    registered with :meth:`register_handler`, :meth:`snapshot` adds up
+    the workers' metrics. Workers that exit are restarted after
+    ``restart_delay`` seconds.
+    """
+
+    clock = reactor
+    restart_delay = 5
+
+    def __init__(self, endpoint, username, password, workers=2,
+                 connections=1):
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.workers = [None] * workers
+        self.handlers = {}
+        self.pins = {}
+        self.ready_waiters = []
+        self.restarts = {}
+        self.running = False
+
+    def spawn_worker(self, index):
+        process = WorkerProcess(self, index)
+        reactor.spawnProcess(
+            process, sys.executable,
+            [sys.executable, '-m', 'txssmi.shard'], env=os.environ)
+        return process
+
+    def worker_config(self, worker):
+        return {
+            'index': worker.index,
+            'endpoint': self.endpoint,
+            'username': self.username,
+            'password': self.password,
+            'connections': self.connections,
+        }
+
+    def start(self):
+        """
+        Start the workers. Returns a Deferred that fires with the
+        supervisor once every worker is ready.
+        """
+        self.running = True
+        for index in range(len(self.workers)):
+            self.workers[index] = self.spawn_worker(index)
+        d = Deferred()
+        self.ready_waiters.append(d)
+        return d
+
+    def stop(self):
+        """
+        Stop the workers. Returns a Deferred that fires once they have
+        exited.
+        """
+        self.running = False
+        for delayed_call in self.restarts.values():
+            delayed_call.cancel()
+        self.restarts.clear()
+        ended = []
+        for worker in self.workers:
+            if worker is not None and not worker.ended.called:
+                worker.stop()
+                ended.append(worker.ended)
+        return gatherResults(ended)
+
+    def worker_ready(self, worker):
+        if not all(worker is not None and worker.ready
+                   for worker in self.workers):
+            return
+        waiters, self.ready_waiters = self.ready_waiters, []
+        for d in waiters:
+            d.callback(self)
+
+    def worker_ended(self, worker):
+        log.msg('Worker %s exited.' % (worker.index,))
+        for msisdn, index in list(self.pins.items()):
+            if index == worker.index:
+                del self.pins[msisdn]
+        if not self.running or self.workers[worker.index] is not worker:
+            return
+
+        def restart():
+            del self.restarts[worker.index]
+            self.workers[worker.index] = self.spawn_worker(worker.index)
+
+        self.restarts[worker.index] = self.clock.callLater(
+            self.restart_delay, restart)
+
+    def worker_for(self, msisdn):
+        index = self.pins.get(msisdn)
+        if index is None:
+            index = shard_for(msisdn, len(self.workers))
+        return self.worker_at(index)
+
+    def worker_at(self, index):
+        worker = self.workers[index]
+        if worker is None or not worker.ready:
+            raise SSMIException('Worker %s is not ready.' % (index,))
+        return worker
+
+    def call(self, method, *args, **kwargs):
+        return maybeDeferred(
+            lambda: self.worker_for(args[0]).request(
+                method, list(args), kwargs))
+
+    def send_messages(self, messages, validity='0'):
+        """
+        Send an SMS for each ``(msisdn, message)`` pair in ``messages``,
+        in one bulk call per worker. Returns a Deferred that fires with
+        every command sent.
+        """
+        shards = {}
+        for msisdn, message in messages:
+            shards.setdefault(
+                shard_for(msisdn, len(self.workers)), []).append(
+                    [msisdn, message])
+
+        def send(index, shard):
+            return maybeDeferred(
+                lambda: self.worker_at(index).request(
+                    'send_messages', [shard], {'validity': validity}))
+
+        d = gatherResults(
+            [send(index, shard) for index, shard in sorted(shards.items())],
+            consumeErrors=True)
+        d.addCallbacks(
+            lambda results: [command for sent in results for command in sent],
+            self.first_failure)
+        return d
+
+    def first_failure(self, failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+
+    def send_session_message(self, method, msisdn, message, session_type,
+                             *args):
+        d = self.call(method, msisdn, message, session_type, *args)
+        if session_type == USSD_END:
+            self.pins.pop(msisdn, None)
+        return d
+
+    def send_ussd_message(self, msisdn, message, session_type):
+        return self.send_session_message(
+            'send_ussd_message', msisdn, message, session_type)
+
+    def send_extended_ussd_message(self, msisdn, message, session_type,
+                                   genfields):
+        return self.send_session_message(
+            'send_extended_ussd_message', msisdn, message, session_type,
+            genfields)
+
+    def register_handler(self, command_name, handler):
+        """
+        Call ``handler`` with every ``command_name`` command any worker
+        receives.
+        """
+        if command_name not in FORWARDED_COMMANDS:
+            raise SSMIException(
+                'Command not forwarded by workers: %s' % (command_name,))
+        self.handlers.setdefault(command_name, []).append(handler)
+        return handler
+
+    def unregister_handler(self, command_name, handler):
+        handlers = self.handlers.get(command_name, [])
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def events_received(self, worker, lines):
+        for line in lines:
+            command = SSMIResponse.parse(line)
+            command_name = command.command_name
+            if command_name in USSD_COMMANDS:
+                if command.type == USSD_NEW:
+                    self.pins[command.msisdn] = worker.index
+                elif command.type in (USSD_END, USSD_TIMEOUT):
+                    self.pins.pop(command.msisdn, None)
+            for handler in self.handlers.get(command_name, ()):
+                try:
+                    handler(command)
+                except Exception:
+                    log.err(None, 'Error in %s handler %r.' % (
+                        command_name, handler))
+
+    def snapshot(self):
+        """
+        The workers' latest metrics added up, see
+        :func:`txssmi.metrics.merge_snapshots`.
+        """
+        snapshot = merge_snapshots(
+            worker.metrics for worker in self.workers
+            if worker is not None and worker.metrics is not None)
+        snapshot['workers'] = len(self.workers)
+        snapshot['ready'] = sum(
+            1 for worker in self.workers if worker is not None and
+            worker.ready)
+        return snapshot
+
+
+def main(reactor):
+    log.startLogging(sys.stderr)
+    worker = ShardWorker(clock=reactor)
+    stdio.StandardIO(worker.channel, reactor=reactor)
+    return worker.done
+
+
+if __name__ == '__main__':
+    task.react(main)
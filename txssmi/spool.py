@@ -0,0 +1,290 @@
+# -*- test-case-name: txssmi.tests.test_spool -*-
+
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict, deque
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from txssmi.builder import SSMIRequest, encode, decode
+from txssmi.commands import SendSMS
+from txssmi.scheduler import LANE_SMS
+
+
+class Spool(object):
+    """
+    Append-only on-disk queue of outbound commands.
+
+    Every command appended to the file at ``path`` gets an increasing
+    record id, acknowledged ids are appended to ``path + '.acks'``. On
+    start up both files are read back through ``mmap`` and whatever has
+    not been acknowledged is pending again, a record or ack torn by a
+    crash is dropped along with anything after it. Once
+    ``compact_after`` records have been acknowledged, and they outnumber
+    the pending ones, the data file is rewritten with only the pending
+    records and the acks are cleared.
+
+    Writes are flushed to the operating system, which survives a process
+    restart. Set ``sync`` to also fsync them, to survive a power failure.
+    """
+
+    record_header = struct.Struct('>QII')
+    ack_record = struct.Struct('>Q')
+
+    def __init__(self, path, sync=False, compact_after=10000):
+        self.path = path
+        self.ack_path = path + '.acks'
+        self.sync = sync
+        self.compact_after = compact_after
+        self.pending = OrderedDict()
+        self.acked = 0
+        self.next_id = 1
+        self.recover()
+        self.data_file = open(self.path, 'ab')
+        self.ack_file = open(self.ack_path, 'ab')
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __iter__(self):
+        """
+        Iterate over ``(record_id, command)`` for every pending record,
+        oldest first.
+        """
+        return iter(list(self.pending.items()))
+
+    def get(self, record_id):
+        return self.pending.get(record_id)
+
+    def map_file(self, path):
+        """
+        Map ``path`` read only, returns an empty string for an empty or
+        missing file.
+        """
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return b''
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close_map(self, mapped):
+        if not isinstance(mapped, bytes):
+            mapped.close()
+
+    def read_records(self, data):
+        """
+        Returns the ``(record_id, payload)`` pairs in ``data`` and the
+        length of the valid records.
+        """
+        records = []
+        header_size = self.record_header.size
+        position = 0
+        while position + header_size <= len(data):
+            record_id, length, checksum = self.record_header.unpack_from(
+                data, position)
+            end = position + header_size + length
+            payload = data[position + header_size:end]
+            if end > len(data) or zlib.crc32(payload) & 0xffffffff != checksum:
+                break
+            records.append((record_id, payload))
+            position = end
+        return records, position
+
+    def recover(self):
+        mapped = self.map_file(self.ack_path)
+        size = self.ack_record.size
+        total = len(mapped)
+        valid = total - total % size
+        acks = set(self.ack_record.unpack_from(mapped, offset)[0]
+                   for offset in range(0, valid, size))
+        self.close_map(mapped)
+        if valid < total:
+            # Acks appended after a torn one would be read out of step.
+            log.msg('Truncating spool acks %s at %s of %s bytes.' % (
+                self.ack_path, valid, total))
+            with open(self.ack_path, 'r+b') as f:
+                f.truncate(valid)
+
+        mapped = self.map_file(self.path)
+        records, valid = self.read_records(mapped)
+        total = len(mapped)
+        self.close_map(mapped)
+        if valid < total:
+            log.msg('Truncating spool %s at %s of %s bytes.' % (
+                self.path, valid, total))
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+
+        for record_id, payload in records:
+            if record_id not in acks:
+                self.pending[record_id] = self.decode(payload)
+        self.next_id = max(
+            [record_id for record_id, _ in records] + list(acks) + [0]) + 1
+
+    def encode(self, command):
+        return encode(str(command), 'utf-8')
+
+    def decode(self, payload):
+        return SSMIRequest.parse(decode(payload, 'utf-8'))
+
+    def write(self, f, data):
+        f.write(data)
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+
+    def pack(self, record_id, payload):
+        return self.record_header.pack(
+            record_id, len(payload),
+            zlib.crc32(payload) & 0xffffffff) + payload
+
+    def append(self, command):
+        """
+        Store ``command`` and return its record id.
+        """
+        record_id = self.next_id
+        self.next_id += 1
+        self.write(self.data_file, self.pack(record_id, self.encode(command)))
+        self.pending[record_id] = command
+        return record_id
+
+    def ack(self, record_id):
+        """
+        Mark ``record_id`` as delivered, it will not be pending again.
+        """
+        if self.pending.pop(record_id, None) is None:
+            return
+        self.write(self.ack_file, self.ack_record.pack(record_id))
+        self.acked += 1
+        if self.acked >= self.compact_after and self.acked > len(self.pending):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the data file with only the pending records and clear the
+        acks.
+        """
+        compact_path = self.path + '.compact'
+        with open(compact_path, 'wb') as f:
+            f.write(b''.join(
+                self.pack(record_id, self.encode(command))
+                for record_id, command in self.pending.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        self.data_file.close()
+        os.rename(compact_path, self.path)
+        self.data_file = open(self.path, 'ab')
+        # Acks left behind by a crash at this point refer to records that
+        # are gone, recover() starts new ids past them.
+        self.ack_file.close()
+        self.ack_file = open(self.ack_path, 'wb')
+        self.acked = 0
+
+    def close(self):
+        self.data_file.close()
+        self.ack_file.close()
+
+
+class SpoolSender(object):
+    """
+    Sends the commands in a :class:`Spool` over an authenticated
+    :class:`txssmi.protocol.SSMIProtocol`, keeping at most
+    ``max_in_flight`` of them waiting for a reply.
+
+    Commands are only acknowledged in the spool once the server has
+    answered them with a SEQ, or once written for commands that get no
+    SEQ. Commands that are not acknowledged by the time the connection is
+    lost are sent again on the next protocol attached, possibly after a
+    restart, so they may be delivered twice but are never lost.
+    """
+
+    max_in_flight = 1000
+    # Seconds to wait before sending commands that failed again.
+    retry_delay = 5
+
+    def __init__(self, spool, lane=LANE_SMS, clock=reactor):
+        self.spool = spool
+        self.lane = lane
+        self.clock = clock
+        self.protocol = None
+        self.queue = deque()
+        self.in_flight = set()
+        self.retry_call = None
+
+    def attach(self, protocol):
+        """
+        Send everything pending in the spool, and anything added later,
+        over ``protocol`` until it disconnects.
+        """
+        self.protocol = protocol
+        self.queue = deque(record_id for record_id, _ in self.spool)
+        self.in_flight = set()
+        protocol.wait_for_disconnect().addCallback(
+            lambda _: self.detach(protocol))
+        self.drain()
+
+    def detach(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+            self.queue.clear()
+            self.in_flight.clear()
+            if self.retry_call is not None:
+                self.retry_call.cancel()
+                self.retry_call = None
+
+    def send_command(self, command):
+        """
+        Spool ``command`` and send it if a protocol is attached. Returns
+        its record id.
+        """
+        record_id = self.spool.append(command)
+        if self.protocol is not None:
+            self.queue.append(record_id)
+            self.drain()
+        return record_id
+
+    def send_message(self, msisdn, message, validity='0'):
+        return self.send_command(
+            SendSMS(msisdn=msisdn, message=message, validity=validity))
+
+    def drain(self):
+        protocol = self.protocol
+        while (protocol is not None and self.queue and
+               len(self.in_flight) < self.max_in_flight):
+            record_id = self.queue.popleft()
+            command = self.spool.get(record_id)
+            if command is None:
+                continue
+            self.in_flight.add(record_id)
+            if command.command_name in protocol.sequenced_commands:
+                d = protocol.send_sequenced(command, lane=self.lane)
+            else:
+                d = protocol.send_command(command, lane=self.lane)
+            d.addCallbacks(self.delivered, self.failed,
+                           callbackArgs=(protocol, record_id),
+                           errbackArgs=(protocol, record_id))
+
+    def delivered(self, result, protocol, record_id):
+        self.spool.ack(record_id)
+        if self.protocol is protocol:
+            self.in_flight.discard(record_id)
+            self.drain()
+
+    def failed(self, failure, protocol, record_id):
+        if self.protocol is not protocol:
+            # Sent again once the next protocol is attached.
+            return
+        log.err(failure, 'Unable to deliver spooled record %s.' % (
+            record_id,))
+        # Retried after the commands already waiting.
+        self.in_flight.discard(record_id)
+        self.queue.append(record_id)
+        if self.retry_call is None:
+            self.retry_call = self.clock.callLater(
+                self.retry_delay, self.retry)
+
+    def retry(self):
+        self.retry_call = None
+        self.drain()
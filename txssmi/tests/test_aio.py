@@ -0,0 +1,400 @@
+import asyncio
+import binascii
+
+from twisted.trial.unittest import TestCase
+
+from txssmi.aio import SSMIAsyncProtocol, ReplyStore, connect
+from txssmi.builder import (
+    SSMIRequest, SSMIException, SSMICommandException, CommandNacked)
+from txssmi.commands import (
+    Ack, Nack, Seq, IMSILookupReply, MoMessage, Login)
+from txssmi.constants import (
+    ACK_LINK_CHECK_RESPONSE, ACK_LOGIN_OK, CODING_7BIT, PROTOCOL_ENHANCED,
+    USSD_NEW)
+from txssmi.segment import Segmenter
+
+
+class FakeTransport(asyncio.Transport):
+
+    def __init__(self):
+        asyncio.Transport.__init__(self)
+        self.writes = []
+        self.closed = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def commands(self):
+        data, self.writes = b''.join(self.writes), []
+        return [SSMIRequest.from_bytes(line)
+                for line in data.split(b'\r') if line]
+
+
+class AsyncProtocolTestCase(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.protocol = SSMIAsyncProtocol(self.loop)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def send(self, command):
+        self.protocol.data_received(command.to_bytes() + b'\r')
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    def test_send_message(self):
+        async def test():
+            await self.protocol.send_message(
+                '2700000000', 'foo, bar', validity='2')
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(cmd.command_name, 'SEND_SMS')
+            self.assertEqual(cmd.msisdn, '2700000000')
+            self.assertEqual(cmd.message, 'foo, bar')
+            self.assertEqual(cmd.validity, '2')
+        self.run_async(test())
+
+    def test_send_messages_written_together(self):
+        async def test():
+            messages = [('27000000%02d' % (i,), 'hi %s' % (i,))
+                        for i in range(10)]
+            sent = await self.protocol.send_messages(iter(messages))
+            await self.settle()
+            self.assertEqual(len(self.transport.writes), 1)
+            cmds = self.transport.commands()
+            self.assertEqual(cmds, sent)
+            self.assertEqual(
+                [(cmd.msisdn, cmd.message) for cmd in cmds], messages)
+        self.run_async(test())
+
+    def test_send_unencodable(self):
+        async def test():
+            await self.protocol.send_message('2700000000', u'ሴ')
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(cmd.message, '?')
+        self.run_async(test())
+
+    def test_authenticate(self):
+        async def test():
+            task = self.loop.create_task(
+                self.protocol.authenticate('username', 'password'))
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(
+                cmd, Login(username='username', password='password'))
+            self.send(Ack(ack_type=ACK_LOGIN_OK))
+            ack = await task
+            self.assertEqual(ack.ack_type, ACK_LOGIN_OK)
+            self.assertTrue(self.protocol.authenticated)
+        self.run_async(test())
+
+    def test_authenticate_nack(self):
+        async def test():
+            task = self.loop.create_task(
+                self.protocol.authenticate('username', 'password'))
+            await self.settle()
+            self.send(Nack(nack_type='1'))
+            await task
+            self.assertFalse(self.protocol.authenticated)
+        self.run_async(test())
+
+    def test_link_check_ack_not_queued(self):
+        self.send(Ack(ack_type=ACK_LINK_CHECK_RESPONSE))
+        self.assertTrue(self.protocol.events.empty())
+
+    def test_send_binary_message(self):
+        async def test():
+            task = self.loop.create_task(self.protocol.send_binary_message(
+                '2700000000', '68656c6c6f'))
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(cmd.command_name, 'SEND_BINARY_SMS')
+            self.assertEqual(binascii.unhexlify(cmd.hex_msg), b'hello')
+            self.assertFalse(task.done())
+            self.send(Seq(msisdn='2700000000', sequence='1'))
+            seq = await task
+            self.assertEqual(seq.sequence, '1')
+        self.run_async(test())
+
+    def test_send_long_message(self):
+        self.patch(self.protocol, 'segmenter', Segmenter())
+
+        async def test():
+            task = self.loop.create_task(
+                self.protocol.send_long_message('2700000000', 'x' * 200))
+            await self.settle()
+            parts = self.transport.commands()
+            self.assertEqual([cmd.pid for cmd in parts],
+                             [PROTOCOL_ENHANCED] * 2)
+            self.assertEqual([cmd.coding for cmd in parts],
+                             [CODING_7BIT] * 2)
+            self.assertEqual([cmd.hex_msg[:12] for cmd in parts],
+                             ['050003010201', '050003010202'])
+            self.send(Seq(msisdn='2700000000', sequence='1'))
+            self.send(Seq(msisdn='2700000000', sequence='2'))
+            seqs = await task
+            self.assertEqual([seq.sequence for seq in seqs], ['1', '2'])
+        self.run_async(test())
+
+    def test_reply_timeout(self):
+        self.patch(self.protocol, 'reply_timeout', 0.01)
+
+        async def test():
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.protocol.send_binary_message(
+                    '2700000000', '68656c6c6f')
+            # The late SEQ is dropped rather than kept for the next send.
+            self.send(Seq(msisdn='2700000000', sequence='1'))
+            self.assertEqual(len(self.protocol.sequence_replies), 0)
+        self.run_async(test())
+
+    def test_untracked_seq_not_taken(self):
+        async def test():
+            await self.protocol.send_message('2700000000', 'hello')
+            await self.settle()
+            self.send(Seq(msisdn='2700000000', sequence='1'))
+            task = self.loop.create_task(self.protocol.send_binary_message(
+                '2700000000', '68656c6c6f'))
+            await self.settle()
+            self.assertFalse(task.done())
+            self.send(Seq(msisdn='2700000000', sequence='2'))
+            seq = await task
+            self.assertEqual(seq.sequence, '2')
+        self.run_async(test())
+
+    def test_nack_fails_oldest(self):
+        async def test():
+            first = self.loop.create_task(self.protocol.send_binary_message(
+                '2700000000', '68656c6c6f'))
+            await self.settle()
+            self.send(Nack(nack_type='1'))
+            with self.assertRaises(CommandNacked):
+                await first
+            second = self.loop.create_task(self.protocol.send_binary_message(
+                '2700000000', '68656c6c6f'))
+            await self.settle()
+            self.send(Seq(msisdn='2700000000', sequence='42'))
+            seq = await second
+            self.assertEqual(seq.sequence, '42')
+            self.assertTrue(self.protocol.events.empty())
+        self.run_async(test())
+
+    def test_imsi_lookup(self):
+        async def test():
+            task = self.loop.create_task(
+                self.protocol.imsi_lookup('2700000000', imsi='12345'))
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(cmd.command_name, 'IMSI_LOOKUP')
+            self.assertEqual(cmd.sequence, '1')
+            self.assertEqual(cmd.imsi, '12345')
+            reply = IMSILookupReply(sequence='1', msisdn='2700000000',
+                                    imsi='12345', spid='spid')
+            self.send(reply)
+            self.assertEqual(await task, reply)
+        self.run_async(test())
+
+    def test_imsi_lookup_not_sent(self):
+        async def test():
+            self.transport.close()
+            with self.assertRaises(ConnectionError):
+                await self.protocol.imsi_lookup('2700000000')
+            self.assertEqual(self.protocol.imsi_lookup_replies.waiters, {})
+        self.run_async(test())
+
+    def test_imsi_lookup_skips_pending_sequences(self):
+        self.protocol.imsi_lookup_replies.wait('1')
+        self.assertEqual(self.protocol.allocate_imsi_sequence(), '2')
+
+    def test_send_extended_ussd_message(self):
+        async def test():
+            await self.protocol.send_extended_ussd_message(
+                '2700000000', 'hello world', USSD_NEW, ['foo', 'bar'])
+            await self.settle()
+            [cmd] = self.transport.commands()
+            self.assertEqual(cmd.command_name, 'SEND_EXTENDED_USSD_MESSAGE')
+            self.assertEqual(cmd.genfields, 'foo:bar')
+            with self.assertRaises(SSMICommandException):
+                await self.protocol.send_extended_ussd_message(
+                    '2700000000', 'hello world', 'x', [])
+        self.run_async(test())
+
+    def test_connection_lost_fails_waiters(self):
+        async def test():
+            task = self.loop.create_task(self.protocol.send_binary_message(
+                '2700000000', '68656c6c6f'))
+            await self.settle()
+            self.protocol.connection_lost(None)
+            with self.assertRaises(ConnectionError):
+                await task
+        self.run_async(test())
+
+    def test_paused_writing(self):
+        async def test():
+            self.protocol.pause_writing()
+            task = self.loop.create_task(
+                self.protocol.send_message('2700000000', 'hello'))
+            await self.settle()
+            self.assertFalse(task.done())
+            self.assertEqual(self.transport.writes, [])
+            self.protocol.resume_writing()
+            await task
+            await self.settle()
+            self.assertEqual(len(self.transport.commands()), 1)
+        self.run_async(test())
+
+    def test_data_received_partial_lines(self):
+        received = []
+        self.protocol.register_handler('MO', received.append)
+        data = b''.join(
+            MoMessage(msisdn='2700000000', sequence=str(i),
+                      message='hi').to_bytes() + b'\r'
+            for i in range(3))
+        self.protocol.data_received(data[:10])
+        self.protocol.data_received(data[10:-5])
+        self.assertEqual(len(received), 2)
+        self.protocol.data_received(data[-5:])
+        self.assertEqual([mo.sequence for mo in received], ['0', '1', '2'])
+
+    def test_consumer_error_logged(self):
+        received = []
+
+        def fail(mo):
+            raise ValueError(mo.sequence)
+
+        self.protocol.register_handler('MO', fail)
+        self.protocol.register_handler('MO', received.append)
+        data = b''.join(
+            MoMessage(msisdn='2700000000', sequence=str(i),
+                      message='hi').to_bytes() + b'\r'
+            for i in range(2))
+        with self.assertLogs('txssmi.aio', 'ERROR') as logs:
+            self.protocol.data_received(data)
+        self.assertEqual([mo.sequence for mo in received], ['0', '1'])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_handler_error_logged(self):
+        received = []
+        self.patch(self.protocol, 'handlers', dict(
+            self.protocol.handlers, MO=lambda mo: 1 / 0))
+        self.protocol.register_handler('MO', received.append)
+        with self.assertLogs('txssmi.aio', 'ERROR'):
+            self.send(MoMessage(msisdn='2700000000', sequence='1',
+                                message='hi'))
+        self.assertEqual(len(received), 1)
+
+    def test_data_received_line_too_long(self):
+        self.patch(self.protocol, 'MAX_LENGTH', 10)
+        self.protocol.data_received(b'x' * 11)
+        self.assertTrue(self.transport.closed)
+
+    def test_register_unknown_handler(self):
+        self.assertRaises(
+            SSMICommandException,
+            self.protocol.register_handler, 'FOO', lambda cmd: None)
+
+
+class ReplyStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.store = ReplyStore(self.loop)
+
+    def test_unwaited_reply_dropped(self):
+        self.store.put('a', 1)
+        future = self.store.wait('a')
+        self.assertFalse(future.done())
+        self.store.put('a', 2)
+        self.assertEqual(future.result(), 2)
+
+    def test_fifo(self):
+        first = self.store.wait('a')
+        second = self.store.wait('a')
+        self.store.put('a', 1)
+        self.store.put('a', 2)
+        self.assertEqual((first.result(), second.result()), (1, 2))
+        self.assertNotIn('a', self.store)
+
+    def test_cancelled_waiter_skipped(self):
+        first = self.store.wait('a')
+        second = self.store.wait('a')
+        first.cancel()
+        self.store.put('a', 1)
+        self.assertEqual(second.result(), 1)
+
+
+class ConnectTestCase(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def serve(self, ack_type):
+        class Server(asyncio.Protocol):
+
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def data_received(self, data):
+                self.transport.write(
+                    Ack(ack_type=ack_type).to_bytes() + b'\r')
+
+        return self.loop.create_server(Server, '127.0.0.1', 0)
+
+    def test_connect(self):
+        async def test():
+            server = await self.serve(ACK_LOGIN_OK)
+            port = server.sockets[0].getsockname()[1]
+            protocol = await connect(
+                '127.0.0.1', port, 'username', 'password')
+            self.assertTrue(protocol.authenticated)
+            protocol.transport.close()
+            await protocol.disconnected
+            server.close()
+            await server.wait_closed()
+        self.loop.run_until_complete(test())
+
+    def test_connect_login_failed(self):
+        async def test():
+            server = await self.serve(ACK_LINK_CHECK_RESPONSE)
+            port = server.sockets[0].getsockname()[1]
+            self.patch(SSMIAsyncProtocol, 'reply_timeout', 0.05)
+            with self.assertRaises(asyncio.TimeoutError):
+                await connect('127.0.0.1', port, 'username', 'password')
+            server.close()
+            await server.wait_closed()
+        self.loop.run_until_complete(test())
+
+    def test_connect_nack(self):
+        async def test():
+            class NackServer(asyncio.Protocol):
+                def connection_made(self, transport):
+                    self.transport = transport
+
+                def data_received(self, data):
+                    self.transport.write(
+                        Nack(nack_type='1').to_bytes() + b'\r')
+
+            server = await self.loop.create_server(
+                NackServer, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            with self.assertRaises(SSMIException):
+                await connect('127.0.0.1', port, 'username', 'password')
+            server.close()
+            await server.wait_closed()
+        self.loop.run_until_complete(test())
@@ -0,0 +1,146 @@
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIException, SSMIRequest
+from txssmi.client import SSMIClientFactory
+from txssmi.commands import Ack, Nack, Seq, DrMessage
+from txssmi.protocol import SSMIProtocol
+
+
+class FakeConnector(object):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.protocols = []
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        self.protocols.append(protocol)
+        return protocol
+
+    def stopConnecting(self):
+        pass
+
+
+class SSMIClientFactoryTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.factory = SSMIClientFactory('username', 'password')
+        self.factory.clock = self.clock
+        self.connector = FakeConnector(self.factory)
+
+    def reply(self, protocol, command):
+        protocol.lineReceived(str(command))
+
+    def connect(self):
+        protocol = self.connector.connect()
+        self.reply(protocol, Ack(ack_type='1'))
+        return protocol
+
+    def disconnect(self, protocol):
+        reason = Failure(ConnectionLost())
+        protocol.connectionLost(reason)
+        self.factory.clientConnectionLost(self.connector, reason)
+
+    def sent(self, protocol):
+        return [SSMIRequest.from_bytes(line)
+                for line in protocol.transport.value().split(b'\r') if line]
+
+    def test_authenticate_on_connect(self):
+        protocol = self.connector.connect()
+        [login] = self.sent(protocol)
+        self.assertEqual(login.command_name, 'LOGIN')
+        self.assertEqual(login.username, 'username')
+        self.assertEqual(self.factory.client, None)
+        self.reply(protocol, Ack(ack_type='1'))
+        self.assertEqual(self.factory.client, protocol)
+        self.assertTrue(protocol.link_check.running)
+
+    def test_authentication_failed(self):
+        protocol = self.connector.connect()
+        self.reply(protocol, Nack(nack_type='1'))
+        self.assertEqual(self.factory.client, None)
+        self.assertTrue(protocol.transport.disconnecting)
+
+    def test_wait_for_client(self):
+        d = self.factory.wait_for_client()
+        self.assertNoResult(d)
+        protocol = self.connect()
+        self.assertEqual(self.successResultOf(d), protocol)
+        self.assertEqual(
+            self.successResultOf(self.factory.wait_for_client()), protocol)
+
+    def test_send_before_connected(self):
+        d = self.factory.send_message('2700000000', 'foo')
+        protocol = self.connect()
+        cmd = self.successResultOf(d)
+        self.assertEqual(cmd.message, 'foo')
+        self.assertEqual(self.sent(protocol)[-1], cmd)
+
+    def test_reconnect(self):
+        protocol = self.connect()
+        self.disconnect(protocol)
+        self.assertEqual(self.factory.client, None)
+        self.assertFalse(protocol.link_check.running)
+        self.clock.advance(self.factory.maxDelay)
+        self.assertEqual(len(self.connector.protocols), 2)
+        new_protocol = self.connector.protocols[1]
+        self.reply(new_protocol, Ack(ack_type='1'))
+        self.assertEqual(self.factory.client, new_protocol)
+        self.assertEqual(self.factory.delay, self.factory.initialDelay)
+
+    def test_fail_fast(self):
+        self.factory.replay = False
+        protocol = self.connect()
+        d = self.factory.send_binary_message('2700000000', 'ff')
+        self.assertNoResult(d)
+        self.disconnect(protocol)
+        self.failureResultOf(d, ConnectionLost)
+
+    def test_replay(self):
+        protocol = self.connect()
+        d = self.factory.send_binary_message('2700000000', 'ff')
+        self.disconnect(protocol)
+        self.assertNoResult(d)
+        self.clock.advance(self.factory.maxDelay)
+        new_protocol = self.connector.protocols[1]
+        self.reply(new_protocol, Ack(ack_type='1'))
+        [_, cmd] = self.sent(new_protocol)
+        self.assertEqual(cmd.command_name, 'SEND_BINARY_SMS')
+        self.assertEqual(cmd.hex_msg, 'ff')
+        self.reply(new_protocol, Seq(msisdn='2700000000', sequence='1'))
+        self.assertEqual(self.successResultOf(d).sequence, '1')
+
+    def test_replay_limit(self):
+        self.factory.max_replays = 1
+        d = self.factory.send_binary_message('2700000000', 'ff')
+        self.disconnect(self.connect())
+        self.assertNoResult(d)
+        self.disconnect(self.connect())
+        self.failureResultOf(d, ConnectionLost)
+
+    def test_stop_trying(self):
+        d = self.factory.wait_for_client()
+        self.factory.stopTrying()
+        self.failureResultOf(d, SSMIException)
+        self.failureResultOf(self.factory.wait_for_client(), SSMIException)
+
+    def test_shared_deliveries(self):
+        protocol = self.connect()
+        protocol.lineReceived(str(Seq(msisdn='2700000000', sequence='1')))
+        self.disconnect(protocol)
+        self.clock.advance(self.factory.maxDelay)
+        new_protocol = self.connector.protocols[1]
+        self.reply(new_protocol, Ack(ack_type='1'))
+        self.assertIdentical(new_protocol.deliveries, protocol.deliveries)
+        new_protocol.lineReceived(str(DrMessage(
+            msisdn='2700000000', sequence='1', ret_code='0')))
+        delivery = self.factory.deliveries.get('2700000000', '1')
+        self.assertTrue(delivery.reported)
+        self.assertEqual(delivery.seq_at, 0)
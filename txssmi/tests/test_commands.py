@@ -1,6 +1,7 @@
 from twisted.trial.unittest import TestCase
 
-from txssmi.builder import SSMIRequest, SSMICommandException
+from txssmi.builder import SSMIRequest, SSMIResponse, SSMICommandException
+from txssmi.commands import Login, MoMessage
 
 
 class SSMICommandTestCase(TestCase):
@@ -39,3 +40,55 @@ class SSMICommandTestCase(TestCase):
             SSMICommandException,
             'Too few parameters for command: LOGIN \(expected 2 got 1\)',
             SSMIRequest.parse, 'SSMI,1,foo')
+
+    def test_parse_unknown_command_id(self):
+        self.assertRaisesRegexp(
+            SSMICommandException, 'Unknown command id: 12345.',
+            SSMIRequest.parse, 'SSMI,12345,foo')
+
+    def test_parse_registered_class(self):
+        self.assertTrue(isinstance(SSMIRequest.parse('SSMI,1,foo,bar'), Login))
+        self.assertTrue(isinstance(
+            SSMIResponse.parse('SSMI,103,2700000000,1,foo'), MoMessage))
+
+    def test_parse_reuses_class(self):
+        cmd1 = SSMIResponse.parse('SSMI,101,1')
+        cmd2 = SSMIResponse.parse('SSMI,101,2')
+        self.assertTrue(cmd1.__class__ is cmd2.__class__)
+
+    def test_from_values(self):
+        LoginRequest = SSMIRequest.create('LOGIN')
+        login = LoginRequest.from_values(['foo', 'bar'])
+        self.assertEqual(login, LoginRequest(username='foo', password='bar'))
+
+    def test_slots(self):
+        login = Login(username='foo', password='bar')
+        self.assertFalse(hasattr(login, '__dict__'))
+        self.assertEqual(login.values, {'username': 'foo', 'password': 'bar'})
+
+    def test_equality(self):
+        login = Login(username='foo', password='bar')
+        self.assertEqual(login, Login(username='foo', password='bar'))
+        self.assertNotEqual(login, Login(username='foo', password='baz'))
+        self.assertNotEqual(
+            MoMessage(msisdn='foo', sequence='1', message='bar'),
+            Login(username='foo', password='bar'))
+
+    def test_hash(self):
+        cmds = set([
+            Login(username='foo', password='bar'),
+            SSMIRequest.parse('SSMI,1,foo,bar'),
+            Login(username='foo', password='baz'),
+        ])
+        self.assertEqual(len(cmds), 2)
+
+    def test_to_bytes(self):
+        login = Login(username='foo', password='bar')
+        self.assertEqual(login.to_bytes(), b'SSMI,1,foo,bar')
+        self.assertEqual(SSMIRequest.from_bytes(login.to_bytes()), login)
+
+    def test_from_bytes_latin1(self):
+        mo = MoMessage(msisdn='foo', sequence='1', message=u'caf\xe9')
+        data = mo.to_bytes()
+        self.assertEqual(data, b'SSMI,103,foo,1,caf\xe9')
+        self.assertEqual(SSMIResponse.from_bytes(memoryview(data)), mo)
@@ -0,0 +1,337 @@
+from twisted.internet.defer import TimeoutError, CancelledError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIException
+from txssmi.commands import Nack, Seq, SendSMS
+from txssmi.correlation import (
+    CorrelationStore, CorrelationEvicted, CommandNacked, SeqTracker,
+    SequenceAllocator, DeliveryIndex)
+
+
+class CorrelationStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.store = CorrelationStore(max_size=3, ttl=10, clock=self.clock)
+
+    def test_wait_then_put(self):
+        d = self.store.wait('a')
+        self.assertNoResult(d)
+        self.assertEqual(len(self.store), 1)
+        self.store.put('a', 'reply')
+        self.assertEqual(self.successResultOf(d), 'reply')
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.hits, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_put_then_wait(self):
+        self.store.put('a', 'reply')
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.successResultOf(self.store.wait('a')), 'reply')
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.hits, 1)
+
+    def test_fifo_per_key(self):
+        d1 = self.store.wait('a')
+        d2 = self.store.wait('a')
+        self.store.put('a', 1)
+        self.store.put('a', 2)
+        self.assertEqual(self.successResultOf(d1), 1)
+        self.assertEqual(self.successResultOf(d2), 2)
+
+    def test_waiter_timeout(self):
+        d = self.store.wait('a')
+        self.clock.advance(10)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.expiries, 1)
+        self.store.put('a', 'late')
+        self.assertEqual(len(self.store), 1)
+
+    def test_waiter_custom_timeout(self):
+        d = self.store.wait('a', timeout=1)
+        self.clock.advance(1)
+        self.failureResultOf(d, TimeoutError)
+
+    def test_reply_expiry(self):
+        self.store.put('a', 'reply')
+        self.clock.advance(10)
+        d = self.store.wait('a')
+        self.assertNoResult(d)
+        self.assertEqual(self.store.expiries, 1)
+        self.assertEqual(len(self.store), 1)
+
+    def test_cancel(self):
+        d = self.store.wait('a')
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_evict_replies_first(self):
+        d = self.store.wait('a')
+        self.store.put('b', 1)
+        self.store.put('c', 2)
+        self.store.put('d', 3)
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.evictions, 1)
+        self.assertEqual(list(self.store.replies.keys()), ['c', 'd'])
+        self.assertNoResult(d)
+
+    def test_evict_least_recently_used_waiter(self):
+        d1 = self.store.wait('a')
+        d2 = self.store.wait('b')
+        self.store.wait('a')
+        self.store.wait('c')
+        self.failureResultOf(d2, CorrelationEvicted)
+        self.assertNoResult(d1)
+        self.assertEqual(self.store.evictions, 1)
+        self.assertEqual(len(self.store), 3)
+
+    def test_fail_all(self):
+        d = self.store.wait('a')
+        self.store.put('b', 1)
+        self.store.fail_all(ValueError('foo'))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class SeqTrackerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.tracker = SeqTracker(max_size=3, timeout=10, clock=self.clock)
+
+    def sms(self, msisdn='2700000000'):
+        return SendSMS(msisdn=msisdn, message='hi', validity='0')
+
+    def seq(self, sequence, msisdn='2700000000'):
+        self.tracker.seq_received(Seq(msisdn=msisdn, sequence=sequence))
+
+    def test_seqs_in_write_order(self):
+        first, second, other = self.sms(), self.sms(), self.sms('2700000001')
+        d1 = self.tracker.claim(first)
+        d2 = self.tracker.claim(second)
+        d3 = self.tracker.claim(other)
+        for command in (first, other, second):
+            self.tracker.written(command)
+        self.seq('1')
+        self.seq('2', '2700000001')
+        self.seq('3')
+        self.assertEqual(self.successResultOf(d1).sequence, '1')
+        self.assertEqual(self.successResultOf(d2).sequence, '3')
+        self.assertEqual(self.successResultOf(d3).sequence, '2')
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.tracker.hits, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unclaimed_seq_dropped(self):
+        self.tracker.written(self.sms())
+        command = self.sms()
+        d = self.tracker.claim(command)
+        self.tracker.written(command)
+        self.seq('1')
+        self.assertNoResult(d)
+        self.seq('2')
+        self.assertEqual(self.successResultOf(d).sequence, '2')
+        self.seq('3')
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_nack_answers_oldest(self):
+        first, second = self.sms('2700000001'), self.sms()
+        d1 = self.tracker.claim(first)
+        d2 = self.tracker.claim(second)
+        self.tracker.written(first)
+        self.tracker.written(second)
+        self.assertTrue(self.tracker.nack_received(Nack(nack_type='1')))
+        self.failureResultOf(d1, CommandNacked)
+        self.seq('1')
+        self.assertEqual(self.successResultOf(d2).sequence, '1')
+        self.assertFalse(self.tracker.nack_received(Nack(nack_type='1')))
+        self.assertEqual(self.tracker.nacks, 1)
+
+    def test_timeout_starts_when_written(self):
+        command = self.sms()
+        d = self.tracker.claim(command)
+        self.clock.advance(20)
+        self.assertNoResult(d)
+        self.tracker.written(command)
+        self.clock.advance(10)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(self.tracker.expiries, 1)
+        # Its SEQ is still expected and is not handed to the next claim.
+        command = self.sms()
+        d = self.tracker.claim(command)
+        self.tracker.written(command)
+        self.seq('1')
+        self.assertNoResult(d)
+        self.seq('2')
+        self.assertEqual(self.successResultOf(d).sequence, '2')
+
+    def test_cancel_before_written(self):
+        command = self.sms()
+        d = self.tracker.claim(command)
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(len(self.tracker), 0)
+        self.tracker.written(command)
+        self.seq('1')
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_max_size(self):
+        commands = [self.sms() for _ in range(4)]
+        ds = [self.tracker.claim(command) for command in commands]
+        for command in commands:
+            self.tracker.written(command)
+        self.failureResultOf(ds[0], CorrelationEvicted)
+        self.assertEqual(len(self.tracker), 3)
+        self.assertEqual(self.tracker.evictions, 1)
+        self.seq('2')
+        self.assertEqual(self.successResultOf(ds[1]).sequence, '2')
+
+    def test_fail_all(self):
+        queued, written = self.sms(), self.sms()
+        d1 = self.tracker.claim(queued)
+        d2 = self.tracker.claim(written)
+        self.tracker.written(written)
+        self.tracker.fail_all(SSMIException('gone'))
+        self.failureResultOf(d1, SSMIException)
+        self.failureResultOf(d2, SSMIException)
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class SequenceAllocatorTestCase(TestCase):
+
+    def test_allocate(self):
+        allocator = SequenceAllocator(first=1, last=3)
+        self.assertEqual(
+            [allocator.allocate() for _ in range(3)], ['1', '2', '3'])
+        self.assertEqual(allocator.free, 0)
+        self.assertRaises(SSMIException, allocator.allocate)
+
+    def test_wrap_around_skips_in_use(self):
+        allocator = SequenceAllocator(first=1, last=3)
+        for _ in range(3):
+            allocator.allocate()
+        allocator.release('2')
+        self.assertEqual(allocator.allocate(), '2')
+        allocator.release('1')
+        allocator.release('3')
+        self.assertEqual(allocator.allocate(), '3')
+        self.assertEqual(allocator.allocate(), '1')
+        self.assertEqual(len(allocator), 3)
+
+    def test_release_unknown(self):
+        allocator = SequenceAllocator()
+        allocator.release('5')
+        self.assertEqual(len(allocator), 0)
+
+
+class DeliveryIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.index = DeliveryIndex(max_size=3, ttl=10, clock=self.clock)
+
+    def test_seq_then_dr(self):
+        delivery = self.index.record_seq('2700000000', '1')
+        self.assertEqual(delivery.seq_at, 0)
+        self.assertFalse(delivery.reported)
+        self.assertEqual(self.index.get('2700000000', '1'), delivery)
+        self.clock.advance(2)
+        self.index.record_dr('2700000000', '1', '0')
+        self.assertTrue(delivery.reported)
+        self.assertEqual(delivery.ret_code, '0')
+        self.assertEqual(delivery.dr_at, 2)
+
+    def test_dr_before_seq(self):
+        delivery = self.index.record_dr('2700000000', '1', '0')
+        self.assertEqual(delivery.seq_at, None)
+        self.assertEqual(self.index.record_seq('2700000000', '1'), delivery)
+        self.assertEqual(delivery.seq_at, 0)
+        self.assertTrue(delivery.reported)
+
+    def test_link(self):
+        self.clock.advance(5)
+        self.index.record_seq('2700000000', '1')
+        delivery = self.index.link('2700000000', '1', 4, 'ref')
+        self.assertEqual(delivery.sent_at, 4)
+        self.assertEqual(delivery.reference, 'ref')
+        self.assertEqual(self.index.link('2700000000', '2'), None)
+
+    def test_wait(self):
+        delivery = self.index.record_seq('2700000000', '1')
+        d = self.index.wait('2700000000', '1')
+        self.assertNoResult(d)
+        self.index.record_dr('2700000000', '1', '0')
+        self.assertEqual(self.successResultOf(d), delivery)
+        self.assertEqual(
+            self.successResultOf(self.index.wait('2700000000', '1')),
+            delivery)
+
+    def test_wait_then_seq_then_dr(self):
+        d = self.index.wait('2700000000', '1')
+        self.clock.advance(1)
+        delivery = self.index.record_seq('2700000000', '1')
+        self.assertEqual(delivery.seq_at, 1)
+        self.assertNoResult(d)
+        self.index.record_dr('2700000000', '1', '0')
+        self.assertEqual(self.successResultOf(d), delivery)
+        self.assertEqual(len(self.index), 1)
+
+    def test_wait_without_seq_expires(self):
+        d = self.index.wait('2700000000', '1')
+        self.clock.advance(10)
+        self.index.record_seq('2700000000', '2')
+        self.failureResultOf(d, TimeoutError)
+
+    def test_wait_cancel(self):
+        self.index.record_seq('2700000000', '1')
+        d = self.index.wait('2700000000', '1')
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.index.record_dr('2700000000', '1', '0')
+
+    def test_subscribe(self):
+        reported = self.index.subscribe([].append)
+        self.index.record_seq('2700000000', '1')
+        delivery = self.index.record_dr('2700000000', '1', '0')
+        self.assertEqual(reported.__self__, [delivery])
+        self.index.unsubscribe(reported)
+        self.index.record_dr('2700000000', '2', '0')
+        self.assertEqual(reported.__self__, [delivery])
+
+    def test_subscriber_errors(self):
+        def broken(delivery):
+            raise ValueError('foo')
+        self.index.subscribe(broken)
+        self.index.record_dr('2700000000', '1', '0')
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_expire(self):
+        self.index.record_seq('2700000000', '1')
+        d = self.index.wait('2700000000', '1')
+        self.clock.advance(10)
+        self.index.record_seq('2700000000', '2')
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(self.index.get('2700000000', '1'), None)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.expiries, 1)
+
+    def test_max_size(self):
+        d = self.index.wait('2700000000', '1')
+        for sequence in ['2', '3', '4']:
+            self.index.record_seq('2700000000', sequence)
+        self.failureResultOf(d, CorrelationEvicted)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.evictions, 1)
+
+    def test_sequence_reused(self):
+        first = self.index.record_seq('2700000000', '1')
+        d = self.index.wait('2700000000', '1')
+        second = self.index.record_seq('2700000000', '1')
+        self.assertNotEqual(first, second)
+        self.failureResultOf(d, CorrelationEvicted)
@@ -0,0 +1,129 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.commands import MoMessage, PremiumMoMessage, Seq
+from txssmi.dedup import BloomFilter, DuplicateFilter, mo_key
+from txssmi.protocol import SSMIProtocol
+
+
+def mo(msisdn='2700000000', sequence='1', message='hello'):
+    return MoMessage(msisdn=msisdn, sequence=sequence, message=message)
+
+
+class BloomFilterTestCase(TestCase):
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.size, 9586)
+        self.assertEqual(bloom.hashes, 7)
+        self.assertEqual(len(bloom.bits), 1199)
+
+    def test_invalid_error_rate(self):
+        self.assertRaises(ValueError, BloomFilter, 1000, 0)
+        self.assertRaises(ValueError, BloomFilter, 1000, 1)
+
+    def test_add_and_contains(self):
+        bloom = BloomFilter(1000, 0.01)
+        positions = bloom.positions(b'foo')
+        self.assertFalse(bloom.contains(positions))
+        bloom.add(positions)
+        self.assertTrue(bloom.contains(positions))
+        self.assertEqual(len(bloom), 1)
+        bloom.clear()
+        self.assertFalse(bloom.contains(positions))
+        self.assertEqual(len(bloom), 0)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(bloom.positions(b'in-%d' % (i,)))
+        false_positives = sum(
+            bloom.contains(bloom.positions(b'out-%d' % (i,)))
+            for i in range(10000))
+        self.assertTrue(false_positives < 200, false_positives)
+
+
+class DuplicateFilterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.filter = DuplicateFilter(
+            window=60, capacity=100, error_rate=1e-6, clock=self.clock)
+
+    def test_key(self):
+        self.assertEqual(mo_key(mo(message=u'caf\xe9')),
+                         b'2700000000\x001\x00caf\xe9')
+
+    def test_duplicate(self):
+        self.assertFalse(self.filter.is_duplicate(mo()))
+        self.assertTrue(self.filter.is_duplicate(mo()))
+        self.assertFalse(self.filter.is_duplicate(mo(sequence='2')))
+        self.assertFalse(self.filter.is_duplicate(mo(msisdn='2700000001')))
+        self.assertFalse(self.filter.is_duplicate(mo(message='hello!')))
+        self.assertEqual(self.filter.snapshot()['checked'], 5)
+        self.assertEqual(self.filter.snapshot()['duplicates'], 1)
+
+    def test_premium_mo(self):
+        pmo = PremiumMoMessage(msisdn='2700000000', sequence='1',
+                               destination='12345', message='hello')
+        self.assertFalse(self.filter.is_duplicate(pmo))
+        self.assertTrue(self.filter.is_duplicate(pmo))
+
+    def test_other_commands_ignored(self):
+        seq = Seq(msisdn='2700000000', sequence='1')
+        self.assertFalse(self.filter.is_duplicate(seq))
+        self.assertFalse(self.filter.is_duplicate(seq))
+        self.assertEqual(self.filter.checked, 0)
+
+    def test_window(self):
+        self.filter.is_duplicate(mo())
+        self.clock.advance(60)
+        self.assertTrue(self.filter.is_duplicate(mo()))
+        self.assertEqual(self.filter.rotations, 1)
+        self.clock.advance(60)
+        self.assertFalse(self.filter.is_duplicate(mo()))
+        self.assertEqual(self.filter.rotations, 2)
+
+    def test_idle_forgets_everything(self):
+        self.filter.is_duplicate(mo())
+        self.clock.advance(120)
+        self.assertFalse(self.filter.is_duplicate(mo()))
+
+    def test_capacity(self):
+        for i in range(100):
+            self.filter.is_duplicate(mo(sequence=str(i)))
+        self.assertEqual(self.filter.rotations, 0)
+        self.filter.is_duplicate(mo(sequence='100'))
+        self.assertEqual(self.filter.rotations, 1)
+        self.assertTrue(self.filter.is_duplicate(mo(sequence='0')))
+        snapshot = self.filter.snapshot()
+        self.assertEqual(snapshot['current'], 1)
+        self.assertEqual(snapshot['previous'], 100)
+
+
+class ProtocolDuplicateFilterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.patch(SSMIProtocol, 'duplicate_filter',
+                   DuplicateFilter(clock=self.clock))
+
+    def connect(self):
+        protocol = SSMIProtocol()
+        protocol.makeConnection(StringTransport())
+        received = []
+        protocol.register_handler('MO', received.append)
+        return protocol, received
+
+    def test_duplicates_dropped_across_connections(self):
+        protocol, received = self.connect()
+        protocol.dataReceived(mo().to_bytes() + b'\r')
+        protocol.dataReceived(mo().to_bytes() + b'\r')
+        self.assertEqual(len(received), 1)
+        reconnected, received = self.connect()
+        reconnected.dataReceived(
+            mo().to_bytes() + b'\r' + mo(sequence='2').to_bytes() + b'\r')
+        self.assertEqual([cmd.sequence for cmd in received], ['2'])
+        self.assertEqual(SSMIProtocol.duplicate_filter.duplicates, 2)
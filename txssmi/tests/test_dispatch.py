@@ -0,0 +1,54 @@
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txssmi.dispatch import BatchConsumer
+
+
+class BatchConsumerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def make_consumer(self, **kwargs):
+        return BatchConsumer(self.batches.append, clock=self.clock, **kwargs)
+
+    def test_interval(self):
+        consumer = self.make_consumer(interval=0.1)
+        consumer('a')
+        self.clock.advance(0.05)
+        consumer('b')
+        self.assertEqual(self.batches, [])
+        self.assertEqual(len(consumer), 2)
+        self.clock.advance(0.05)
+        self.assertEqual(self.batches, [['a', 'b']])
+        self.assertEqual(len(consumer), 0)
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [['a', 'b']])
+
+    def test_max_size(self):
+        consumer = self.make_consumer(max_size=2)
+        consumer('a')
+        consumer('b')
+        consumer('c')
+        self.assertEqual(self.batches, [['a', 'b']])
+        self.clock.advance(0.1)
+        self.assertEqual(self.batches, [['a', 'b'], ['c']])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush(self):
+        consumer = self.make_consumer()
+        consumer('a')
+        self.successResultOf(consumer.flush())
+        self.assertEqual(self.batches, [['a']])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.successResultOf(consumer.flush())
+        self.assertEqual(self.batches, [['a']])
+
+    def test_handler_failure(self):
+        consumer = BatchConsumer(
+            lambda batch: fail(ValueError('foo')), clock=self.clock)
+        consumer('a')
+        self.successResultOf(consumer.flush())
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
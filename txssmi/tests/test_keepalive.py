@@ -0,0 +1,125 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.commands import Ack, MoMessage
+from txssmi.constants import ACK_LINK_CHECK_RESPONSE
+from txssmi.protocol import SSMIProtocol
+
+
+class LinkMonitorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.protocol = SSMIProtocol()
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.authenticated = True
+        self.monitor = self.protocol.link_check
+        self.addCleanup(self.monitor.stop)
+
+    def checks(self):
+        checks = self.transport.value().count(b'SSMI,3\r')
+        self.transport.clear()
+        return checks
+
+    def receive(self, command):
+        self.protocol.dataReceived(command.to_bytes() + b'\r')
+
+    def ack(self):
+        self.receive(Ack(ack_type=ACK_LINK_CHECK_RESPONSE))
+
+    def test_round_trip_time(self):
+        self.monitor.start(60, now=False)
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+        self.clock.advance(0.5)
+        self.ack()
+        self.assertEqual(self.monitor.last_rtt, 0.5)
+        self.assertEqual(self.monitor.srtt, 0.5)
+        self.assertEqual(self.monitor.rttvar, 0.25)
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+        self.clock.advance(0.1)
+        self.ack()
+        self.assertAlmostEqual(self.monitor.min_rtt, 0.1)
+        self.assertAlmostEqual(self.monitor.srtt, 0.45)
+        snapshot = self.monitor.snapshot()
+        self.assertEqual(snapshot['responses'], 2)
+        self.assertEqual(snapshot['rtt']['count'], 2)
+
+    def test_ack_not_queued(self):
+        self.monitor.start(60)
+        self.ack()
+        self.assertEqual(self.protocol.event_queue.pending, [])
+        self.receive(Ack(ack_type=ACK_LINK_CHECK_RESPONSE))
+        self.assertEqual(self.protocol.event_queue.pending, [])
+
+    def test_skipped_while_receiving(self):
+        self.monitor.start(60, now=False)
+        self.clock.advance(50)
+        self.receive(MoMessage(msisdn='2700000000', sequence='1',
+                               message='foo'))
+        self.clock.advance(10)
+        self.assertEqual(self.checks(), 0)
+        self.assertEqual(self.monitor.skipped, 1)
+        self.clock.advance(49)
+        self.assertEqual(self.checks(), 0)
+        self.clock.advance(1)
+        self.assertEqual(self.checks(), 1)
+
+    def test_dead_link(self):
+        self.monitor.start(60, now=False)
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+        self.clock.advance(10)
+        self.assertEqual(self.checks(), 1)
+        self.clock.advance(10)
+        self.assertEqual(self.checks(), 1)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(10)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse(self.monitor.alive)
+        self.assertFalse(self.monitor.running)
+        self.assertEqual(self.monitor.timeouts, 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_missed_reset_by_response(self):
+        self.monitor.start(60, now=False)
+        self.clock.advance(60)
+        self.clock.advance(10)
+        self.clock.advance(10)
+        self.ack()
+        self.assertEqual(self.monitor.missed, 0)
+        self.assertTrue(self.monitor.alive)
+
+    def test_slow_response_with_traffic(self):
+        self.monitor.start(60, now=False)
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+        self.clock.advance(5)
+        self.receive(MoMessage(msisdn='2700000000', sequence='1',
+                               message='foo'))
+        self.clock.advance(5)
+        self.assertEqual(self.monitor.timeouts, 0)
+        self.assertEqual(self.checks(), 0)
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+
+    def test_not_authenticated(self):
+        self.protocol.authenticated = False
+        self.monitor.start(60)
+        self.assertEqual(self.checks(), 0)
+        self.assertEqual(self.monitor.checks, 0)
+        self.protocol.authenticated = True
+        self.clock.advance(60)
+        self.assertEqual(self.checks(), 1)
+
+    def test_stop(self):
+        self.monitor.start(60)
+        self.monitor.stop()
+        self.assertFalse(self.monitor.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.ack()
+        self.assertEqual(self.monitor.responses, 0)
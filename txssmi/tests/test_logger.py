@@ -0,0 +1,50 @@
+from twisted.python import log
+from twisted.trial.unittest import TestCase
+
+from txssmi.commands import MoMessage
+from txssmi.logger import CommandLogger, DEBUG, INFO, WARNING
+
+
+class CommandLoggerTestCase(TestCase):
+
+    def setUp(self):
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+        self.mo = MoMessage(msisdn='2700000000', sequence='1',
+                            message='foo')
+
+    def test_level(self):
+        logger = CommandLogger(level=INFO)
+        self.assertFalse(logger.enabled(DEBUG))
+        self.assertTrue(logger.enabled(WARNING))
+        logger.command(DEBUG, 'Received MO', self.mo)
+        logger.msg(DEBUG, 'Connection made.')
+        self.assertEqual(self.events, [])
+
+    def test_command(self):
+        logger = CommandLogger(level=DEBUG)
+        logger.command(DEBUG, 'Received MO', self.mo)
+        [event] = self.events
+        self.assertEqual(event['command'], self.mo)
+        self.assertEqual(event['logLevel'], DEBUG)
+        self.assertEqual(log.textFromEventDict(event),
+                         'Received MO: %r' % (self.mo,))
+
+    def test_msg(self):
+        logger = CommandLogger()
+        logger.msg(INFO, 'Connection lost: %(reason)s', reason='gone')
+        [event] = self.events
+        self.assertEqual(log.textFromEventDict(event),
+                         'Connection lost: gone')
+
+    def test_sample_rate(self):
+        logger = CommandLogger(level=DEBUG, sample_rate=0.1, seed=1)
+        for _ in range(1000):
+            logger.command(DEBUG, 'Received MO', self.mo)
+        self.assertTrue(50 < len(self.events) < 150)
+
+    def test_sample_rate_zero(self):
+        logger = CommandLogger(level=DEBUG, sample_rate=0)
+        logger.command(DEBUG, 'Received MO', self.mo)
+        self.assertEqual(self.events, [])
@@ -0,0 +1,126 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txssmi.metrics import (
+    Histogram, NullMetrics, InMemoryMetrics, merge_snapshots)
+
+
+class HistogramTestCase(TestCase):
+
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.mean, None)
+        self.assertEqual(histogram.percentile(99), None)
+
+    def test_observe(self):
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5, 1, 1.5, 4]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 0])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.mean, 1.75)
+        self.assertEqual(histogram.max, 4)
+
+    def test_percentile(self):
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5] * 90 + [1.5] * 9 + [10]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(99), 2)
+        self.assertEqual(histogram.percentile(100), 10)
+
+    def test_snapshot(self):
+        histogram = Histogram([1, 2])
+        histogram.observe(3)
+        self.assertEqual(histogram.snapshot(), {
+            'count': 1,
+            'total': 3.0,
+            'max': 3,
+            'buckets': [(1, 0), (2, 0)],
+            'overflow': 1,
+        })
+
+
+class InMemoryMetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = InMemoryMetrics(clock=self.clock, max_pending=2)
+
+    def test_null_metrics(self):
+        metrics = NullMetrics()
+        self.assertFalse(metrics.enabled)
+        metrics.start_timer('seq', '2700000000')
+        self.assertEqual(metrics.stop_timer('seq', '2700000000'), None)
+
+    def test_counters(self):
+        self.metrics.command_sent('SEND_SMS')
+        self.metrics.command_sent('SEND_SMS')
+        self.metrics.command_received('SEQ')
+        self.metrics.bytes_sent(10)
+        self.metrics.bytes_received(5)
+        self.metrics.queue_depth('bulk', 3)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['sent'], {'SEND_SMS': 2})
+        self.assertEqual(snapshot['received'], {'SEQ': 1})
+        self.assertEqual(snapshot['bytes_out'], 10)
+        self.assertEqual(snapshot['bytes_in'], 5)
+        self.assertEqual(snapshot['queue_depths'], {'bulk': 3})
+
+    def test_timer(self):
+        self.metrics.start_timer('seq', '2700000000')
+        self.clock.advance(0.2)
+        self.metrics.start_timer('seq', '2700000000')
+        self.clock.advance(0.2)
+        self.assertEqual(self.metrics.stop_timer('seq', '2700000000'), 0)
+        self.assertEqual(self.metrics.stop_timer('seq', '2700000000'), 0.2)
+        self.assertEqual(self.metrics.stop_timer('seq', '2700000000'), None)
+        histogram = self.metrics.timings['seq']
+        self.assertEqual(histogram.count, 2)
+        self.assertAlmostEqual(histogram.mean, 0.3)
+
+    def test_timer_start(self):
+        self.clock.advance(5)
+        self.metrics.start_timer('dr', ('2700000000', '1'), start=1)
+        self.metrics.stop_timer('dr', ('2700000000', '1'))
+        self.assertEqual(self.metrics.timings['dr'].max, 4)
+
+    def test_max_pending(self):
+        self.metrics.start_timer('seq', '1')
+        self.metrics.start_timer('seq', '2')
+        self.metrics.start_timer('seq', '3')
+        self.assertEqual(self.metrics.pending_count, 2)
+        self.assertEqual(self.metrics.stop_timer('seq', '1'), None)
+        self.assertEqual(self.metrics.stop_timer('seq', '3'), 0)
+
+    def test_merge_snapshots(self):
+        other = InMemoryMetrics(clock=self.clock, buckets=[1, 10])
+        self.metrics = InMemoryMetrics(clock=self.clock, buckets=[1, 10])
+        for metrics, delay in [(self.metrics, 0.5), (other, 20)]:
+            metrics.command_sent('SEND_SMS')
+            metrics.bytes_sent(10)
+            metrics.queue_depth('bulk', 2)
+            metrics.start_timer('seq', '1')
+            self.clock.advance(delay)
+            metrics.stop_timer('seq', '1')
+        other.command_received('SEQ')
+        merged = merge_snapshots(
+            [self.metrics.snapshot(), other.snapshot()])
+        self.assertEqual(merged['sent'], {'SEND_SMS': 2})
+        self.assertEqual(merged['received'], {'SEQ': 1})
+        self.assertEqual(merged['bytes_out'], 20)
+        self.assertEqual(merged['bytes_in'], 0)
+        self.assertEqual(merged['queue_depths'], {'bulk': 4})
+        self.assertEqual(merged['timings']['seq'], {
+            'count': 2,
+            'total': 20.5,
+            'max': 20,
+            'buckets': [(1, 1), (10, 0)],
+            'overflow': 1,
+        })
+
+    def test_merge_no_snapshots(self):
+        merged = merge_snapshots([])
+        self.assertEqual(merged['sent'], {})
+        self.assertEqual(merged['timings'], {})
@@ -0,0 +1,241 @@
+from twisted.internet.defer import succeed, fail
+from twisted.internet.error import ConnectionRefusedError, ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIException
+from txssmi.commands import (
+    Ack, Nack, ServerLogout, USSDMessage, ExtendedUSSDMessage)
+from txssmi.constants import (
+    USSD_NEW, USSD_END, USSD_RESPONSE, USSD_TIMEOUT, USSD_PHASE_2)
+from txssmi.pool import SSMIPool
+from txssmi.protocol import SSMIProtocol
+
+
+class FakeEndpoint(object):
+
+    def __init__(self):
+        self.protocols = []
+        self.refuse = False
+
+    def connect(self, factory):
+        if self.refuse:
+            return fail(ConnectionRefusedError())
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        self.protocols.append(protocol)
+        return succeed(protocol)
+
+
+class SSMIPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIPool, 'clock', self.clock)
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.endpoint = FakeEndpoint()
+
+    def make_pool(self, size=2, **kwargs):
+        pool = SSMIPool(self.endpoint, 'username', 'password', size=size,
+                        **kwargs)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def reply(self, protocol, command):
+        protocol.lineReceived(str(command))
+
+    def accept_all(self):
+        for protocol in self.endpoint.protocols:
+            if not protocol.authenticated:
+                self.reply(protocol, Ack(ack_type='1'))
+
+    def disconnect(self, protocol):
+        protocol.connectionLost(Failure(ConnectionDone()))
+
+    def sent(self, protocol):
+        return [line for line in protocol.transport.value().split(b'\r')
+                if line and not line.startswith(b'SSMI,1,')]
+
+    def test_start(self):
+        pool = self.make_pool(size=3)
+        d = pool.start()
+        self.assertEqual(len(self.endpoint.protocols), 3)
+        self.assertFalse(d.called)
+        self.accept_all()
+        self.assertEqual(self.successResultOf(d), pool)
+        self.assertEqual(pool.members, self.endpoint.protocols)
+        self.assertTrue(
+            all(member.link_check.running for member in pool.members))
+
+    def test_unknown_strategy(self):
+        self.assertRaises(SSMIException, self.make_pool, strategy='foo')
+
+    def test_no_healthy_members(self):
+        pool = self.make_pool()
+        self.failureResultOf(pool.send_message('2700000000', 'foo'),
+                             SSMIException)
+
+    def test_round_robin(self):
+        pool = self.make_pool(strategy=SSMIPool.ROUND_ROBIN)
+        pool.start()
+        self.accept_all()
+        for i in range(4):
+            pool.send_message('2700000000', str(i))
+        p1, p2 = self.endpoint.protocols
+        self.assertEqual(len(self.sent(p1)), 2)
+        self.assertEqual(len(self.sent(p2)), 2)
+
+    def test_least_loaded(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        p1.pauseProducing()
+        p1.send_message('2700000000', 'queued')
+        for i in range(3):
+            pool.send_message('2700000000', str(i))
+        self.assertEqual(len(self.sent(p1)), 0)
+        self.assertEqual(len(self.sent(p2)), 3)
+
+    def test_fastest(self):
+        pool = self.make_pool(strategy=SSMIPool.FASTEST)
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        p1.link_check.observe(0.5)
+        pool.send_message('2700000000', '0')
+        self.assertEqual(len(self.sent(p1)), 1)
+        p2.link_check.observe(0.1)
+        pool.send_message('2700000000', '1')
+        self.assertEqual(len(self.sent(p2)), 1)
+
+    def test_dead_link_unhealthy(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        p1.link_check.alive = False
+        self.assertFalse(pool.is_healthy(p1))
+        pool.check_health()
+        self.assertEqual(pool.members, [p2])
+
+    def test_ussd_session_pinned(self):
+        pool = self.make_pool(strategy=SSMIPool.ROUND_ROBIN)
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        pool.send_ussd_message('2700000000', 'menu', USSD_NEW)
+        pool.send_message('2700000001', 'other')
+        pool.send_ussd_message('2700000000', 'bye', USSD_END)
+        self.assertEqual(len(self.sent(p1)), 2)
+        self.assertEqual(pool.pins, {})
+
+    def test_pin_dropped_with_member(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        pool.pin('2700000000', p1)
+        self.disconnect(p1)
+        self.assertEqual(pool.pins, {})
+        pool.send_ussd_message('2700000000', 'menu', USSD_NEW)
+        self.assertEqual(len(self.sent(p2)), 1)
+
+    def test_inbound_ussd_session_pinned(self):
+        pool = self.make_pool(strategy=SSMIPool.ROUND_ROBIN)
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        self.reply(p2, USSDMessage(
+            msisdn='2700000000', type=USSD_NEW, phase=USSD_PHASE_2,
+            message='*100#'))
+        self.assertEqual(pool.pins, {'2700000000': p2})
+        pool.send_ussd_message('2700000000', 'menu', USSD_RESPONSE)
+        self.assertEqual(len(self.sent(p2)), 1)
+        self.reply(p2, USSDMessage(
+            msisdn='2700000000', type=USSD_END, phase=USSD_PHASE_2,
+            message=''))
+        self.assertEqual(pool.pins, {})
+
+    def test_inbound_ussd_timeout_unpins(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        self.reply(p1, ExtendedUSSDMessage(
+            msisdn='2700000000', type=USSD_NEW, phase=USSD_PHASE_2,
+            message='*100#', genfields='655011234567890:1::'))
+        self.assertEqual(pool.pins, {'2700000000': p1})
+        self.reply(p1, ExtendedUSSDMessage(
+            msisdn='2700000000', type=USSD_TIMEOUT, phase=USSD_PHASE_2,
+            message='', genfields='655011234567890:1::'))
+        self.assertEqual(pool.pins, {})
+
+    def test_replace_disconnected_member(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        self.disconnect(p1)
+        self.assertEqual(pool.members, [p2])
+        self.clock.advance(pool.reconnect_delay)
+        self.assertEqual(len(self.endpoint.protocols), 3)
+        self.accept_all()
+        self.assertEqual(pool.members, [p2, self.endpoint.protocols[2]])
+
+    def test_failed_authentication_retried(self):
+        pool = self.make_pool(size=1)
+        pool.start()
+        [p1] = self.endpoint.protocols
+        self.reply(p1, Nack(nack_type='1'))
+        self.assertEqual(pool.members, [])
+        self.assertTrue(p1.transport.disconnecting)
+        self.flushLoggedErrors(SSMIException)
+        self.clock.advance(pool.reconnect_delay)
+        self.accept_all()
+        self.assertEqual(pool.members, [self.endpoint.protocols[1]])
+
+    def test_refused_connection_retried(self):
+        self.endpoint.refuse = True
+        pool = self.make_pool(size=1)
+        pool.start()
+        self.flushLoggedErrors(ConnectionRefusedError)
+        self.assertEqual(pool.members, [])
+        self.endpoint.refuse = False
+        self.clock.advance(pool.reconnect_delay)
+        self.accept_all()
+        self.assertEqual(len(pool.members), 1)
+
+    def test_health_check_drops_logged_out_member(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        self.reply(p1, ServerLogout(ip='127.0.0.1'))
+        pool.send_message('2700000000', 'foo')
+        self.assertEqual(len(self.sent(p2)), 1)
+        self.clock.advance(pool.health_check_interval)
+        self.assertEqual(pool.members, [p2])
+        self.assertTrue(p1.transport.disconnecting)
+        self.assertEqual(len(pool.replacements), 1)
+
+    def test_stop(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        p1, p2 = self.endpoint.protocols
+        self.disconnect(p1)
+        pool.stop()
+        self.assertEqual(pool.members, [])
+        self.assertEqual(pool.replacements, set())
+        self.assertTrue(p2.transport.disconnecting)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_shared_deliveries(self):
+        pool = self.make_pool()
+        pool.start()
+        self.accept_all()
+        for member in pool.members:
+            self.assertIdentical(member.deliveries, pool.deliveries)
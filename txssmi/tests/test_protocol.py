@@ -1,20 +1,33 @@
 import binascii
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, TimeoutError
+from twisted.internet.error import ConnectionDone, ConnectionLost
 from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase
 
-from txssmi.builder import SSMIRequest
+from txssmi.builder import SSMIRequest, SSMICommandException
 from txssmi.commands import (
     Login, Ack, IMSILookupReply, Seq, MoMessage, DrMessage, FFMessage,
     BMoMessage, PremiumMoMessage, PremiumBMoMessage, USSDMessage,
-    ExtendedUSSDMessage, ServerLogout, Nack)
+    ExtendedUSSDMessage, ServerLogout, Nack, SendSMS)
 from txssmi.protocol import SSMIProtocol
+from txssmi.correlation import (
+    CommandNacked, CorrelationStore, SequenceAllocator)
+from txssmi.logger import CommandLogger, DEBUG
+from txssmi.metrics import InMemoryMetrics
+from txssmi.scheduler import LANE_USSD
+from txssmi.segment import Segmenter
 from txssmi.constants import (
-    CODING_8BIT, PROTOCOL_ENHANCED, USSD_INITIATE, USSD_NEW, DR_SUCCESS,
-    USSD_PHASE_2, USSD_TIMEOUT)
+    CODING_7BIT, CODING_8BIT, PROTOCOL_STANDARD, PROTOCOL_ENHANCED,
+    USSD_INITIATE, USSD_NEW, DR_SUCCESS, USSD_PHASE_2, USSD_TIMEOUT)
+
+
+def hexlify(data):
+    return binascii.hexlify(data).decode('ascii')
 
 
 class ProtocolTestCase(TestCase):
@@ -31,7 +44,8 @@ class ProtocolTestCase(TestCase):
         self.protocol.makeConnection(self.transport)
 
     def send(self, command):
-        return self.protocol.lineReceived(str(command))
+        return self.protocol.dataReceived(
+            command.to_bytes() + self.protocol.delimiter)
 
     def receive(self, count, clear=True):
         d = Deferred()
@@ -42,7 +56,7 @@ class ProtocolTestCase(TestCase):
                 return
 
             lines = self.transport.value().split(self.protocol.delimiter)
-            commands = map(SSMIRequest.parse, filter(None, lines))
+            commands = [SSMIRequest.from_bytes(line) for line in lines if line]
             if len(commands) == count:
                 d.callback(commands)
                 if clear:
@@ -86,12 +100,232 @@ class ProtocolTestCase(TestCase):
         self.assertEqual(cmd.message, 'foo, bar')
         self.assertEqual(cmd.validity, '2')
 
+    def make_protocol(self, **attrs):
+        for name, value in attrs.items():
+            self.patch(self.protocol_class, name, value)
+        protocol = self.protocol_class()
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def flush(self, d, limit=100):
+        for _ in range(limit):
+            if d.called:
+                break
+            self.clock.advance(0)
+        return d
+
+    @inlineCallbacks
+    def test_send_messages(self):
+        messages = [('27000000%02d' % (i,), 'hi %s' % (i,))
+                    for i in range(10)]
+        d = self.protocol.send_messages(iter(messages), validity='2')
+        sent = yield self.flush(d)
+        cmds = yield self.receive(10)
+        self.assertEqual(cmds, sent)
+        self.assertEqual(
+            [(cmd.msisdn, cmd.message) for cmd in cmds], messages)
+        self.assertEqual(set(cmd.validity for cmd in cmds), set(['2']))
+
+    @inlineCallbacks
+    def test_send_commands_batches(self):
+        writes = []
+        self.patch(self.transport, 'write', writes.append)
+        self.protocol.batch_size = 3
+        d = self.protocol.send_commands(
+            SendSMS(msisdn='2700000000', message=str(i)) for i in range(7))
+        sent = yield self.flush(d)
+        self.assertEqual(len(sent), 7)
+        self.assertEqual([data.count(b'\r') for data in writes], [3, 3, 1])
+        self.assertEqual(
+            writes[2],
+            SendSMS(msisdn='2700000000', message='6').to_bytes() + b'\r')
+
+    def test_registers_producer(self):
+        self.assertEqual(self.transport.producer, self.protocol)
+        self.assertTrue(self.transport.streaming)
+
+    def test_high_water_mark(self):
+        _, transport = self.make_protocol(high_water_mark=1024)
+        self.assertEqual(transport.bufferSize, 1024)
+
+    @inlineCallbacks
+    def test_send_command_while_paused(self):
+        self.protocol.pauseProducing()
+        d1 = self.protocol.send_message('2700000000', 'foo')
+        d2 = self.protocol.send_message('2700000000', 'bar')
+        self.assertEqual(self.transport.value(), b'')
+        self.assertEqual(self.protocol.queue_depth, 2)
+        self.assertFalse(d1.called)
+        self.protocol.resumeProducing()
+        self.assertEqual(self.protocol.queue_depth, 0)
+        cmd1, cmd2 = yield self.receive(2)
+        self.assertEqual(cmd1.message, 'foo')
+        self.assertEqual(cmd2.message, 'bar')
+        self.assertEqual((yield d1), cmd1)
+        self.assertEqual((yield d2), cmd2)
+
+    def test_stop_producing_fails_queued_commands(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.send_message('2700000000', 'foo')
+        self.protocol.stopProducing()
+        self.assertEqual(self.protocol.queue_depth, 0)
+        self.failureResultOf(d, ConnectionDone)
+
+    @inlineCallbacks
+    def test_send_commands_while_paused(self):
+        writes = []
+
+        def write(data):
+            # Behave like a transport whose buffer fills on the first write
+            writes.append(data)
+            if len(writes) == 1:
+                self.protocol.pauseProducing()
+
+        self.patch(self.transport, 'write', write)
+        self.protocol.batch_size = 2
+        d = self.protocol.send_commands(
+            SendSMS(msisdn='2700000000', message=str(i)) for i in range(4))
+        for _ in range(5):
+            self.clock.advance(0)
+        self.assertEqual(len(writes), 1)
+        self.assertFalse(d.called)
+        self.protocol.resumeProducing()
+        sent = yield self.flush(d)
+        self.assertEqual(len(writes), 2)
+        self.assertEqual([cmd.message for cmd in sent],
+                         ['0', '1', '2', '3'])
+
+    def test_send_after_connection_lost(self):
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(
+            self.protocol.send_message('2700000000', 'foo'), ConnectionDone)
+        self.failureResultOf(
+            self.protocol.send_binary_message('2700000000', 'ff'),
+            ConnectionDone)
+        d = self.protocol.send_messages([('2700000000', 'foo')])
+        self.clock.advance(0)
+        self.failureResultOf(d, ConnectionDone)
+        self.assertEqual(self.protocol.queue_depth, 0)
+        self.assertEqual(len(self.protocol.sequence_replies), 0)
+
+    def test_resume_after_connection_lost(self):
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.protocol.resumeProducing()
+        self.failureResultOf(
+            self.protocol.send_message('2700000000', 'foo'), ConnectionDone)
+        self.assertEqual(self.protocol.queue_depth, 0)
+
+    def test_data_received_partial_lines(self):
+        received = []
+        self.protocol.register_handler('MO', received.append)
+        data = b''.join(
+            MoMessage(msisdn='2700000000', sequence=str(i),
+                      message='foo').to_bytes() + b'\r'
+            for i in range(3))
+        self.protocol.dataReceived(data[:10])
+        self.assertEqual(received, [])
+        self.protocol.dataReceived(data[10:40])
+        self.assertEqual([mo.sequence for mo in received], ['0'])
+        self.protocol.dataReceived(data[40:])
+        self.assertEqual([mo.sequence for mo in received], ['0', '1', '2'])
+        self.assertEqual(self.protocol.buffer, b'')
+
+    def test_data_received_while_paused(self):
+        received = []
+        self.protocol.register_handler('ACK', received.append)
+        self.protocol.pauseProducing()
+        # LineReceiver stops delivering lines while its own flag is set.
+        self.assertFalse(self.protocol.paused)
+        self.send(Ack(ack_type='1'))
+        self.assertEqual(received, [Ack(ack_type='1')])
+
+    def test_data_received_line_too_long(self):
+        self.protocol.MAX_LENGTH = 10
+        self.protocol.dataReceived(b'SSMI,101,' + b'1' * 10)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.protocol.buffer, b'')
+
+    def test_data_received_latin1(self):
+        received = []
+        self.protocol.register_handler('MO', received.append)
+        self.protocol.dataReceived(b'SSMI,103,2700000000,1,caf\xe9\r')
+        self.assertEqual(received[0].message, u'caf\xe9')
+
+    def test_send_unencodable(self):
+        self.protocol.send_command(
+            SendSMS(msisdn='2700000000', message=u'€5', validity='0'))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(),
+                         b'SSMI,2,0,2700000000,?5\r')
+
+    def test_throttle_disabled(self):
+        self.assertEqual(self.protocol.throttle, None)
+
+    def test_throttled_send_message(self):
+        protocol, transport = self.make_protocol(
+            throttle_rate=2, throttle_burst=1)
+        d1 = protocol.send_message('2700000000', 'foo')
+        d2 = protocol.send_ussd_message('2700000000', 'bar', USSD_NEW)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        self.assertEqual(protocol.throttle_wait_time, 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(self.successResultOf(d2).message, 'bar')
+        self.assertEqual(len(transport.value().split(b'\r')), 3)
+
+    def test_throttled_send_commands(self):
+        protocol, transport = self.make_protocol(
+            throttle_rate=10, throttle_burst=4)
+        writes = []
+        self.patch(transport, 'write', writes.append)
+        d = protocol.send_commands(
+            SendSMS(msisdn='2700000000', message=str(i)) for i in range(10))
+        self.clock.advance(0)
+        self.assertEqual([data.count(b'\r') for data in writes], [4])
+        self.clock.advance(0.4)
+        self.assertEqual([data.count(b'\r') for data in writes], [4, 4])
+        self.clock.advance(0.2)
+        self.flush(d)
+        self.assertEqual([data.count(b'\r') for data in writes], [4, 4, 2])
+        self.assertEqual(len(self.successResultOf(d)), 10)
+
+    def test_ussd_ahead_of_bulk(self):
+        protocol, transport = self.make_protocol(
+            throttle_rate=10, throttle_burst=1, batch_size=1)
+        d = protocol.send_commands(
+            SendSMS(msisdn='2700000000', message=str(i)) for i in range(5))
+        self.clock.advance(0)
+        protocol.send_message('2700000001', 'single')
+        protocol.send_ussd_message('2700000002', 'menu', USSD_NEW)
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        self.clock.advance(0.1)
+        lines = transport.value().split(b'\r')
+        self.assertEqual(
+            [SSMIRequest.from_bytes(line).msisdn for line in lines if line],
+            ['2700000000', '2700000002', '2700000001', '2700000000'])
+        # Only the next bulk batch is taken from the generator
+        self.assertEqual(protocol.queue_depth, 1)
+        self.assertFalse(d.called)
+        self.assertEqual(protocol.lane_latency(LANE_USSD).count, 1)
+        self.assertEqual(protocol.lane_latency(LANE_USSD).max, 0.1)
+
+    def test_control_not_throttled(self):
+        protocol, transport = self.make_protocol(
+            throttle_rate=10, throttle_burst=1)
+        protocol.send_message('2700000000', 'foo')
+        protocol.send_message('2700000000', 'bar')
+        d = protocol.login('username', 'password')
+        self.assertEqual(self.successResultOf(d).command_name, 'LOGIN')
+        self.assertEqual(protocol.queue_depth, 1)
+
     @inlineCallbacks
     def test_link_check(self):
         self.assertFalse(self.transport.value())
         self.protocol.authenticated = False
         self.protocol.link_check.start(60)
-        self.assertEqual(self.transport.value(), '')
+        self.assertEqual(self.transport.value(), b'')
         self.protocol.authenticated = True
         self.clock.advance(60)
         [check1] = yield self.receive(1)
@@ -103,15 +337,51 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_send_binary_message(self):
         self.protocol.send_binary_message(
-            '2700000000', binascii.hexlify('hello world'),
+            '2700000000', hexlify(b'hello world'),
             protocol_id=PROTOCOL_ENHANCED, coding=CODING_8BIT)
         [cmd] = yield self.receive(1)
         self.assertEqual(cmd.command_name, 'SEND_BINARY_SMS')
-        self.assertEqual(binascii.unhexlify(cmd.hex_msg), 'hello world')
+        self.assertEqual(binascii.unhexlify(cmd.hex_msg), b'hello world')
         self.assertEqual(cmd.msisdn, '2700000000')
         self.assertEqual(cmd.pid, PROTOCOL_ENHANCED)
         self.assertEqual(cmd.coding, CODING_8BIT)
 
+    @inlineCallbacks
+    def test_send_long_message(self):
+        self.patch(self.protocol, 'segmenter', Segmenter())
+        d = self.protocol.send_long_message('2700000000', 'x' * 200)
+        parts = yield self.receive(2)
+        self.assertEqual([cmd.command_name for cmd in parts],
+                         ['SEND_BINARY_SMS'] * 2)
+        self.assertEqual([cmd.pid for cmd in parts], [PROTOCOL_ENHANCED] * 2)
+        self.assertEqual([cmd.coding for cmd in parts], [CODING_7BIT] * 2)
+        self.assertEqual([cmd.hex_msg[:12] for cmd in parts],
+                         ['050003010201', '050003010202'])
+        self.assertNoResult(d)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.assertNoResult(d)
+        self.send(Seq(msisdn='2700000000', sequence='2'))
+        seqs = yield d
+        self.assertEqual([seq.sequence for seq in seqs], ['1', '2'])
+
+    @inlineCallbacks
+    def test_send_long_message_single_part(self):
+        d = self.protocol.send_long_message('2700000000', u'caf\xe9')
+        [cmd] = yield self.receive(1)
+        self.assertEqual(cmd.pid, PROTOCOL_STANDARD)
+        self.assertEqual(cmd.coding, CODING_7BIT)
+        self.assertEqual(cmd.hex_msg, 'e3b0b900')
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        [seq] = yield d
+        self.assertEqual(seq.sequence, '1')
+
+    def test_send_long_message_timeout(self):
+        d = self.protocol.send_long_message('2700000000', u'\u1234' * 71)
+        self.clock.advance(0)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.clock.advance(self.protocol.reply_timeout)
+        self.failureResultOf(d, TimeoutError)
+
     @inlineCallbacks
     def test_logout(self):
         self.protocol.logout()
@@ -142,13 +412,13 @@ class ProtocolTestCase(TestCase):
     def test_send_mms_message(self):
         self.protocol.send_mms_message(
             '2700000000', 'subject', 'name.gif',
-            binascii.hexlify('hello world'))
+            hexlify(b'hello world'))
         [cmd] = yield self.receive(1)
         self.assertEqual(cmd.command_name, 'SEND_MMS_MESSAGE')
         self.assertEqual(cmd.msisdn, '2700000000')
         self.assertEqual(cmd.subject, 'subject')
         self.assertEqual(cmd.name, 'name.gif')
-        self.assertEqual(cmd.content, binascii.hexlify(u'hello world'))
+        self.assertEqual(cmd.content, hexlify(b'hello world'))
 
     @inlineCallbacks
     def test_imsi_lookup(self):
@@ -186,10 +456,97 @@ class ProtocolTestCase(TestCase):
         self.assertEqual(resp.sequence, 'bar')
         self.assertEqual(resp.msisdn, '2700000000')
 
+    def test_imsi_lookup_allocates_sequence(self):
+        d1 = self.protocol.imsi_lookup('2700000000')
+        d2 = self.protocol.imsi_lookup('2700000001')
+        cmd1, cmd2 = [SSMIRequest.from_bytes(line) for line in
+                      self.transport.value().split(b'\r') if line]
+        self.assertNotEqual(cmd1.sequence, cmd2.sequence)
+        self.assertEqual(cmd1.imsi, '')
+        self.assertEqual(len(self.protocol.imsi_sequences), 2)
+        reply = IMSILookupReply(sequence=cmd2.sequence, msisdn=cmd2.msisdn,
+                                imsi='123', spid='spid')
+        self.send(reply)
+        self.assertEqual(self.successResultOf(d2), reply)
+        self.assertNoResult(d1)
+        self.assertEqual(len(self.protocol.imsi_sequences), 1)
+
+    def test_imsi_lookup_timeout_releases_sequence(self):
+        d = self.protocol.imsi_lookup('2700000000', timeout=5)
+        self.clock.advance(5)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.protocol.imsi_sequences), 0)
+
+    def test_imsi_lookup_many(self):
+        writes = []
+        self.patch(self.transport, 'write', writes.append)
+        msisdns = ['27000000%02d' % (i,) for i in range(10)]
+        ds = self.protocol.imsi_lookup_many(iter(msisdns))
+        self.clock.advance(0)
+        self.assertEqual(len(writes), 1)
+        cmds = [SSMIRequest.from_bytes(line)
+                for line in writes[0].split(b'\r') if line]
+        self.assertEqual([cmd.msisdn for cmd in cmds], msisdns)
+        self.assertEqual(len(set(cmd.sequence for cmd in cmds)), 10)
+        for cmd in reversed(cmds):
+            self.send(IMSILookupReply(sequence=cmd.sequence,
+                                      msisdn=cmd.msisdn, imsi='1', spid='2'))
+            self.assertEqual(self.successResultOf(ds[msisdns.index(
+                cmd.msisdn)]).msisdn, cmd.msisdn)
+        self.assertEqual(len(self.protocol.imsi_sequences), 0)
+
+    def test_imsi_lookup_many_too_many(self):
+        self.protocol.imsi_sequences = SequenceAllocator(first=1, last=2)
+        self.assertRaises(
+            SSMICommandException, self.protocol.imsi_lookup_many,
+            ['2700000000', '2700000001', '2700000002'])
+        self.assertEqual(len(self.protocol.imsi_lookup_replies), 0)
+
+    def test_imsi_lookup_many_more_than_pending_replies(self):
+        writes = []
+        self.patch(self.transport, 'write', writes.append)
+        self.protocol.imsi_lookup_replies = CorrelationStore(
+            2, clock=self.clock)
+        self.protocol.imsi_lookup('2700000000', imsi='')
+        self.assertRaises(
+            SSMICommandException, self.protocol.imsi_lookup_many,
+            ['2700000001', '2700000002'])
+        self.clock.advance(0)
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(len(self.protocol.imsi_sequences), 1)
+        self.assertEqual(self.protocol.imsi_lookup_replies.evictions, 0)
+
+    def test_imsi_sequence_held_while_queued(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.imsi_lookup('2700000000', imsi='', timeout=5)
+        self.clock.advance(5)
+        self.assertNoResult(d)
+        self.assertEqual(len(self.protocol.imsi_sequences), 1)
+        self.protocol.resumeProducing()
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.protocol.imsi_sequences), 0)
+
+    def test_sequence_reply_timeout(self):
+        d = self.protocol.send_binary_message('2700000000', 'foo')
+        self.clock.advance(self.protocol.reply_timeout)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(self.protocol.sequence_replies.expiries, 1)
+
+    def test_imsi_lookup_timeout(self):
+        d = self.protocol.imsi_lookup('2700000000', imsi='', timeout=5)
+        self.clock.advance(5)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.protocol.imsi_lookup_replies), 0)
+
+    def test_unsolicited_sequence_dropped(self):
+        for i in range(5):
+            self.send(Seq(msisdn='27000000%02d' % (i,), sequence='1'))
+        self.assertEqual(len(self.protocol.sequence_replies), 0)
+
     @inlineCallbacks
     def test_mo(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_MO', calls.append)
+        self.protocol.register_handler('MO', calls.append)
         cmd = MoMessage(msisdn='2700000000', sequence='1',
                         message='foo')
         yield self.send(cmd)
@@ -198,7 +555,7 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_mo_with_comma(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_MO', calls.append)
+        self.protocol.register_handler('MO', calls.append)
         cmd = MoMessage(msisdn='2700000000', sequence='1',
                         message='foo, bar')
         yield self.send(cmd)
@@ -207,7 +564,7 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_dr(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_DR', calls.append)
+        self.protocol.register_handler('DR', calls.append)
         cmd = DrMessage(msisdn='2700000000', sequence='1', ret_code=DR_SUCCESS)
         yield self.send(cmd)
         self.assertEqual([cmd], calls)
@@ -215,7 +572,7 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_free_form(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_FREE_FORM', calls.append)
+        self.protocol.register_handler('FREE_FORM', calls.append)
         cmd = FFMessage(text='foo')
         yield self.send(cmd)
         self.assertEqual([cmd], calls)
@@ -223,17 +580,17 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_binary_mo(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_BINARY_MO', calls.append)
+        self.protocol.register_handler('BINARY_MO', calls.append)
         cmd = BMoMessage(msisdn='2700000000', sequence='1',
                          coding=CODING_8BIT, pid=PROTOCOL_ENHANCED,
-                         hex_msg=binascii.hexlify('hello'))
+                         hex_msg=hexlify(b'hello'))
         yield self.send(cmd)
         self.assertEqual([cmd], calls)
 
     @inlineCallbacks
     def test_premium_mo(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_PREMIUM_MO', calls.append)
+        self.protocol.register_handler('PREMIUM_MO', calls.append)
         cmd = PremiumMoMessage(msisdn='2700000000', sequence='1',
                                destination='foo', message='bar')
         yield self.send(cmd)
@@ -242,11 +599,10 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_premium_binary_mo(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_PREMIUM_BINARY_MO',
-                   calls.append)
+        self.protocol.register_handler('PREMIUM_BINARY_MO', calls.append)
         cmd = PremiumBMoMessage(msisdn='2700000000', sequence='1',
                                 coding=CODING_8BIT, pid=PROTOCOL_ENHANCED,
-                                hex_msg=binascii.hexlify('hello'),
+                                hex_msg=hexlify(b'hello'),
                                 destination='foo')
         yield self.send(cmd)
         self.assertEqual([cmd], calls)
@@ -254,7 +610,7 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_ussd_message(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_USSD_MESSAGE', calls.append)
+        self.protocol.register_handler('USSD_MESSAGE', calls.append)
         cmd = USSDMessage(msisdn='2700000000', type=USSD_TIMEOUT,
                           phase=USSD_PHASE_2, message='foo')
         yield self.send(cmd)
@@ -263,8 +619,7 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_extended_ussd_message(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_EXTENDED_USSD_MESSAGE',
-                   calls.append)
+        self.protocol.register_handler('EXTENDED_USSD_MESSAGE', calls.append)
         cmd = ExtendedUSSDMessage(msisdn='2700000000', type=USSD_NEW,
                                   phase=USSD_PHASE_2, message='*100#',
                                   genfields='655011234567890:1::')
@@ -274,14 +629,252 @@ class ProtocolTestCase(TestCase):
     @inlineCallbacks
     def test_server_logout(self):
         calls = []
-        self.patch(self.protocol_class, 'handle_LOGOUT', calls.append)
+        self.protocol.register_handler('LOGOUT', calls.append)
         cmd = ServerLogout(ip='127.0.0.1')
         yield self.send(cmd)
         self.assertEqual([cmd], calls)
 
+    def test_server_logout_deauthenticates(self):
+        self.protocol.authenticated = True
+        self.send(ServerLogout(ip='127.0.0.1'))
+        self.assertFalse(self.protocol.authenticated)
+
+    def test_wait_for_disconnect(self):
+        d = self.protocol.wait_for_disconnect()
+        self.assertFalse(d.called)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_wait_for_connect(self):
+        protocol = self.protocol_class()
+        d = protocol.wait_for_connect()
+        self.assertFalse(d.called)
+        protocol.makeConnection(StringTransport())
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_connection_lost_fails_pending_replies(self):
+        self.protocol.link_check.start(60)
+        auth_d = self.protocol.authenticate('username', 'password')
+        seq_d = self.protocol.send_binary_message('2700000000', 'ff')
+        imsi_d = self.protocol.imsi_lookup('2700000000', sequence='1',
+                                           imsi='')
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(auth_d, ConnectionLost)
+        self.failureResultOf(seq_d, ConnectionLost)
+        self.failureResultOf(imsi_d, ConnectionLost)
+        self.assertFalse(self.protocol.link_check.running)
+
+    def test_connection_lost_fails_queued_commands(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.send_message('2700000000', 'foo')
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionDone)
+
     @inlineCallbacks
     def test_nack(self):
         cmd = Nack(nack_type='1')
         yield self.send(cmd)
         nack = yield self.protocol.event_queue.get()
         self.assertEqual(str(cmd), 'SSMI,102,1')
+
+    def test_metrics(self):
+        metrics = InMemoryMetrics(clock=self.clock)
+        self.protocol.metrics = metrics
+        self.protocol.send_message('2700000000', 'foo')
+        self.protocol.imsi_lookup('2700000000', sequence='7')
+        self.assertEqual(metrics.sent, {'SEND_SMS': 1, 'IMSI_LOOKUP': 1})
+        self.assertEqual(metrics.bytes_out, len(self.transport.value()))
+        self.assertEqual(metrics.queue_depths['sms'], 0)
+
+        self.clock.advance(1)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.send(IMSILookupReply(sequence='7', msisdn='2700000000',
+                                  imsi='1234', spid='1'))
+        self.clock.advance(2)
+        self.send(DrMessage(msisdn='2700000000', sequence='1',
+                            ret_code=DR_SUCCESS))
+        self.assertEqual(metrics.received, {
+            'SEQ': 1, 'IMSI_LOOKUP_REPLY': 1, 'DR': 1})
+        self.assertTrue(metrics.bytes_in > 0)
+        self.assertEqual(metrics.timings['seq'].max, 1)
+        self.assertEqual(metrics.timings['imsi_lookup'].max, 1)
+        self.assertEqual(metrics.timings['dr'].max, 3)
+        self.assertEqual(metrics.pending_count, 0)
+
+    def test_inbound_logging(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        self.protocol.noisy = False
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='foo')
+        self.send(mo)
+        self.assertEqual(events, [])
+        self.protocol.logger = CommandLogger(level=DEBUG)
+        self.send(mo)
+        [event] = events
+        self.assertEqual(event['command'], mo)
+
+    def test_handler_override(self):
+        calls = []
+
+        class MOProtocol(SSMIProtocol):
+            def handle_MO(self, mo):
+                calls.append(mo)
+
+        protocol = MOProtocol()
+        protocol.makeConnection(StringTransport())
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='foo')
+        protocol.lineReceived(str(mo))
+        self.assertEqual(calls, [mo])
+
+    def test_register_unknown_handler(self):
+        self.assertRaises(SSMICommandException,
+                          self.protocol.register_handler, 'FOO', None)
+
+    def test_unregister_handler(self):
+        calls = []
+        self.protocol.register_handler('MO', calls.append)
+        self.protocol.unregister_handler('MO', calls.append)
+        self.send(MoMessage(msisdn='2700000000', sequence='1', message='foo'))
+        self.assertEqual(calls, [])
+
+    def test_handler_errors(self):
+        calls = []
+
+        def broken(command):
+            raise ValueError('foo')
+
+        self.protocol.register_handler('MO', broken)
+        self.protocol.register_handler('MO', calls.append)
+        self.send(MoMessage(msisdn='2700000000', sequence='1', message='foo'))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_batch_handler(self):
+        batches = []
+        self.protocol.register_batch_handler(
+            ['MO', 'DR'], batches.append, interval=0.1)
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='foo')
+        dr = DrMessage(msisdn='2700000000', sequence='1', ret_code=DR_SUCCESS)
+        self.send(mo)
+        self.send(dr)
+        self.assertEqual(batches, [])
+        self.clock.advance(0.1)
+        self.assertEqual(batches, [[mo, dr]])
+
+    def test_batch_handler_flushed_on_connection_lost(self):
+        batches = []
+        self.protocol.register_batch_handler('MO', batches.append)
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='foo')
+        self.send(mo)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(batches, [[mo]])
+
+    def test_unregister_batch_handler(self):
+        batches = []
+        consumer = self.protocol.register_batch_handler('MO', batches.append)
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='foo')
+        self.send(mo)
+        self.protocol.unregister_handler('MO', consumer)
+        self.assertEqual(batches, [[mo]])
+        self.assertEqual(self.protocol.batch_consumers, [])
+
+    def test_send_tracked_message(self):
+        d = self.protocol.send_tracked_message(
+            '2700000000', 'foo', reference='ref')
+        self.clock.advance(1)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        delivery = self.successResultOf(d)
+        self.assertEqual(delivery.key, ('2700000000', '1'))
+        self.assertEqual(delivery.reference, 'ref')
+        self.assertEqual(delivery.sent_at, 0)
+        self.assertEqual(delivery.seq_at, 1)
+
+        dr = self.protocol.wait_for_delivery(delivery)
+        self.assertNoResult(dr)
+        self.send(DrMessage(msisdn='2700000000', sequence='1',
+                            ret_code=DR_SUCCESS))
+        self.assertEqual(self.successResultOf(dr), delivery)
+        self.assertEqual(delivery.ret_code, DR_SUCCESS)
+
+    def test_untracked_seq_not_claimed(self):
+        self.protocol.send_message('2700000000', 'first')
+        self.clock.advance(0)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        d = self.protocol.send_tracked_message(
+            '2700000000', 'second', reference='mine')
+        self.clock.advance(0)
+        self.assertNoResult(d)
+        self.send(Seq(msisdn='2700000000', sequence='2'))
+        delivery = self.successResultOf(d)
+        self.assertEqual(delivery.sequence, '2')
+        self.assertEqual(delivery.reference, 'mine')
+        self.assertEqual(
+            self.protocol.deliveries.get('2700000000', '1').reference, None)
+
+    def test_untracked_seq_in_flight_not_claimed(self):
+        self.protocol.send_message('2700000000', 'first')
+        d = self.protocol.send_binary_message('2700000000', 'ff')
+        self.clock.advance(0)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.assertNoResult(d)
+        self.send(Seq(msisdn='2700000000', sequence='2'))
+        self.assertEqual(self.successResultOf(d).sequence, '2')
+        self.assertEqual(len(self.protocol.sequence_replies), 0)
+
+    def test_nack_fails_oldest_claim(self):
+        d1 = self.protocol.send_tracked_message(
+            '2700000000', 'first', reference='A')
+        self.send(Nack(nack_type='1'))
+        failure = self.failureResultOf(d1, CommandNacked)
+        self.assertEqual(failure.value.nack.nack_type, '1')
+        d2 = self.protocol.send_tracked_message(
+            '2700000000', 'second', reference='B')
+        self.send(Seq(msisdn='2700000000', sequence='42'))
+        delivery = self.successResultOf(d2)
+        self.assertEqual(delivery.sequence, '42')
+        self.assertEqual(delivery.reference, 'B')
+        self.assertEqual(len(self.protocol.sequence_replies), 0)
+        self.assertEqual(self.protocol.event_queue.pending, [])
+
+    def test_nack_for_untracked_message(self):
+        self.protocol.send_message('2700000000', 'first')
+        d = self.protocol.send_binary_message('2700000000', 'ff')
+        self.send(Nack(nack_type='1'))
+        self.assertNoResult(d)
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.assertEqual(self.successResultOf(d).sequence, '1')
+
+    def test_seq_timeout_starts_when_written(self):
+        protocol, transport = self.make_protocol(
+            throttle_rate=1, throttle_burst=1)
+        for i in range(3):
+            protocol.send_message('2700000001', 'queued')
+        d1 = protocol.send_binary_message('2700000000', 'ff')
+        for _ in range(3):
+            self.clock.advance(1)
+        self.clock.advance(protocol.reply_timeout - 1)
+        self.assertNoResult(d1)
+        self.clock.advance(1)
+        self.failureResultOf(d1, TimeoutError)
+        # The late SEQ for the first message is not taken by the second.
+        d2 = protocol.send_binary_message('2700000000', 'ff')
+        self.clock.advance(1)
+        protocol.lineReceived(str(Seq(msisdn='2700000000', sequence='1')))
+        self.assertNoResult(d2)
+        protocol.lineReceived(str(Seq(msisdn='2700000000', sequence='2')))
+        self.assertEqual(self.successResultOf(d2).sequence, '2')
+
+    def test_unsent_claim_released(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.send_binary_message('2700000000', 'ff')
+        self.protocol.stopProducing()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertEqual(len(self.protocol.sequence_replies), 0)
+
+    def test_untracked_delivery(self):
+        self.send(Seq(msisdn='2700000000', sequence='1'))
+        self.send(DrMessage(msisdn='2700000000', sequence='1',
+                            ret_code=DR_SUCCESS))
+        delivery = self.protocol.deliveries.get('2700000000', '1')
+        self.assertTrue(delivery.reported)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.commands import BMoMessage, PremiumBMoMessage
+from txssmi.constants import CODING_8BIT, PROTOCOL_STANDARD
+from txssmi.protocol import SSMIProtocol
+from txssmi.reassembly import Reassembler
+from txssmi.segment import Segmenter
+
+
+class ReassemblerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.messages = []
+        self.reassembler = Reassembler(
+            self.messages.append, max_pending=2, timeout=60,
+            clock=self.clock)
+        self.addCleanup(self.reassembler.stop)
+        self.segmenter = Segmenter()
+
+    def parts(self, text, msisdn='2700000000'):
+        coding, hex_parts = self.segmenter.hex_parts(text)
+        return [BMoMessage(msisdn=msisdn, sequence=str(i), pid='0',
+                           coding=coding, hex_msg=hex_msg)
+                for i, hex_msg in enumerate(hex_parts)]
+
+    def test_single(self):
+        [part] = self.parts(u'hello')
+        self.reassembler.handle_part(part)
+        [message] = self.messages
+        self.assertEqual(message.content, u'hello')
+        self.assertEqual(message.msisdn, '2700000000')
+        self.assertEqual(message.command, part)
+
+    def test_gsm7_in_order(self):
+        text = u'{x}' * 100
+        parts = self.parts(text)
+        self.assertEqual(len(parts), 4)
+        for part in parts:
+            self.reassembler.handle_part(part)
+        [message] = self.messages
+        self.assertEqual(message.content, text)
+        self.assertEqual(message.parts, parts)
+        self.assertEqual(len(self.reassembler), 0)
+
+    def test_ucs2_out_of_order(self):
+        text = u'ሴ' * 100
+        parts = self.parts(text)
+        for part in reversed(parts):
+            self.reassembler.handle_part(part)
+        [message] = self.messages
+        self.assertEqual(message.content, text)
+        self.assertEqual(message.parts, parts)
+
+    def test_8bit(self):
+        part = BMoMessage(msisdn='2700000000', sequence='1', pid='0',
+                          coding=CODING_8BIT, hex_msg='0001ff')
+        self.reassembler.handle_part(part)
+        self.assertEqual(self.messages[0].content, b'\x00\x01\xff')
+
+    def test_interleaved(self):
+        self.reassembler.max_pending = 3
+        first = self.parts(u'a' * 200)
+        second = self.parts(u'b' * 200)
+        other = self.parts(u'c' * 200, msisdn='2700000001')
+        for parts in zip(first, second, other):
+            for part in parts:
+                self.reassembler.handle_part(part)
+        self.assertEqual(
+            sorted(message.content for message in self.messages),
+            [u'a' * 200, u'b' * 200, u'c' * 200])
+
+    def test_duplicate_part(self):
+        first, second = self.parts(u'a' * 200)
+        self.reassembler.handle_part(first)
+        self.reassembler.handle_part(first)
+        self.assertEqual(self.reassembler.duplicates, 1)
+        self.reassembler.handle_part(second)
+        self.assertEqual([m.content for m in self.messages], [u'a' * 200])
+
+    def test_timeout(self):
+        first, second = self.parts(u'a' * 200)
+        self.reassembler.handle_part(first)
+        self.clock.advance(30)
+        third, _ = self.parts(u'b' * 200)
+        self.reassembler.handle_part(third)
+        self.clock.advance(30)
+        self.assertEqual(len(self.reassembler), 1)
+        self.assertEqual(self.reassembler.expired, 1)
+        self.reassembler.handle_part(second)
+        self.assertEqual(self.messages, [])
+        self.clock.advance(30)
+        self.assertEqual(len(self.reassembler), 1)
+        self.assertEqual(self.reassembler.expired, 2)
+        self.clock.advance(60)
+        self.assertEqual(len(self.reassembler), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_max_pending(self):
+        firsts = [self.parts(text * 200)[0] for text in u'abc']
+        for part in firsts:
+            self.reassembler.handle_part(part)
+        self.assertEqual(len(self.reassembler), 2)
+        self.assertEqual(self.reassembler.evicted, 1)
+        self.assertEqual(self.reassembler.snapshot()['pending'], 2)
+
+    def test_invalid_hex(self):
+        self.reassembler.handle_part(BMoMessage(
+            msisdn='2700000000', sequence='1', pid='0', coding='0',
+            hex_msg='zz'))
+        self.assertEqual(self.messages, [])
+
+    def test_handler_error(self):
+        def handler(message):
+            raise ValueError('boom')
+
+        self.reassembler.handler = handler
+        self.reassembler.handle_part(self.parts(u'hi')[0])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.reassembler.delivered, 1)
+
+    def test_attach(self):
+        protocol = SSMIProtocol()
+        protocol.makeConnection(StringTransport())
+        self.reassembler.attach(protocol)
+        first, second = self.parts(u'a' * 200)
+        protocol.dataReceived(first.to_bytes() + b'\r')
+        protocol.dataReceived(PremiumBMoMessage(
+            msisdn=second.msisdn, sequence=second.sequence, pid=second.pid,
+            coding=second.coding, destination='1234',
+            hex_msg=second.hex_msg).to_bytes() + b'\r')
+        [message] = self.messages
+        self.assertEqual(message.content, u'a' * 200)
+        self.assertEqual(message.parts[1].destination, '1234')
+        self.assertEqual(message.command.pid, PROTOCOL_STANDARD)
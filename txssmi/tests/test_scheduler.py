@@ -0,0 +1,88 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txssmi.scheduler import (
+    LaneScheduler, LANE_USSD, LANE_CONTROL, LANE_SMS, LANE_BULK)
+from txssmi.throttle import TokenBucket
+
+
+class LaneSchedulerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = LaneScheduler(clock=self.clock)
+
+    def fill(self, lane, count):
+        for i in range(count):
+            self.scheduler.put(lane, '%s-%s' % (lane, i))
+
+    def taken(self, count, throttle=None):
+        return [command for command, _ in
+                self.scheduler.take(count, throttle=throttle)]
+
+    def test_empty(self):
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.take(10), [])
+
+    def test_depth(self):
+        self.fill(LANE_SMS, 2)
+        self.fill(LANE_CONTROL, 1)
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(self.scheduler.depth(LANE_SMS), 2)
+        self.assertEqual(self.scheduler.throttled_depth(), 2)
+
+    def test_single_lane_is_fifo(self):
+        self.fill(LANE_BULK, 5)
+        self.assertEqual(self.taken(3), ['bulk-0', 'bulk-1', 'bulk-2'])
+        self.assertEqual(self.taken(3), ['bulk-3', 'bulk-4'])
+
+    def test_weighted_round_robin(self):
+        self.fill(LANE_BULK, 30)
+        self.fill(LANE_SMS, 30)
+        self.fill(LANE_USSD, 30)
+        lanes = [command.split('-')[0] for command in self.taken(33)]
+        self.assertEqual(lanes, (
+            ['ussd'] * 8 + ['sms'] * 2 + ['bulk']) * 3)
+
+    def test_ussd_overtakes_bulk(self):
+        self.fill(LANE_BULK, 10)
+        self.assertEqual(self.taken(1), ['bulk-0'])
+        self.fill(LANE_USSD, 1)
+        self.assertEqual(self.taken(2), ['ussd-0', 'bulk-1'])
+
+    def test_blocked_lanes_keep_their_turn(self):
+        throttle = TokenBucket(10, burst=1, clock=self.clock)
+        self.fill(LANE_SMS, 3)
+        self.assertEqual(self.taken(1, throttle), ['sms-0'])
+        self.assertEqual(self.taken(1, throttle), [])
+        self.fill(LANE_BULK, 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.taken(1, throttle), ['sms-1'])
+
+    def test_throttle(self):
+        throttle = TokenBucket(10, burst=2, clock=self.clock)
+        self.fill(LANE_SMS, 3)
+        self.fill(LANE_CONTROL, 3)
+        self.assertEqual(
+            self.taken(10, throttle),
+            ['control-0', 'control-1', 'control-2', 'sms-0', 'sms-1'])
+        self.assertEqual(throttle.available(), 0)
+        self.assertEqual(self.taken(10, throttle), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.taken(10, throttle), ['sms-2'])
+
+    def test_latency(self):
+        self.fill(LANE_SMS, 1)
+        self.clock.advance(0.2)
+        self.taken(1)
+        latency = self.scheduler.lane_map[LANE_SMS].latency
+        self.assertEqual(latency.count, 1)
+        self.assertEqual(latency.percentile(99), 0.25)
+
+    def test_clear(self):
+        self.fill(LANE_SMS, 1)
+        self.fill(LANE_BULK, 1)
+        self.assertEqual(
+            [command for command, _ in self.scheduler.clear()],
+            ['sms-0', 'bulk-0'])
+        self.assertEqual(len(self.scheduler), 0)
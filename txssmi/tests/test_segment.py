@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import binascii
+
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMICommandException
+from txssmi.constants import CODING_7BIT, CODING_8BIT, CODING_UCS2
+from txssmi.segment import (
+    Segmenter, gsm7_septets, pack_septets, unpack_septets, gsm7_decode,
+    coding_alphabet, parse_concat_header, ALPHABET_GSM7, ALPHABET_8BIT,
+    ALPHABET_UCS2)
+
+
+class SegmentTestCase(TestCase):
+
+    def setUp(self):
+        self.segmenter = Segmenter()
+
+    def test_gsm7_septets(self):
+        self.assertEqual(gsm7_septets(u'@A'), [(0x00,), (0x41,)])
+        self.assertEqual(gsm7_septets(u'€'), [(0x1B, 0x65)])
+        self.assertEqual(gsm7_septets(u'\x1b'), None)
+        self.assertEqual(gsm7_septets(u'ሴ'), None)
+
+    def test_pack_septets(self):
+        septets = [(ord(char),) for char in u'hellohello']
+        self.assertEqual(
+            binascii.hexlify(pack_septets([s for s, in septets])),
+            b'e8329bfd4697d9ec37')
+
+    def test_pack_septets_fill_bits(self):
+        self.assertEqual(pack_septets([0x7F], 1), b'\xfe')
+        self.assertEqual(pack_septets([0x7F, 0x7F], 1), b'\xfe\x7f')
+
+    def test_single_gsm7(self):
+        coding, [part] = self.segmenter.split(u'x' * 160)
+        self.assertEqual(coding, CODING_7BIT)
+        self.assertEqual(len(part), 140)
+        self.assertEqual(self.segmenter.reference, 0)
+
+    def test_single_ucs2(self):
+        coding, [part] = self.segmenter.split(u'ሴ' * 70)
+        self.assertEqual(coding, CODING_UCS2)
+        self.assertEqual(part, u'ሴ'.encode('utf-16-be') * 70)
+
+    def test_concatenated_gsm7(self):
+        coding, parts = self.segmenter.split(u'x' * 161)
+        self.assertEqual(coding, CODING_7BIT)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[0][:6], b'\x05\x00\x03\x01\x02\x01')
+        self.assertEqual(parts[1][:6], b'\x05\x00\x03\x01\x02\x02')
+        self.assertEqual(len(parts[0]), 140)
+        # 8 remaining septets after the fill bit.
+        self.assertEqual(len(parts[1]), 6 + 57 // 8 + 1)
+
+    def test_concatenated_ucs2(self):
+        coding, parts = self.segmenter.split(u'ሴ' * 71)
+        self.assertEqual(coding, CODING_UCS2)
+        self.assertEqual([len(part) for part in parts], [140, 14])
+        self.assertEqual(parts[1][6:], u'ሴ'.encode('utf-16-be') * 4)
+
+    def test_escape_not_split(self):
+        coding, parts = self.segmenter.split(u'x' * 152 + u'€' * 5)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(self.segmenter.count(u'x' * 152 + u'€' * 5),
+                         (CODING_7BIT, 2))
+
+    def test_surrogate_not_split(self):
+        text = u'ሴ' * 66 + u'\U0001F600' + u'ሴ' * 3
+        self.assertEqual(self.segmenter.count(text), (CODING_UCS2, 2))
+        coding, parts = self.segmenter.split(text)
+        self.assertEqual(parts[0][6:], u'ሴ'.encode('utf-16-be') * 66)
+        self.assertEqual(parts[1][6:],
+                         (u'\U0001F600' + u'ሴ' * 3).encode('utf-16-be'))
+
+    def test_references(self):
+        self.segmenter.reference = 255
+        _, parts = self.segmenter.split(u'x' * 161)
+        self.assertEqual(parts[0][3:4], b'\x00')
+        _, parts = self.segmenter.split(u'x' * 161)
+        self.assertEqual(parts[0][3:4], b'\x01')
+
+    def test_count(self):
+        self.assertEqual(self.segmenter.count(u''), (CODING_7BIT, 1))
+        self.assertEqual(self.segmenter.count(u'x' * 306), (CODING_7BIT, 2))
+        self.assertEqual(self.segmenter.count(u'x' * 307), (CODING_7BIT, 3))
+        self.assertEqual(self.segmenter.count(u'ሴ' * 134),
+                         (CODING_UCS2, 2))
+
+    def test_too_long(self):
+        self.segmenter.max_parts = 2
+        self.assertRaises(
+            SSMICommandException, self.segmenter.split, u'x' * 307)
+
+    def test_hex_parts(self):
+        text = u'x' * 200
+        coding, hex_parts = self.segmenter.hex_parts(text)
+        self.segmenter.reference = 0
+        _, parts = self.segmenter.split(text)
+        self.assertEqual(
+            [binascii.unhexlify(hex_msg) for hex_msg in hex_parts], parts)
+
+    def test_unpack_septets(self):
+        packed = pack_septets([ord(char) for char in 'hellohello'])
+        self.assertEqual(unpack_septets(packed),
+                         [ord(char) for char in 'hellohello'])
+        self.assertEqual(unpack_septets(b'\xfe\x7f', 1), [0x7F, 0x7F])
+
+    def test_unpack_septets_padding(self):
+        self.assertEqual(unpack_septets(pack_septets([0x41] * 7)),
+                         [0x41] * 7)
+        self.assertEqual(unpack_septets(pack_septets([0x41] * 8)),
+                         [0x41] * 8)
+
+    def test_gsm7_decode(self):
+        text = u'caf\xe9 {€} @'
+        septets = [s for unit in gsm7_septets(text) for s in unit]
+        self.assertEqual(gsm7_decode(septets), text)
+        self.assertEqual(gsm7_decode([0x1B, 0x41]), u'A')
+
+    def test_coding_alphabet(self):
+        self.assertEqual(coding_alphabet(CODING_7BIT), ALPHABET_GSM7)
+        self.assertEqual(coding_alphabet(CODING_8BIT), ALPHABET_8BIT)
+        self.assertEqual(coding_alphabet(CODING_UCS2), ALPHABET_UCS2)
+        self.assertEqual(coding_alphabet('4'), ALPHABET_8BIT)
+        self.assertEqual(coding_alphabet(''), ALPHABET_GSM7)
+
+    def test_parse_concat_header(self):
+        _, parts = self.segmenter.split(u'x' * 161)
+        self.assertEqual(parse_concat_header(parts[1]), (1, 2, 2, 6))
+        self.assertEqual(
+            parse_concat_header(b'\x06\x08\x04\x12\x34\x03\x01data'),
+            (0x1234, 3, 1, 7))
+        self.assertEqual(parse_concat_header(b'hello'), None)
+        self.assertEqual(parse_concat_header(b''), None)
+        self.assertEqual(
+            parse_concat_header(b'\x05\x00\x03\x01\x02\x03'), None)
@@ -0,0 +1,155 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIResponse, SSMICommandException
+from txssmi.commands import (
+    Login, LinkCheck, SendSMS, SendUSSDMessage, IMSILookup, ClientLogout)
+from txssmi.constants import USSD_NEW
+from txssmi.server import SSMIServerFactory
+
+
+class SSMIServerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIServerFactory, 'clock', self.clock)
+
+    def connect(self, login=True, **kwargs):
+        factory = SSMIServerFactory('username', 'password', **kwargs)
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        if login:
+            self.send(protocol, Login(username='username',
+                                      password='password'))
+            self.replies(protocol)
+        return factory, protocol
+
+    def send(self, protocol, command):
+        protocol.lineReceived(command.to_bytes())
+
+    def replies(self, protocol):
+        lines = protocol.transport.value().split(b'\r')
+        protocol.transport.clear()
+        return [SSMIResponse.from_bytes(line) for line in lines if line]
+
+    def test_login(self):
+        factory, protocol = self.connect(login=False)
+        self.send(protocol, Login(username='username', password='password'))
+        [ack] = self.replies(protocol)
+        self.assertEqual(ack.command_name, 'ACK')
+        self.assertEqual(ack.ack_type, '1')
+        self.assertTrue(protocol.authenticated)
+        self.assertEqual(factory.connections, [protocol])
+
+    def test_login_failed(self):
+        factory, protocol = self.connect(login=False)
+        self.send(protocol, Login(username='username', password='wrong'))
+        [nack] = self.replies(protocol)
+        self.assertEqual(nack.command_name, 'NACK')
+        self.assertFalse(protocol.authenticated)
+
+    def test_not_logged_in(self):
+        factory, protocol = self.connect(login=False)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        [nack] = self.replies(protocol)
+        self.assertEqual(nack.command_name, 'NACK')
+
+    def test_unparseable(self):
+        factory, protocol = self.connect()
+        protocol.lineReceived(b'SSMI,12345,foo')
+        [nack] = self.replies(protocol)
+        self.assertEqual(nack.command_name, 'NACK')
+        self.flushLoggedErrors(SSMICommandException)
+
+    def test_link_check(self):
+        factory, protocol = self.connect()
+        self.send(protocol, LinkCheck())
+        [ack] = self.replies(protocol)
+        self.assertEqual(ack.ack_type, '2')
+
+    def test_send_sms(self):
+        factory, protocol = self.connect()
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        seq, dr = self.replies(protocol)
+        self.assertEqual(seq.command_name, 'SEQ')
+        self.assertEqual(seq.msisdn, '2700000000')
+        self.assertEqual(dr.command_name, 'DR')
+        self.assertEqual(dr.sequence, seq.sequence)
+        self.assertEqual(factory.received['SEND_SMS'], 1)
+        self.assertEqual(factory.sent['SEQ'], 1)
+
+    def test_send_sms_delays(self):
+        factory, protocol = self.connect(seq_delay=1, dr_delay=5)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        self.assertEqual(self.replies(protocol), [])
+        self.clock.advance(1)
+        [seq] = self.replies(protocol)
+        self.assertEqual(seq.command_name, 'SEQ')
+        self.clock.advance(4)
+        [dr] = self.replies(protocol)
+        self.assertEqual(dr.command_name, 'DR')
+
+    def test_no_drs(self):
+        factory, protocol = self.connect(dr_delay=None)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        [seq] = self.replies(protocol)
+        self.assertEqual(seq.command_name, 'SEQ')
+
+    def test_nack_rate(self):
+        factory, protocol = self.connect(nack_rate=1.0)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        [nack] = self.replies(protocol)
+        self.assertEqual(nack.command_name, 'NACK')
+
+    def test_nack_rate_seeded(self):
+        factory, protocol = self.connect(nack_rate=0.5, seed=1,
+                                         dr_delay=None)
+        for i in range(100):
+            self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        nacks = [cmd for cmd in self.replies(protocol)
+                 if cmd.command_name == 'NACK']
+        self.assertTrue(30 < len(nacks) < 70)
+
+    def test_logout_after(self):
+        factory, protocol = self.connect(logout_after=2, dr_delay=None)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        self.assertFalse(protocol.transport.disconnecting)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='bar'))
+        seq1, seq2, logout = self.replies(protocol)
+        self.assertEqual(logout.command_name, 'LOGOUT')
+        self.assertTrue(protocol.transport.disconnecting)
+
+    def test_client_logout(self):
+        factory, protocol = self.connect()
+        self.send(protocol, ClientLogout())
+        self.assertTrue(protocol.transport.disconnecting)
+
+    def test_ussd(self):
+        factory, protocol = self.connect()
+        self.send(protocol, SendUSSDMessage(msisdn='2700000000',
+                                            type=USSD_NEW, message='foo'))
+        self.assertEqual(self.replies(protocol), [])
+        self.assertEqual(factory.received['SEND_USSD_MESSAGE'], 1)
+
+    def test_imsi_lookup(self):
+        factory, protocol = self.connect()
+        self.send(protocol, IMSILookup(sequence='5', msisdn='2700000000'))
+        [reply] = self.replies(protocol)
+        self.assertEqual(reply.command_name, 'IMSI_LOOKUP_REPLY')
+        self.assertEqual(reply.sequence, '5')
+        self.assertEqual(reply.imsi, factory.imsi)
+
+    def test_send_mo(self):
+        factory, protocol = self.connect()
+        factory.send_mo('2700000000', 'hello')
+        [mo] = self.replies(protocol)
+        self.assertEqual(mo.command_name, 'MO')
+        self.assertEqual(mo.message, 'hello')
+
+    def test_connection_lost_cancels_pending(self):
+        factory, protocol = self.connect(seq_delay=1)
+        self.send(protocol, SendSMS(msisdn='2700000000', message='foo'))
+        protocol.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(factory.connections, [])
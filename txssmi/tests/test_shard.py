@@ -0,0 +1,324 @@
+import json
+
+from twisted.internet.defer import succeed
+from twisted.internet.error import ProcessDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIException
+from txssmi.commands import (
+    SendSMS, Seq, MoMessage, DrMessage, USSDMessage, SendUSSDMessage)
+from txssmi.constants import USSD_NEW, USSD_END, USSD_RESPONSE
+from txssmi.pool import SSMIPool
+from txssmi.protocol import SSMIProtocol
+from txssmi.shard import (
+    ShardSupervisor, ShardWorker, WorkerProcess, RemoteError, shard_for,
+    encode_value, decode_value)
+from txssmi.tests.test_pool import FakeEndpoint
+
+
+def messages(transport):
+    lines = transport.value().split(b'\n')
+    transport.clear()
+    return [json.loads(line.decode('utf-8')) for line in lines if line]
+
+
+def feed(worker, *messages):
+    worker.childDataReceived(1, b''.join(
+        json.dumps(message).encode('utf-8') + b'\n'
+        for message in messages))
+
+
+class ShardTestCase(TestCase):
+
+    def test_shard_for(self):
+        self.assertEqual(shard_for('2700000000', 4),
+                         shard_for(u'2700000000', 4))
+        shards = [shard_for('27000%05d' % (i,), 4) for i in range(1000)]
+        self.assertEqual(set(shards), set([0, 1, 2, 3]))
+        self.assertTrue(all(shards.count(i) > 200 for i in range(4)))
+
+    def test_encode_value(self):
+        values = [
+            None, 'foo', SendSMS(msisdn='2700000000', message='a,b'),
+            [Seq(msisdn='2700000000', sequence='1')],
+        ]
+        for value in values:
+            encoded = json.loads(json.dumps(encode_value(value)))
+            self.assertEqual(decode_value(encoded), value)
+
+
+class ShardSupervisorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(ShardSupervisor, 'clock', self.clock)
+        self.supervisor = ShardSupervisor(
+            'tcp:host=127.0.0.1:port=2222', 'username', 'password',
+            workers=2)
+        self.spawned = []
+        self.patch(self.supervisor, 'spawn_worker', self.spawn_worker)
+
+    def spawn_worker(self, index):
+        worker = WorkerProcess(self.supervisor, index)
+        worker.makeConnection(StringTransport())
+        self.spawned.append(worker)
+        return worker
+
+    def start(self):
+        d = self.supervisor.start()
+        for worker in self.supervisor.workers:
+            feed(worker, {'ready': worker.index})
+        return self.successResultOf(d)
+
+    def msisdn_for(self, index):
+        return next('27000%05d' % (i,) for i in range(100)
+                    if shard_for('27000%05d' % (i,), 2) == index)
+
+    def test_start(self):
+        d = self.supervisor.start()
+        worker0, worker1 = self.supervisor.workers
+        [config] = messages(worker0.transport)
+        self.assertEqual(config['config'], {
+            'index': 0,
+            'endpoint': 'tcp:host=127.0.0.1:port=2222',
+            'username': 'username',
+            'password': 'password',
+            'connections': 1,
+        })
+        feed(worker0, {'ready': 0})
+        self.assertNoResult(d)
+        feed(worker1, {'ready': 1})
+        self.assertEqual(self.successResultOf(d), self.supervisor)
+
+    def test_not_ready(self):
+        self.supervisor.start()
+        self.failureResultOf(
+            self.supervisor.send_message('2700000000', 'foo'), SSMIException)
+
+    def test_routing(self):
+        self.start()
+        for index in (0, 1):
+            worker = self.supervisor.workers[index]
+            messages(worker.transport)
+            msisdn = self.msisdn_for(index)
+            d = self.supervisor.send_message(msisdn, 'foo')
+            [request] = messages(worker.transport)
+            self.assertEqual(request['method'], 'send_message')
+            self.assertEqual(request['args'], [msisdn, 'foo'])
+            self.assertEqual(request['kwargs'], {'validity': '0'})
+            command = SendSMS(msisdn=msisdn, message='foo')
+            feed(worker, {'id': request['request'],
+                          'result': encode_value(command)})
+            self.assertEqual(self.successResultOf(d), command)
+
+    def test_remote_error(self):
+        self.start()
+        worker = self.supervisor.workers[0]
+        messages(worker.transport)
+        d = self.supervisor.send_message(self.msisdn_for(0), 'foo')
+        [request] = messages(worker.transport)
+        feed(worker, {'id': request['request'],
+                      'error': ['TimeoutError', 'No reply']})
+        failure = self.failureResultOf(d, RemoteError)
+        self.assertEqual(failure.value.error_type, 'TimeoutError')
+
+    def test_send_messages(self):
+        self.start()
+        for worker in self.supervisor.workers:
+            messages(worker.transport)
+        pairs = [(self.msisdn_for(0), 'a'), (self.msisdn_for(1), 'b'),
+                 (self.msisdn_for(0), 'c')]
+        d = self.supervisor.send_messages(pairs, validity='2')
+        for worker in self.supervisor.workers:
+            [request] = messages(worker.transport)
+            [shard] = request['args']
+            self.assertEqual(
+                shard, [[m, t] for m, t in pairs
+                        if shard_for(m, 2) == worker.index])
+            feed(worker, {'id': request['request'], 'result': encode_value(
+                [SendSMS(msisdn=m, message=t, validity='2')
+                 for m, t in shard])})
+        self.assertEqual(
+            sorted(command.message for command in self.successResultOf(d)),
+            ['a', 'b', 'c'])
+
+    def test_events(self):
+        self.start()
+        received = []
+        self.supervisor.register_handler('MO', received.append)
+        self.supervisor.register_handler('DR', received.append)
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='hi')
+        dr = DrMessage(msisdn='2700000000', sequence='1', ret_code='0')
+        feed(self.supervisor.workers[1], {'events': [str(mo), str(dr)]})
+        self.assertEqual(received, [mo, dr])
+
+    def test_register_unknown_handler(self):
+        self.assertRaises(SSMIException, self.supervisor.register_handler,
+                          'SEQ', lambda command: None)
+
+    def test_handler_error(self):
+        self.start()
+
+        def handler(command):
+            raise ValueError('boom')
+
+        self.supervisor.register_handler('MO', handler)
+        feed(self.supervisor.workers[0], {'events': [str(MoMessage(
+            msisdn='2700000000', sequence='1', message='hi'))]})
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_ussd_pinned(self):
+        self.start()
+        msisdn = self.msisdn_for(0)
+        worker0, worker1 = self.supervisor.workers
+        feed(worker1, {'events': [str(USSDMessage(
+            msisdn=msisdn, type=USSD_NEW, phase='2', message='*123#'))]})
+        messages(worker1.transport)
+        self.supervisor.send_ussd_message(msisdn, 'menu', USSD_RESPONSE)
+        [request] = messages(worker1.transport)
+        self.assertEqual(request['method'], 'send_ussd_message')
+        self.supervisor.send_ussd_message(msisdn, 'bye', USSD_END)
+        self.assertEqual(len(messages(worker1.transport)), 1)
+        self.assertEqual(self.supervisor.pins, {})
+        messages(worker0.transport)
+        self.supervisor.send_ussd_message(msisdn, 'again', USSD_NEW)
+        self.assertEqual(len(messages(worker0.transport)), 1)
+
+    def test_worker_restarted(self):
+        self.start()
+        worker = self.supervisor.workers[0]
+        messages(worker.transport)
+        d = self.supervisor.send_message(self.msisdn_for(0), 'foo')
+        worker.processEnded(Failure(ProcessDone(0)))
+        self.failureResultOf(d, SSMIException)
+        self.assertEqual(len(self.spawned), 2)
+        self.clock.advance(self.supervisor.restart_delay)
+        self.assertEqual(len(self.spawned), 3)
+        self.assertEqual(self.supervisor.workers[0].index, 0)
+        self.assertFalse(self.supervisor.workers[0].ready)
+
+    def test_stop(self):
+        self.start()
+        d = self.supervisor.stop()
+        for worker in self.supervisor.workers:
+            self.assertEqual(messages(worker.transport)[-1], {'stop': True})
+            self.assertNoResult(d)
+            worker.processEnded(Failure(ProcessDone(0)))
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_metrics(self):
+        self.start()
+        snapshot = {
+            'sent': {'SEND_SMS': 2}, 'received': {}, 'bytes_out': 10,
+            'bytes_in': 0, 'queue_depths': {}, 'timings': {},
+        }
+        for worker in self.supervisor.workers:
+            feed(worker, {'metrics': snapshot})
+        merged = self.supervisor.snapshot()
+        self.assertEqual(merged['sent'], {'SEND_SMS': 4})
+        self.assertEqual(merged['bytes_out'], 20)
+        self.assertEqual(merged['ready'], 2)
+
+
+class ShardWorkerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIPool, 'clock', self.clock)
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.endpoint = FakeEndpoint()
+        self.worker = ShardWorker(clock=self.clock)
+        self.patch(self.worker, 'make_endpoint', lambda _: self.endpoint)
+        self.transport = StringTransport()
+        self.worker.channel.makeConnection(self.transport)
+        self.addCleanup(self.worker.stop)
+
+    def send(self, message):
+        self.worker.channel.dataReceived(
+            json.dumps(message).encode('utf-8') + b'\n')
+
+    def configure(self):
+        self.send({'config': {
+            'index': 1, 'endpoint': 'tcp:host=127.0.0.1:port=2222',
+            'username': 'username', 'password': 'password',
+            'connections': 1,
+        }})
+        [protocol] = self.endpoint.protocols
+        protocol.dataReceived(b'SSMI,101,1\r')
+        protocol.transport.clear()
+        return protocol
+
+    def test_configure(self):
+        protocol = self.configure()
+        self.assertEqual(messages(self.transport), [{'ready': 1}])
+        self.assertEqual(protocol.metrics, self.worker.metrics)
+
+    def test_request(self):
+        protocol = self.configure()
+        messages(self.transport)
+        self.send({'request': 7, 'method': 'send_message',
+                   'args': ['2700000000', 'foo'], 'kwargs': {}})
+        self.assertEqual(protocol.transport.value(),
+                         b'SSMI,2,0,2700000000,foo\r')
+        [reply] = messages(self.transport)
+        self.assertEqual(reply['id'], 7)
+        self.assertEqual(decode_value(reply['result']),
+                         SendSMS(msisdn='2700000000', message='foo'))
+
+    def test_request_error(self):
+        self.configure()
+        messages(self.transport)
+        self.patch(self.worker.pool, 'send_message',
+                   lambda *args: succeed(None).addCallback(
+                       lambda _: 1 / 0))
+        self.send({'request': 1, 'method': 'send_message',
+                   'args': ['2700000000', 'foo'], 'kwargs': {}})
+        [reply] = messages(self.transport)
+        self.assertEqual(reply['error'][0], 'ZeroDivisionError')
+
+    def test_unknown_method(self):
+        self.configure()
+        messages(self.transport)
+        self.send({'request': 1, 'method': 'stop', 'args': [], 'kwargs': {}})
+        [reply] = messages(self.transport)
+        self.assertEqual(reply['error'][0], 'SSMIException')
+
+    def test_forward_events(self):
+        protocol = self.configure()
+        messages(self.transport)
+        mo = MoMessage(msisdn='2700000000', sequence='1', message='hi')
+        ussd = USSDMessage(msisdn='2700000000', type=USSD_NEW, phase='2',
+                           message='*123#')
+        seq = Seq(msisdn='2700000000', sequence='1')
+        protocol.dataReceived(b''.join(
+            command.to_bytes() + b'\r' for command in (mo, seq, ussd)))
+        self.assertEqual(messages(self.transport), [])
+        self.clock.advance(self.worker.event_interval)
+        self.assertEqual(messages(self.transport),
+                         [{'events': [str(mo), str(ussd)]}])
+
+    def test_metrics(self):
+        protocol = self.configure()
+        messages(self.transport)
+        protocol.send_command(SendUSSDMessage(
+            msisdn='2700000000', type=USSD_NEW, message='hi'))
+        self.clock.advance(self.worker.metrics_interval)
+        [report] = messages(self.transport)
+        self.assertEqual(report['metrics']['sent'],
+                         {'SEND_USSD_MESSAGE': 1})
+
+    def test_stop(self):
+        protocol = self.configure()
+        self.send({'stop': True})
+        self.successResultOf(self.worker.done)
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertFalse(self.worker.metrics_call.running)
+
+    def test_parent_gone(self):
+        self.configure()
+        self.worker.channel.connectionLost(Failure(ProcessDone(0)))
+        self.successResultOf(self.worker.done)
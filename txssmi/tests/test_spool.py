@@ -0,0 +1,247 @@
+import os
+
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIRequest
+from txssmi.commands import SendSMS, SendUSSDMessage, Seq
+from txssmi.constants import USSD_NEW
+from txssmi.protocol import SSMIProtocol
+from txssmi.spool import Spool, SpoolSender
+
+
+def sms(i):
+    return SendSMS(msisdn='27000000%02d' % (i,), message='hi %s' % (i,),
+                   validity='0')
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def make_spool(self, **kwargs):
+        spool = Spool(self.path, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_append(self):
+        spool = self.make_spool()
+        self.assertEqual(spool.append(sms(1)), 1)
+        self.assertEqual(spool.append(sms(2)), 2)
+        self.assertEqual(list(spool), [(1, sms(1)), (2, sms(2))])
+        self.assertEqual(len(spool), 2)
+
+    def test_recover(self):
+        spool = self.make_spool()
+        spool.append(sms(1))
+        spool.append(sms(2))
+        spool.ack(1)
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [(2, sms(2))])
+        self.assertEqual(spool.append(sms(3)), 3)
+
+    def test_recover_empty(self):
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [])
+        self.assertEqual(spool.next_id, 1)
+
+    def test_recover_torn_record(self):
+        spool = self.make_spool()
+        spool.append(sms(1))
+        spool.append(sms(2))
+        spool.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 3)
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [(1, sms(1))])
+        spool.append(sms(3))
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [(1, sms(1)), (2, sms(3))])
+
+    def test_recover_torn_ack(self):
+        spool = self.make_spool()
+        for i in range(1, 6):
+            spool.append(sms(i))
+        spool.ack(1)
+        spool.close()
+        with open(self.path + '.acks', 'ab') as f:
+            f.write(b'\x00\x00\x00')
+        spool = self.make_spool()
+        self.assertEqual([record_id for record_id, _ in spool],
+                         [2, 3, 4, 5])
+        spool.ack(2)
+        spool.ack(3)
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual([record_id for record_id, _ in spool], [4, 5])
+        self.assertEqual(os.path.getsize(self.path + '.acks'),
+                         3 * Spool.ack_record.size)
+
+    def test_recover_corrupt_record(self):
+        spool = self.make_spool()
+        spool.append(sms(1))
+        spool.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [])
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_ack_unknown(self):
+        spool = self.make_spool()
+        spool.ack(5)
+        self.assertEqual(os.path.getsize(spool.ack_path), 0)
+
+    def test_compact(self):
+        spool = self.make_spool(compact_after=3)
+        for i in range(5):
+            spool.append(sms(i))
+        size = os.path.getsize(self.path)
+        spool.ack(1)
+        spool.ack(2)
+        self.assertEqual(os.path.getsize(self.path), size)
+        spool.ack(4)
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.assertEqual(os.path.getsize(spool.ack_path), 0)
+        self.assertEqual(list(spool), [(3, sms(2)), (5, sms(4))])
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [(3, sms(2)), (5, sms(4))])
+        self.assertEqual(spool.append(sms(5)), 6)
+
+    def test_compact_everything(self):
+        spool = self.make_spool(compact_after=1)
+        spool.append(sms(1))
+        spool.ack(1)
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [])
+        record_id = spool.append(sms(2))
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [(record_id, sms(2))])
+
+    def test_recover_interrupted_compaction(self):
+        spool = self.make_spool(compact_after=100)
+        spool.append(sms(1))
+        spool.append(sms(2))
+        spool.ack(2)
+        # Acks left behind when a compaction did not get to clear them.
+        with open(self.path, 'wb'):
+            pass
+        spool.close()
+        spool = self.make_spool()
+        self.assertEqual(list(spool), [])
+        self.assertEqual(spool.append(sms(3)), 3)
+
+
+class SpoolSenderTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.spool = Spool(self.mktemp())
+        self.addCleanup(self.spool.close)
+        self.sender = SpoolSender(self.spool, clock=self.clock)
+
+    def connect(self):
+        protocol = SSMIProtocol()
+        protocol.makeConnection(StringTransport())
+        protocol.authenticated = True
+        self.sender.attach(protocol)
+        return protocol
+
+    def sent(self, protocol):
+        lines = protocol.transport.value().split(protocol.delimiter)
+        protocol.transport.clear()
+        return [SSMIRequest.from_bytes(line) for line in lines if line]
+
+    def test_send_without_protocol(self):
+        self.sender.send_message('2700000001', 'hi 1')
+        protocol = self.connect()
+        self.assertEqual(self.sent(protocol), [sms(1)])
+
+    def test_ack_on_seq(self):
+        protocol = self.connect()
+        self.sender.send_message('2700000001', 'hi 1')
+        self.assertEqual(self.sent(protocol), [sms(1)])
+        self.assertEqual(len(self.spool), 1)
+        protocol.lineReceived(str(Seq(msisdn='2700000001', sequence='1')))
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.sender.in_flight, set())
+
+    def test_ack_without_seq(self):
+        self.connect()
+        self.sender.send_command(SendUSSDMessage(
+            msisdn='2700000001', type=USSD_NEW, message='foo'))
+        self.assertEqual(len(self.spool), 0)
+
+    def test_resend_after_connection_lost(self):
+        protocol = self.connect()
+        self.sender.send_command(sms(1))
+        self.sender.send_command(sms(2))
+        protocol.lineReceived(str(Seq(msisdn='2700000001', sequence='1')))
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.sender.protocol, None)
+        protocol = self.connect()
+        self.assertEqual(self.sent(protocol), [sms(2)])
+
+    def test_resend_after_restart(self):
+        self.connect()
+        self.sender.send_command(sms(1))
+        self.spool.close()
+        self.spool = Spool(self.spool.path)
+        self.addCleanup(self.spool.close)
+        self.sender = SpoolSender(self.spool, clock=self.clock)
+        protocol = self.connect()
+        self.assertEqual(self.sent(protocol), [sms(1)])
+
+    def test_max_in_flight(self):
+        self.sender.max_in_flight = 2
+        for i in range(3):
+            self.sender.send_command(sms(i))
+        protocol = self.connect()
+        self.assertEqual(self.sent(protocol), [sms(0), sms(1)])
+        protocol.lineReceived(str(Seq(msisdn='2700000000', sequence='1')))
+        self.assertEqual(self.sent(protocol), [sms(2)])
+
+    def test_retry_after_timeout(self):
+        protocol = self.connect()
+        self.sender.send_command(sms(1))
+        self.sent(protocol)
+        self.clock.advance(protocol.reply_timeout)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(list(self.sender.queue), [1])
+        self.sender.send_command(sms(2))
+        self.assertEqual(self.sent(protocol), [sms(1), sms(2)])
+
+    def test_retry_without_new_traffic(self):
+        protocol = self.connect()
+        self.sender.send_command(sms(1))
+        self.sent(protocol)
+        self.clock.advance(protocol.reply_timeout)
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(self.sent(protocol), [])
+        self.clock.advance(self.sender.retry_delay)
+        self.assertEqual(self.sent(protocol), [sms(1)])
+        # The late SEQ for the first attempt, then the one for the retry.
+        protocol.lineReceived(str(Seq(msisdn='2700000001', sequence='1')))
+        self.assertEqual(len(self.spool), 1)
+        protocol.lineReceived(str(Seq(msisdn='2700000001', sequence='2')))
+        self.assertEqual(len(self.spool), 0)
+
+    def test_retry_cancelled_on_disconnect(self):
+        protocol = self.connect()
+        self.sender.send_command(sms(1))
+        self.clock.advance(protocol.reply_timeout)
+        self.flushLoggedErrors()
+        protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.sender.retry_call, None)
@@ -0,0 +1,44 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txssmi.throttle import TokenBucket
+
+
+class TokenBucketTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst_defaults_to_rate(self):
+        bucket = TokenBucket(10, clock=self.clock)
+        self.assertEqual(bucket.burst, 10)
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, TokenBucket, 0, clock=self.clock)
+
+    def test_consume_within_burst(self):
+        bucket = TokenBucket(10, burst=3, clock=self.clock)
+        self.assertEqual(bucket.available(), 3)
+        bucket.consume(3)
+        self.assertEqual(bucket.available(), 0)
+        self.assertEqual(bucket.tokens, 0)
+
+    def test_delay(self):
+        bucket = TokenBucket(10, burst=1, clock=self.clock)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.consume(1)
+        self.assertAlmostEqual(bucket.delay(), 0.1)
+        self.assertAlmostEqual(bucket.delay(3), 0.3)
+        self.clock.advance(0.1)
+        self.assertEqual(bucket.available(), 1)
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(10, burst=5, clock=self.clock)
+        bucket.consume(5)
+        self.clock.advance(0.2)
+        self.assertAlmostEqual(bucket.tokens, 2)
+        self.assertEqual(bucket.available(), 2)
+        self.clock.advance(60)
+        self.assertEqual(bucket.tokens, 5)
@@ -0,0 +1,205 @@
+import os
+import sys
+from io import StringIO
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import TestCase
+
+from txssmi.commands import Ack, Seq, MoMessage, SendSMS
+from txssmi.protocol import SSMIProtocol
+from txssmi.trace import (
+    TraceRecorder, TraceReplayer, TraceFormatError, read_trace, read_traces,
+    replay_protocol, dump, main, NullTransport, Options, RECEIVED, SENT,
+    TRACE_MAGIC)
+
+
+class TraceRecorderTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.path = self.mktemp()
+
+    def recorder(self, **kw):
+        recorder = TraceRecorder(self.path, clock=self.clock, **kw)
+        self.addCleanup(recorder.close)
+        return recorder
+
+    def test_record(self):
+        recorder = self.recorder()
+        recorder.received(b'SSMI,100,2700000000,1')
+        self.clock.advance(1.5)
+        recorder.sent(memoryview(b'SSMI,3\rSSMI,3'))
+        recorder.close()
+        self.assertEqual(list(read_trace(self.path)), [
+            (0, RECEIVED, b'SSMI,100,2700000000,1'),
+            (1.5, SENT, b'SSMI,3\rSSMI,3'),
+        ])
+
+    def test_append(self):
+        recorder = self.recorder()
+        recorder.received(b'a')
+        recorder.close()
+        recorder = self.recorder()
+        recorder.received(b'b')
+        recorder.close()
+        self.assertEqual(
+            [data for _, _, data in read_trace(self.path)], [b'a', b'b'])
+
+    def test_rotate(self):
+        recorder = self.recorder(max_bytes=len(TRACE_MAGIC) + 30,
+                                 backup_count=2)
+        for data in [b'a' * 10, b'b' * 10, b'c' * 10, b'd' * 10]:
+            recorder.received(data)
+        recorder.close()
+        self.assertEqual(recorder.rotations, 3)
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        self.assertEqual(
+            [data for _, _, data in read_traces(
+                [self.path + '.2', self.path + '.1', self.path])],
+            [b'b' * 10, b'c' * 10, b'd' * 10])
+
+    def test_not_a_trace(self):
+        with open(self.path, 'wb') as trace:
+            trace.write(b'SSMI,3\r')
+        self.assertRaises(TraceFormatError, list, read_trace(self.path))
+
+    def test_truncated(self):
+        recorder = self.recorder()
+        recorder.received(b'SSMI,3')
+        recorder.close()
+        with open(self.path, 'rb+') as trace:
+            trace.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(TraceFormatError, list, read_trace(self.path))
+
+    def test_dump(self):
+        recorder = self.recorder()
+        recorder.sent(b'SSMI,3\rSSMI,4')
+        recorder.close()
+        out = StringIO()
+        dump([self.path], out)
+        self.assertEqual(out.getvalue(),
+                         '0.000000 >> SSMI,3\n0.000000 >> SSMI,4\n')
+
+    def test_main_dump(self):
+        recorder = self.recorder()
+        recorder.received(b'SSMI,100,2700000000,1')
+        recorder.close()
+        out = StringIO()
+        self.patch(sys, 'stdout', out)
+        d = main(self.clock, 'dump', self.path)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(out.getvalue(),
+                         '0.000000 << SSMI,100,2700000000,1\n')
+
+
+class ProtocolTraceTestCase(TestCase):
+
+    def test_protocol_records(self):
+        clock = Clock()
+        path = self.mktemp()
+        recorder = TraceRecorder(path, clock=clock)
+        self.addCleanup(recorder.close)
+        self.patch(SSMIProtocol, 'clock', clock)
+        self.patch(SSMIProtocol, 'trace', recorder)
+        protocol = SSMIProtocol()
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(
+            Ack(ack_type='1').to_bytes() + b'\r' +
+            Seq(msisdn='2700000000', sequence='1').to_bytes()[:5])
+        protocol.write_commands([
+            SendSMS(msisdn='2700000000', message='hi', validity='0')])
+        recorder.close()
+        self.assertEqual(list(read_trace(path)), [
+            (0, RECEIVED, Ack(ack_type='1').to_bytes()),
+            (0, SENT, SendSMS(msisdn='2700000000', message='hi',
+                              validity='0').to_bytes()),
+        ])
+
+
+class TraceReplayerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.records = [
+            (100.0, RECEIVED, MoMessage(
+                msisdn='2700000000', sequence='1',
+                message='a').to_bytes()),
+            (100.5, SENT, b'SSMI,3'),
+            (102.0, RECEIVED, MoMessage(
+                msisdn='2700000000', sequence='2',
+                message='b').to_bytes() + b'\r' + MoMessage(
+                msisdn='2700000000', sequence='3',
+                message='c').to_bytes()),
+        ]
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.protocol, direction = replay_protocol('client')
+        self.assertEqual(direction, RECEIVED)
+        self.received = []
+        self.protocol.register_handler('MO', self.received.append)
+
+    def test_as_fast_as_possible(self):
+        replayer = TraceReplayer(
+            iter(self.records), self.protocol, RECEIVED, clock=self.clock)
+        d = replayer.start()
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(self.successResultOf(d), replayer)
+        self.assertEqual(
+            [mo.sequence for mo in self.received], ['1', '2', '3'])
+        self.assertEqual(replayer.lines, 3)
+        self.assertEqual(replayer.elapsed, 0)
+
+    def test_original_pace(self):
+        replayer = TraceReplayer(
+            iter(self.records), self.protocol, RECEIVED, speed=2,
+            clock=self.clock)
+        d = replayer.start()
+        self.clock.advance(0)
+        self.assertEqual(len(self.received), 1)
+        self.clock.advance(0.9)
+        self.assertEqual(len(self.received), 1)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.clock.advance(0)
+        self.assertEqual(len(self.received), 3)
+        self.successResultOf(d)
+        self.assertEqual(replayer.elapsed, 1)
+
+    def test_server_target(self):
+        protocol, direction = replay_protocol('server')
+        self.assertEqual(direction, SENT)
+        replayer = TraceReplayer(
+            iter(self.records), protocol, SENT, clock=self.clock)
+        d = replayer.start()
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(protocol.factory.received['LINK_CHECK'], 1)
+        self.assertTrue(protocol.transport.written)
+
+    def test_null_transport(self):
+        protocol, direction = replay_protocol('client')
+        transport = protocol.transport
+        self.assertIsInstance(transport, NullTransport)
+        self.assertIs(transport.producer, protocol)
+        transport.writeSequence([b'foo', b'\r'])
+        self.assertEqual(transport.written, 4)
+        self.assertFalse(transport.disconnecting)
+        transport.loseConnection()
+        self.assertTrue(transport.disconnecting)
+
+
+class OptionsTestCase(TestCase):
+
+    def test_replay(self):
+        options = Options()
+        options.parseOptions(['replay', '--speed=10', 'a', 'b'])
+        self.assertEqual(options.subOptions['paths'], ('a', 'b'))
+        self.assertEqual(options.subOptions['speed'], 10.0)
+        self.assertEqual(options.subOptions['target'], 'client')
+
+    def test_invalid(self):
+        for argv in [[], ['replay'], ['replay', '--target=foo', 'a'],
+                     ['replay', '--speed=0', 'a'], ['dump']]:
+            self.assertRaises(UsageError, Options().parseOptions, argv)
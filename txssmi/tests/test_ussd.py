@@ -0,0 +1,172 @@
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from txssmi.builder import SSMIRequest
+from txssmi.commands import USSDMessage, ExtendedUSSDMessage
+from txssmi.constants import (
+    USSD_NEW, USSD_RESPONSE, USSD_END, USSD_TIMEOUT, USSD_PHASE_2)
+from txssmi.protocol import SSMIProtocol
+from txssmi.ussd import (
+    USSDApplication, USSDSessionManager, USSDSessionEnded, END_USER,
+    END_APPLICATION, END_NETWORK_TIMEOUT, END_IDLE, END_REPLACED,
+    END_CONNECTION_LOST)
+
+
+class RecordingApplication(USSDApplication):
+
+    def __init__(self):
+        self.events = []
+
+    def session_started(self, session, message):
+        self.events.append(('started', session.msisdn, message))
+
+    def message_received(self, session, message):
+        self.events.append(('message', session.msisdn, message))
+
+    def session_ended(self, session, reason):
+        self.events.append(('ended', session.msisdn, reason))
+
+
+class USSDSessionManagerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SSMIProtocol, 'clock', self.clock)
+        self.application = RecordingApplication()
+        self.manager = USSDSessionManager(
+            self.application, idle_timeout=10, clock=self.clock)
+        self.addCleanup(self.manager.stop)
+        self.protocol = self.connect()
+
+    def connect(self):
+        protocol = SSMIProtocol()
+        protocol.makeConnection(StringTransport())
+        self.manager.attach(protocol)
+        return protocol
+
+    def receive(self, msisdn, session_type, message='', protocol=None):
+        protocol = protocol or self.protocol
+        protocol.lineReceived(str(USSDMessage(
+            msisdn=msisdn, type=session_type, phase=USSD_PHASE_2,
+            message=message)))
+
+    def sent(self, protocol=None):
+        protocol = protocol or self.protocol
+        lines = protocol.transport.value().split(protocol.delimiter)
+        protocol.transport.clear()
+        return [SSMIRequest.from_bytes(line) for line in lines if line]
+
+    def test_session(self):
+        self.receive('2700000000', USSD_NEW, '*120#')
+        session = self.manager.get('2700000000')
+        self.assertEqual(session.protocol, self.protocol)
+        self.assertEqual(len(self.manager), 1)
+        self.receive('2700000000', USSD_RESPONSE, '1')
+        self.receive('2700000000', USSD_END)
+        self.assertEqual(self.application.events, [
+            ('started', '2700000000', '*120#'),
+            ('message', '2700000000', '1'),
+            ('ended', '2700000000', END_USER),
+        ])
+        self.assertEqual(len(self.manager), 0)
+
+    def test_extended_ussd(self):
+        self.protocol.lineReceived(str(ExtendedUSSDMessage(
+            msisdn='2700000000', type=USSD_NEW, phase=USSD_PHASE_2,
+            message='*120#', genfields='655011234567890:1::')))
+        self.assertEqual(self.application.events, [
+            ('started', '2700000000', '*120#')])
+
+    def test_reply(self):
+        self.receive('2700000000', USSD_NEW, '*120#')
+        session = self.manager.get('2700000000')
+        session.reply('Menu')
+        session.reply('Bye', end=True)
+        [menu, bye] = self.sent()
+        self.assertEqual((menu.type, menu.message), (USSD_RESPONSE, 'Menu'))
+        self.assertEqual((bye.type, bye.message), (USSD_END, 'Bye'))
+        self.assertEqual(self.application.events[-1],
+                         ('ended', '2700000000', END_APPLICATION))
+        self.assertRaises(USSDSessionEnded, session.reply, 'foo')
+
+    def test_network_timeout(self):
+        self.receive('2700000000', USSD_NEW)
+        self.receive('2700000000', USSD_TIMEOUT)
+        self.assertEqual(self.application.events[-1],
+                         ('ended', '2700000000', END_NETWORK_TIMEOUT))
+
+    def test_idle_timeout(self):
+        self.receive('2700000000', USSD_NEW)
+        self.clock.advance(5)
+        self.receive('2700000001', USSD_NEW)
+        self.clock.advance(2)
+        self.receive('2700000000', USSD_RESPONSE)
+        self.clock.advance(3)
+        self.assertEqual(len(self.manager), 2)
+        self.clock.advance(5)
+        self.assertEqual(self.manager.get('2700000001'), None)
+        self.assertEqual(self.application.events[-1],
+                         ('ended', '2700000001', END_IDLE))
+        self.clock.advance(2)
+        self.assertEqual(len(self.manager), 0)
+        self.assertEqual(self.manager.expired, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reply_resets_idle_timer(self):
+        self.receive('2700000000', USSD_NEW)
+        self.clock.advance(9)
+        self.manager.get('2700000000').reply('Menu')
+        self.clock.advance(9)
+        self.assertEqual(len(self.manager), 1)
+
+    def test_new_replaces_session(self):
+        self.receive('2700000000', USSD_NEW, '*120#')
+        self.receive('2700000000', USSD_NEW, '*130#')
+        self.assertEqual(self.application.events, [
+            ('started', '2700000000', '*120#'),
+            ('ended', '2700000000', END_REPLACED),
+            ('started', '2700000000', '*130#'),
+        ])
+
+    def test_unknown_session(self):
+        self.receive('2700000000', USSD_END)
+        self.assertEqual(self.application.events, [])
+        self.receive('2700000000', USSD_RESPONSE, '1')
+        self.assertEqual(self.application.events, [
+            ('started', '2700000000', '1')])
+
+    def test_connection_lost(self):
+        other = self.connect()
+        self.receive('2700000000', USSD_NEW)
+        self.receive('2700000001', USSD_NEW, protocol=other)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.application.events[-1],
+                         ('ended', '2700000000', END_CONNECTION_LOST))
+        self.assertEqual(list(self.manager.sessions), ['2700000001'])
+
+    def test_application_errors(self):
+        def broken(session, message):
+            raise ValueError('foo')
+        self.application.session_started = broken
+        self.receive('2700000000', USSD_NEW)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(self.manager), 1)
+
+    def test_snapshot(self):
+        for i in range(3):
+            self.receive('270000000%s' % (i,), USSD_NEW)
+        self.receive('2700000000', USSD_END)
+        self.assertEqual(self.manager.snapshot(), {
+            'active': 2, 'peak': 3, 'started': 3, 'ended': 1,
+            'expired': 0})
+
+    def test_many_sessions(self):
+        for i in range(20000):
+            self.receive('27%09d' % (i,), USSD_NEW)
+        self.assertEqual(len(self.manager), 20000)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(10)
+        self.assertEqual(len(self.manager), 0)
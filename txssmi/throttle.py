@@ -0,0 +1,58 @@
+# -*- test-case-name: txssmi.tests.test_throttle -*-
+
+from twisted.internet import reactor
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter driven by a Twisted clock.
+
+    The bucket refills at ``rate`` tokens per second up to ``burst`` tokens.
+    Callers take tokens with :meth:`consume` as long as they are
+    :meth:`available` and use :meth:`delay` to schedule the next attempt.
+    """
+
+    epsilon = 1e-9
+
+    def __init__(self, rate, burst=None, clock=reactor):
+        if rate <= 0:
+            raise ValueError('rate must be positive: %r' % (rate,))
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.clock = clock
+        self._tokens = float(self.burst)
+        self.updated = clock.seconds()
+
+    def refill(self):
+        now = self.clock.seconds()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def tokens(self):
+        """
+        The number of tokens currently in the bucket.
+        """
+        self.refill()
+        return self._tokens
+
+    def available(self):
+        """
+        The number of whole tokens that can be consumed without waiting.
+        """
+        return int(self.tokens + self.epsilon)
+
+    def consume(self, count):
+        """
+        Take ``count`` tokens straight away, see :meth:`available`.
+        """
+        self.refill()
+        self._tokens -= count
+
+    def delay(self, count=1):
+        """
+        Seconds until ``count`` tokens will be available.
+        """
+        self.refill()
+        return max(0.0, (count - self._tokens) / self.rate)
@@ -0,0 +1,340 @@
+# -*- test-case-name: txssmi.tests.test_trace -*-
+"""
+Record the lines an :class:`txssmi.protocol.SSMIProtocol` sends and
+receives to a compact binary trace, and replay traces.
+
+Set ``SSMIProtocol.trace`` to a :class:`TraceRecorder` to record. To look
+at a trace or replay it, as fast as possible or at the pace it was
+recorded::
+
+    python -m txssmi.trace dump trace.bin
+    python -m txssmi.trace replay --target=client trace.bin.1 trace.bin
+    python -m txssmi.trace replay --target=server --speed=1 trace.bin
+
+``replay`` feeds the lines the client received to an ``SSMIProtocol``,
+or the lines it sent to the fake server in :mod:`txssmi.server`, and
+reports the throughput.
+"""
+
+import os
+import struct
+import sys
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import succeed
+from twisted.internet.error import ConnectionDone
+from twisted.python import usage
+from twisted.python.failure import Failure
+
+from txssmi.builder import decode
+
+# A trace is this header followed by records of a timestamp, a direction
+# and a length, then that many bytes holding one or more lines joined by
+# the delimiter.
+TRACE_MAGIC = b'SSMITRACE1\n'
+RECORD = struct.Struct('<dBI')
+RECEIVED = 0
+SENT = 1
+DIRECTIONS = {RECEIVED: '<<', SENT: '>>'}
+DELIMITER = b'\r'
+
+
+class TraceFormatError(Exception):
+    pass
+
+
+class TraceRecorder(object):
+    """
+    Appends timestamped records of the data sent and received to the
+    trace at ``path``.
+
+    Once the file would grow past ``max_bytes`` it is renamed to
+    ``path.1``, ``path.1`` to ``path.2`` and so on, keeping at most
+    ``backup_count`` old files, and a new one is started. Records are
+    buffered, call :meth:`flush` or :meth:`close` to write them out.
+    """
+
+    buffer_size = 65536
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backup_count=5,
+                 clock=reactor):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.clock = clock
+        self.records = 0
+        self.rotations = 0
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab', self.buffer_size)
+        self.size = self.file.tell()
+        if not self.size:
+            self.file.write(TRACE_MAGIC)
+            self.size = len(TRACE_MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for number in range(self.backup_count - 1, 0, -1):
+                source = '%s.%d' % (self.path, number)
+                if os.path.exists(source):
+                    os.rename(source, '%s.%d' % (self.path, number + 1))
+            os.rename(self.path, '%s.1' % (self.path,))
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self.open()
+
+    def record(self, direction, data):
+        """
+        Record ``data``, complete lines without the trailing delimiter,
+        as sent or received now.
+        """
+        length = RECORD.size + len(data)
+        if self.size + length > self.max_bytes and self.records:
+            self.rotate()
+        self.file.write(RECORD.pack(self.clock.seconds(), direction,
+                                    len(data)))
+        self.file.write(data)
+        self.size += length
+        self.records += 1
+
+    def received(self, data):
+        self.record(RECEIVED, data)
+
+    def sent(self, data):
+        self.record(SENT, data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_trace(path):
+    """
+    Yields ``(timestamp, direction, data)`` for every record in the trace
+    at ``path``.
+    """
+    with open(path, 'rb') as trace:
+        if trace.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise TraceFormatError('Not an SSMI trace: %s' % (path,))
+        while True:
+            header = trace.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise TraceFormatError('Truncated record in %s' % (path,))
+            timestamp, direction, length = RECORD.unpack(header)
+            data = trace.read(length)
+            if len(data) < length:
+                raise TraceFormatError('Truncated record in %s' % (path,))
+            yield timestamp, direction, data
+
+
+def read_traces(paths):
+    """
+    Yields the records of the traces at ``paths``, in the order given.
+    """
+    for path in paths:
+        for record in read_trace(path):
+            yield record
+
+
+class NullTransport(object):
+    """
+    A transport that counts what is written to it and throws it away.
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.disconnecting = False
+        self.producer = None
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TraceReplayer(object):
+    """
+    Feeds the data going in ``direction`` in ``records`` to ``protocol``.
+
+    With a ``speed`` of None the data is fed as fast as the protocol takes
+    it, otherwise at the pace it was recorded, sped up ``speed`` times.
+    :meth:`start` returns a Deferred that fires with the replayer once
+    every record has been fed.
+    """
+
+    def __init__(self, records, protocol, direction, speed=None,
+                 clock=reactor):
+        self.records = records
+        self.protocol = protocol
+        self.direction = direction
+        self.speed = speed
+        self.clock = clock
+        self.cooperator = task.Cooperator(
+            scheduler=lambda x: clock.callLater(0, x))
+        self.lines = 0
+        self.bytes = 0
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or self.clock.seconds()) - self.started_at
+
+    def start(self):
+        self.started_at = self.clock.seconds()
+        d = self.cooperator.cooperate(self.feed()).whenDone()
+        d.addCallback(lambda _: self.finish())
+        return d
+
+    def finish(self):
+        self.finished_at = self.clock.seconds()
+        return self
+
+    def feed(self):
+        delimiter = self.protocol.delimiter
+        first = None
+        for timestamp, direction, data in self.records:
+            if direction != self.direction:
+                continue
+            if self.speed is not None:
+                if first is None:
+                    first = timestamp
+                delay = ((timestamp - first) / self.speed -
+                         (self.clock.seconds() - self.started_at))
+                if delay > 0:
+                    yield task.deferLater(self.clock, delay, lambda: None)
+            self.protocol.dataReceived(data + delimiter)
+            self.lines += data.count(delimiter) + 1
+            self.bytes += len(data) + len(delimiter)
+            yield None
+
+
+def dump(paths, out=None):
+    if out is None:
+        out = sys.stdout
+    for timestamp, direction, data in read_traces(paths):
+        for line in data.split(DELIMITER):
+            out.write('%.6f %s %s\n' % (
+                timestamp, DIRECTIONS.get(direction, '??'),
+                decode(line)))
+
+
+def replay_protocol(target):
+    """
+    Returns the protocol to replay to for ``target`` and the direction of
+    the lines it takes, connected to a :class:`NullTransport`.
+    """
+    if target == 'client':
+        from txssmi.protocol import SSMIProtocol
+        protocol, direction = SSMIProtocol(), RECEIVED
+    else:
+        from txssmi.server import SSMIServerFactory
+        protocol, direction = SSMIServerFactory().buildProtocol(None), SENT
+        # Traces that start after the login are replayed too.
+        protocol.authenticated = True
+    protocol.makeConnection(NullTransport())
+    return protocol, direction
+
+
+class DumpOptions(usage.Options):
+
+    synopsis = '<trace> [<trace> ...]'
+
+    def parseArgs(self, *paths):
+        if not paths:
+            raise usage.UsageError('No trace given.')
+        self['paths'] = paths
+
+
+class ReplayOptions(usage.Options):
+
+    synopsis = '[options] <trace> [<trace> ...]'
+
+    optParameters = [
+        ['target', 't', 'client',
+         'Replay the lines the client received to an SSMIProtocol '
+         '(client), or those it sent to the fake server (server).'],
+        ['speed', 's', None,
+         'Replay at the recorded pace, sped up this many times. As fast '
+         'as possible by default.', float],
+    ]
+
+    def parseArgs(self, *paths):
+        if not paths:
+            raise usage.UsageError('No trace given.')
+        self['paths'] = paths
+
+    def postOptions(self):
+        if self['target'] not in ('client', 'server'):
+            raise usage.UsageError(
+                'Unknown target: %s' % (self['target'],))
+        if self['speed'] is not None and self['speed'] <= 0:
+            raise usage.UsageError('Speed must be positive.')
+
+
+class Options(usage.Options):
+
+    subCommands = [
+        ['dump', None, DumpOptions, 'Print the lines in traces.'],
+        ['replay', None, ReplayOptions, 'Replay traces.'],
+    ]
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError('No command given.')
+
+
+def replay(reactor, options, out=None):
+    if out is None:
+        out = sys.stdout
+    protocol, direction = replay_protocol(options['target'])
+    replayer = TraceReplayer(
+        read_traces(options['paths']), protocol, direction,
+        options['speed'], clock=reactor)
+
+    def report(replayer):
+        elapsed = replayer.elapsed
+        protocol.connectionLost(Failure(ConnectionDone()))
+        out.write('lines: %d (%.1f MB) in %.2fs\n' % (
+            replayer.lines, replayer.bytes / 1e6, elapsed))
+        out.write('throughput: %.0f lines/sec %.1f MB/sec\n' % (
+            replayer.lines / elapsed, replayer.bytes / 1e6 / elapsed))
+
+    return replayer.start().addCallback(report)
+
+
+def main(reactor, *argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        raise SystemExit('%s\n%s' % (options, e))
+    if options.subCommand == 'dump':
+        dump(options.subOptions['paths'])
+        # task.react wants a Deferred.
+        return succeed(None)
+    return replay(reactor, options.subOptions)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
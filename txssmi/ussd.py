@@ -0,0 +1,204 @@
+# -*- test-case-name: txssmi.tests.test_ussd -*-
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from txssmi.builder import SSMIException
+from txssmi.constants import (
+    USSD_NEW, USSD_RESPONSE, USSD_END, USSD_TIMEOUT)
+
+END_USER = 'end'
+END_APPLICATION = 'application'
+END_NETWORK_TIMEOUT = 'timeout'
+END_IDLE = 'idle'
+END_REPLACED = 'replaced'
+END_CONNECTION_LOST = 'connection_lost'
+
+
+class USSDSessionEnded(SSMIException):
+    pass
+
+
+class USSDSession(object):
+    """
+    An active USSD session with ``msisdn``. ``state`` is free for the
+    application to use.
+    """
+
+    __slots__ = ('manager', 'protocol', 'msisdn', 'started_at', 'last_seen',
+                 'state')
+
+    def __init__(self, manager, protocol, msisdn, now):
+        self.manager = manager
+        self.protocol = protocol
+        self.msisdn = msisdn
+        self.started_at = now
+        self.last_seen = now
+        self.state = None
+
+    def __repr__(self):
+        return '<USSDSession msisdn=%s>' % (self.msisdn,)
+
+    def reply(self, message, end=False):
+        """
+        Send ``message`` to the user, ending the session if ``end`` is
+        True. Returns the protocol's Deferred for the send.
+        """
+        return self.manager.reply(self, message, end)
+
+
+class USSDApplication(object):
+    """
+    Called by :class:`USSDSessionManager` as sessions start, receive
+    messages and end. Subclasses override the methods they need.
+    """
+
+    def session_started(self, session, message):
+        pass
+
+    def message_received(self, session, message):
+        pass
+
+    def session_ended(self, session, reason):
+        pass
+
+
+class USSDSessionManager(object):
+    """
+    Tracks USSD sessions per msisdn for the protocols it is attached to
+    and hands their messages to ``application``.
+
+    Sessions end when the user or the application ends them, when the
+    network times them out or after ``idle_timeout`` seconds without a
+    message either way. Sessions are kept in order of last activity and a
+    single timer expires the idle ones, so tens of thousands of sessions
+    cost one delayed call.
+    """
+
+    def __init__(self, application, idle_timeout=180, clock=reactor):
+        self.application = application
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.sessions = OrderedDict()
+        self.expire_call = None
+        self.peak = 0
+        self.started = 0
+        self.ended = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, msisdn):
+        return self.sessions.get(msisdn)
+
+    def attach(self, protocol):
+        """
+        Handle the USSD messages received on ``protocol``, sessions on it
+        end when it disconnects.
+        """
+        def handler(command):
+            self.handle_message(protocol, command)
+
+        protocol.register_handler('USSD_MESSAGE', handler)
+        protocol.register_handler('EXTENDED_USSD_MESSAGE', handler)
+        protocol.wait_for_disconnect().addCallback(
+            lambda _: self.connection_lost(protocol))
+        return protocol
+
+    def handle_message(self, protocol, command):
+        msisdn = command.msisdn
+        session = self.sessions.get(msisdn)
+        if command.type == USSD_NEW or session is None:
+            if session is not None:
+                self.end(session, END_REPLACED)
+            if command.type in (USSD_END, USSD_TIMEOUT):
+                return
+            session = self.start(protocol, msisdn)
+            self.call('session_started', session, command.message)
+        elif command.type == USSD_END:
+            self.end(session, END_USER)
+        elif command.type == USSD_TIMEOUT:
+            self.end(session, END_NETWORK_TIMEOUT)
+        else:
+            self.touch(session)
+            self.call('message_received', session, command.message)
+
+    def start(self, protocol, msisdn):
+        session = USSDSession(self, protocol, msisdn, self.clock.seconds())
+        self.sessions[session.msisdn] = session
+        self.started += 1
+        self.peak = max(self.peak, len(self.sessions))
+        self.schedule_expiry()
+        return session
+
+    def touch(self, session):
+        session.last_seen = self.clock.seconds()
+        del self.sessions[session.msisdn]
+        self.sessions[session.msisdn] = session
+
+    def reply(self, session, message, end=False):
+        if self.sessions.get(session.msisdn) is not session:
+            raise USSDSessionEnded(
+                'Session with %s has ended.' % (session.msisdn,))
+        d = session.protocol.send_ussd_message(
+            session.msisdn, message, USSD_END if end else USSD_RESPONSE)
+        if end:
+            self.end(session, END_APPLICATION)
+        else:
+            self.touch(session)
+        return d
+
+    def end(self, session, reason):
+        if self.sessions.get(session.msisdn) is not session:
+            return
+        del self.sessions[session.msisdn]
+        self.ended += 1
+        self.call('session_ended', session, reason)
+
+    def call(self, method, session, arg):
+        try:
+            getattr(self.application, method)(session, arg)
+        except Exception:
+            log.err(None, 'Error in USSD application %s for %r.' % (
+                method, session))
+
+    def schedule_expiry(self):
+        if self.expire_call is not None or not self.sessions:
+            return
+        oldest = next(iter(self.sessions.values()))
+        delay = max(0, oldest.last_seen + self.idle_timeout -
+                    self.clock.seconds())
+        self.expire_call = self.clock.callLater(delay, self.expire)
+
+    def expire(self):
+        self.expire_call = None
+        deadline = self.clock.seconds() - self.idle_timeout
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_seen > deadline:
+                break
+            self.expired += 1
+            self.end(session, END_IDLE)
+        self.schedule_expiry()
+
+    def connection_lost(self, protocol):
+        for session in list(self.sessions.values()):
+            if session.protocol is protocol:
+                self.end(session, END_CONNECTION_LOST)
+
+    def snapshot(self):
+        return {
+            'active': len(self.sessions),
+            'peak': self.peak,
+            'started': self.started,
+            'ended': self.ended,
+            'expired': self.expired,
+        }
+
+    def stop(self):
+        if self.expire_call is not None:
+            self.expire_call.cancel()
+            self.expire_call = None